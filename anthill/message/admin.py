@@ -6,11 +6,13 @@ from anthill.common.jsonrpc import JsonRPCError
 from anthill.common import to_int
 
 from .model.group import GroupError, GroupNotFound, GroupExistsError, UserAlreadyJoined, GroupParticipantNotFound
-from .model.history import MessageError, MessageNotFound
+from .model.history import MessageError, MessageNotFound, MessageQueryError
 from .model import MessageFlags
 
 import logging
+import tempfile
 import math
+import io
 
 
 class IndexController(a.AdminController):
@@ -19,7 +21,13 @@ class IndexController(a.AdminController):
             a.links("Message service", [
                 a.link("users", "Edit user conversations", icon="user"),
                 a.link("groups", "Edit groups", icon="users"),
-                a.link("history", "Message history", icon="history")
+                a.link("history", "Message history", icon="history"),
+                a.link("retention", "Retention policies", icon="clock-o"),
+                a.link("quotas", "Mailbox quotas", icon="inbox"),
+                a.link("compression", "Payload compression", icon="compress"),
+                a.link("history_export", "Export / Import history", icon="exchange"),
+                a.link("jobs", "Background jobs", icon="tasks"),
+                a.link("shards", "Shards", icon="database")
             ])
         ]
 
@@ -85,6 +93,20 @@ class UserController(a.AdminController):
                 a.link("group", "@" + str(group.group_id), icon="users", group_id=group.group_id)
                 for group in data["user_groups"]
             ]),
+            a.content("Unread messages", [
+                {
+                    "id": "recipient_class",
+                    "title": "Recipient Class"
+                }, {
+                    "id": "recipient",
+                    "title": "Recipient"
+                }, {
+                    "id": "count",
+                    "title": "Unread"
+                }], [counter.dump() for counter in data["unread"]], "default", empty="No unread messages"),
+            a.form(title="Unread counters", fields={}, methods={
+                "recount_unread": a.method("Recount", "default")
+            }, data={}),
             a.links("Navigate", [
                 a.link("users", "Go back", icon="chevron-left"),
                 a.link("add_user_participation", "Join a Group", icon="plus", account=self.context.get("account")),
@@ -107,10 +129,26 @@ class UserController(a.AdminController):
         except GroupError as e:
             raise a.ActionError("Failed to get user conversations: " + e.message)
 
+        try:
+            unread = await self.application.history.list_unread(self.gamespace, account)
+        except MessageError as e:
+            raise a.ActionError("Failed to get unread counters: " + e.message)
+
         return {
-            "user_groups": user_groups
+            "user_groups": user_groups,
+            "unread": unread
         }
 
+    async def recount_unread(self, **ignored):
+        account = self.context.get("account")
+
+        try:
+            await self.application.history.recount_unread(self.gamespace, account)
+        except MessageError as e:
+            raise a.ActionError("Failed to recount unread messages: " + e.message)
+
+        raise a.Redirect("user", message="Unread counters have been recounted", account=account)
+
 
 class GroupsController(a.AdminController):
     def render(self, data):
@@ -749,6 +787,14 @@ class MessagesHistoryController(a.AdminController):
     def access_scopes(self):
         return ["message_admin"]
 
+    @staticmethod
+    def __pages__(page, page_size, count):
+        if count is None:
+            # counts are omitted, so only allow to go one page further if this one is full
+            return page + 1 if page_size >= MessagesHistoryController.MESSAGES_PER_PAGE else page
+
+        return int(math.ceil(float(count) / float(MessagesHistoryController.MESSAGES_PER_PAGE)))
+
     async def filter(self, **args):
 
         page = self.context.get("page", 1)
@@ -791,8 +837,12 @@ class MessagesHistoryController(a.AdminController):
             if message_delivered:
                 q.message_delivered = message_delivered == "yes"
 
-            messages, count = await q.query(count=True)
-            pages = int(math.ceil(float(count) / float(MessagesHistoryController.MESSAGES_PER_PAGE)))
+            try:
+                messages, count = await q.query(count=True)
+            except MessageQueryError as e:
+                raise a.ActionError(e.message)
+
+            pages = MessagesHistoryController.__pages__(page, len(messages), count)
         else:
             messages, pages = [], 0
 
@@ -882,9 +932,498 @@ class UserMessagesController(a.AdminController):
             gamespace=self.gamespace, account_id=account_id,
             limit=UserMessagesController.MESSAGES_PER_PAGE, offset=offset)
 
-        pages = int(math.ceil(float(count) / float(UserMessagesController.MESSAGES_PER_PAGE)))
+        pages = MessagesHistoryController.__pages__(page, len(messages), count)
 
         return {
             "messages": messages,
             "pages": pages
         }
+
+
+class RetentionController(a.AdminController):
+    def render(self, data):
+        policies = [
+            {
+                "message_type": policy.message_type or "(any)",
+                "days": str(policy.days) if policy.days else "forever"
+            }
+            for policy in data["policies"]
+        ]
+
+        return [
+            a.breadcrumbs([], "Retention policies"),
+            a.content("Policies", [
+                {
+                    "id": "message_type",
+                    "title": "Message Type"
+                }, {
+                    "id": "days",
+                    "title": "Keep for (days)"
+                }], policies, "default", empty="No policies, messages are kept for {0}.".format(
+                "{0} days".format(data["default_days"]) if data["default_days"] else "forever")),
+            a.split([
+                a.form(title="Set a policy", fields={
+                    "message_type": a.field("Message type (empty for any type)", "text", "primary", order=1),
+                    "days": a.field("Keep for (days, 0 for forever)", "text", "primary", "number", order=2),
+                }, methods={
+                    "set_policy": a.method("Set", "primary")
+                }, data={}),
+                a.form(title="Delete a policy", fields={
+                    "message_type": a.field("Message type (empty for any type)", "text", "primary", order=1),
+                }, methods={
+                    "delete_policy": a.method("Delete", "danger")
+                }, data={})
+            ]),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        retention = self.application.retention
+
+        try:
+            policies = await retention.list_policies(self.gamespace)
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        return {
+            "policies": policies,
+            "default_days": retention.default_days
+        }
+
+    @validate(message_type="str", days="int")
+    async def set_policy(self, days, message_type=""):
+        try:
+            await self.application.retention.set_policy(self.gamespace, message_type, days)
+        except MessageError as e:
+            raise a.ActionError("Failed to set a policy: " + e.message)
+
+        raise a.Redirect("retention", message="Retention policy has been set")
+
+    @validate(message_type="str")
+    async def delete_policy(self, message_type=""):
+        try:
+            await self.application.retention.delete_policy(self.gamespace, message_type)
+        except MessageError as e:
+            raise a.ActionError("Failed to delete a policy: " + e.message)
+
+        raise a.Redirect("retention", message="Retention policy has been deleted")
+
+
+class QuotasController(a.AdminController):
+    def render(self, data):
+        quotas = [
+            {
+                "recipient_class": quota.recipient_class,
+                "message_type": quota.message_type or "(any)",
+                "messages": str(quota.messages)
+            }
+            for quota in data["quotas"]
+        ]
+
+        mailboxes = [
+            {
+                "recipient_class": mailbox.recipient_class,
+                "recipient": mailbox.recipient,
+                "message_type": mailbox.message_type or "(any)",
+                "undelivered": str(mailbox.undelivered),
+                "evicted": str(mailbox.evicted)
+            }
+            for mailbox in data["mailboxes"]
+        ]
+
+        return [
+            a.breadcrumbs([], "Mailbox quotas"),
+            a.content("Quotas", [
+                {
+                    "id": "recipient_class",
+                    "title": "Recipient Class"
+                }, {
+                    "id": "message_type",
+                    "title": "Message Type"
+                }, {
+                    "id": "messages",
+                    "title": "Undelivered messages"
+                }], quotas, "default", empty="No quotas, mailboxes are unlimited."),
+            a.split([
+                a.form(title="Set a quota", fields={
+                    "recipient_class": a.field("Recipient class", "text", "primary", "non-empty", order=1),
+                    "message_type": a.field("Message type (empty for any type)", "text", "primary", order=2),
+                    "messages": a.field("Undelivered messages", "text", "primary", "number", order=3),
+                }, methods={
+                    "set_quota": a.method("Set", "primary")
+                }, data={}),
+                a.form(title="Delete a quota", fields={
+                    "recipient_class": a.field("Recipient class", "text", "primary", "non-empty", order=1),
+                    "message_type": a.field("Message type (empty for any type)", "text", "primary", order=2),
+                }, methods={
+                    "delete_quota": a.method("Delete", "danger")
+                }, data={})
+            ]),
+            a.content("Mailboxes with evicted messages ({0} evicted by this process)".format(data["evicted"]), [
+                {
+                    "id": "recipient_class",
+                    "title": "Recipient Class"
+                }, {
+                    "id": "recipient",
+                    "title": "Recipient"
+                }, {
+                    "id": "message_type",
+                    "title": "Message Type"
+                }, {
+                    "id": "undelivered",
+                    "title": "Undelivered"
+                }, {
+                    "id": "evicted",
+                    "title": "Evicted"
+                }], mailboxes, "default", empty="No messages have been evicted."),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        quotas = self.application.quotas
+
+        try:
+            quota_list = await quotas.list_quotas(self.gamespace)
+            mailboxes = await quotas.list_mailboxes(self.gamespace)
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        return {
+            "quotas": quota_list,
+            "mailboxes": mailboxes,
+            "evicted": quotas.evicted
+        }
+
+    @validate(recipient_class="str_name", messages="int", message_type="str")
+    async def set_quota(self, recipient_class, messages, message_type=""):
+        try:
+            await self.application.quotas.set_quota(self.gamespace, recipient_class, message_type, messages)
+        except MessageError as e:
+            raise a.ActionError("Failed to set a quota: " + e.message)
+
+        raise a.Redirect("quotas", message="Mailbox quota has been set")
+
+    @validate(recipient_class="str_name", message_type="str")
+    async def delete_quota(self, recipient_class, message_type=""):
+        try:
+            await self.application.quotas.delete_quota(self.gamespace, recipient_class, message_type)
+        except MessageError as e:
+            raise a.ActionError("Failed to delete a quota: " + e.message)
+
+        raise a.Redirect("quotas", message="Mailbox quota has been deleted")
+
+
+class HistoryExportController(a.UploadAdminController):
+    def __init__(self, app, token):
+        super(HistoryExportController, self).__init__(app, token)
+        self.upload = None
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Export / Import history"),
+            a.form(title="Export history", fields={
+                "account": a.field("Account (empty to export the whole gamespace)", "text", "primary", order=1),
+            }, methods={
+                "export": a.method("Export into a file", "primary"),
+                "download": a.method("Download (a single account only)", "default")
+            }, data={}),
+            a.notice("Export", "A file is written into {0} on the service host.".format(data["path"])),
+            a.file_upload("Import history (.ndjson.gz)"),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        return {
+            "path": self.application.exports.path
+        }
+
+    @validate(account="str")
+    async def export(self, account=""):
+        account_id = to_int(account) if account else None
+
+        try:
+            path, exported = await self.application.exports.export_file(self.gamespace, account_id=account_id)
+        except MessageError as e:
+            raise a.ActionError("Failed to export history: " + e.message)
+
+        raise a.Redirect("history_export", message="Exported {0} messages into {1}".format(exported, path))
+
+    @validate(account="int")
+    async def download(self, account):
+        stream = io.BytesIO()
+
+        try:
+            await self.application.exports.export(self.gamespace, stream, account_id=account)
+        except MessageError as e:
+            raise a.ActionError("Failed to export history: " + e.message)
+
+        raise a.BinaryFile(stream.getvalue(), "messages-{0}.ndjson.gz".format(account))
+
+    async def receive_started(self, filename, args):
+        self.upload = tempfile.TemporaryFile()
+
+    async def receive_data(self, chunk):
+        self.upload.write(chunk)
+
+    async def receive_completed(self):
+        try:
+            self.upload.seek(0)
+            messages, positions = await self.application.exports.import_(self.gamespace, self.upload)
+        except MessageError as e:
+            raise a.ActionError("Failed to import history: " + e.message)
+        finally:
+            self.upload.close()
+
+        raise a.Redirect("history_export", message="Imported {0} messages and {1} read positions".format(
+            messages, positions))
+
+
+class JobsController(a.AdminController):
+    def render(self, data):
+        jobs = [
+            {
+                "job_id": str(job.job_id),
+                "kind": job.kind,
+                "status": [a.status(job.status, {
+                    "done": "success",
+                    "failed": "danger",
+                    "running": "info"
+                }.get(job.status, "default"))],
+                "stage": "{0} / {1}".format(job.stage, job.stages),
+                "progress": str(job.progress),
+                "created": str(job.created),
+                "updated": str(job.updated),
+                "error": job.error or ""
+            }
+            for job in data["jobs"]
+        ]
+
+        return [
+            a.breadcrumbs([], "Background jobs"),
+            a.content("Recent jobs", [
+                {
+                    "id": "job_id",
+                    "title": "ID"
+                }, {
+                    "id": "kind",
+                    "title": "Kind"
+                }, {
+                    "id": "status",
+                    "title": "Status"
+                }, {
+                    "id": "stage",
+                    "title": "Stage"
+                }, {
+                    "id": "progress",
+                    "title": "Rows processed"
+                }, {
+                    "id": "created",
+                    "title": "Created"
+                }, {
+                    "id": "updated",
+                    "title": "Updated"
+                }, {
+                    "id": "error",
+                    "title": "Error"
+                }], jobs, "default", empty="No jobs"),
+            a.form(title="Retry a failed job", fields={
+                "job_id": a.field("Job ID", "text", "primary", "number", order=1),
+            }, methods={
+                "retry": a.method("Retry", "primary")
+            }, data={}),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        try:
+            jobs = await self.application.jobs.list_jobs(self.gamespace)
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        return {
+            "jobs": jobs
+        }
+
+    @validate(job_id="int")
+    async def retry(self, job_id):
+        try:
+            await self.application.jobs.retry_job(self.gamespace, job_id)
+        except MessageError as e:
+            raise a.ActionError("Failed to retry a job: " + e.message)
+
+        raise a.Redirect("jobs", message="Job has been put back into the queue")
+
+
+class ShardsController(a.AdminController):
+    def render(self, data):
+        shards = [
+            {
+                "shard": str(index),
+                "messages": str(count)
+            }
+            for index, count in data["shards"]
+        ]
+
+        moved = [
+            {
+                "gamespace": str(shard.gamespace),
+                "shard": str(shard.shard),
+                "state": [a.status(shard.state, "info" if shard.state == "moving" else "success")],
+                "target": str(shard.target) if shard.target is not None else ""
+            }
+            for shard in data["moved"]
+        ]
+
+        return [
+            a.breadcrumbs([], "Shards"),
+            a.content("Shards", [
+                {
+                    "id": "shard",
+                    "title": "Shard"
+                }, {
+                    "id": "messages",
+                    "title": "Messages (estimated)"
+                }], shards, "default"),
+            a.content("Gamespaces moved off the primary", [
+                {
+                    "id": "gamespace",
+                    "title": "Gamespace"
+                }, {
+                    "id": "shard",
+                    "title": "Shard"
+                }, {
+                    "id": "state",
+                    "title": "State"
+                }, {
+                    "id": "target",
+                    "title": "Moving to"
+                }], moved, "default", empty="Every gamespace is on the primary"),
+            a.form(title="Move this gamespace", fields={
+                "shard": a.field("Current shard", "readonly", "primary", order=1),
+                "target": a.field("Target shard", "text", "primary", "number", order=2),
+            }, methods={
+                "move": a.method("Move", "primary"),
+                "abort_move": a.method("Abort a move", "danger")
+            }, data={"shard": str(data["shard"])}),
+            a.links("Navigate", [
+                a.link("jobs", "Background jobs", icon="tasks"),
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        shards = self.application.shards
+
+        try:
+            counts = await shards.count_messages()
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        return {
+            "shards": counts,
+            "moved": shards.list_moved(),
+            "shard": shards.index(self.gamespace)
+        }
+
+    @validate(target="int")
+    async def move(self, target, **ignored):
+        try:
+            await self.application.shards.move(self.gamespace, target)
+        except MessageError as e:
+            raise a.ActionError("Failed to move a gamespace: " + e.message)
+
+        raise a.Redirect("jobs", message="Gamespace is being moved")
+
+    async def abort_move(self, **ignored):
+        try:
+            await self.application.shards.abort_move(self.gamespace)
+        except MessageError as e:
+            raise a.ActionError("Failed to abort a move: " + e.message)
+
+        raise a.Redirect("shards", message="Move has been aborted")
+
+class CompressionController(a.AdminController):
+    def render(self, data):
+        stats = data["stats"]
+        saved = stats["original"] - stats["packed"]
+
+        return [
+            a.breadcrumbs([], "Payload compression"),
+            a.content("Compressed payloads of this gamespace", [
+                {
+                    "id": "messages",
+                    "title": "Messages"
+                }, {
+                    "id": "original",
+                    "title": "Original size (bytes)"
+                }, {
+                    "id": "packed",
+                    "title": "Compressed size (bytes)"
+                }, {
+                    "id": "saved",
+                    "title": "Saved"
+                }], [
+                {
+                    "messages": str(stats["messages"]),
+                    "original": str(stats["original"]),
+                    "packed": str(stats["packed"]),
+                    "saved": "{0} bytes ({1:.1f}%)".format(
+                        saved, saved * 100.0 / stats["original"] if stats["original"] else 0)
+                }], "default"),
+            a.form(title="Compress existing messages", fields={
+                "threshold": a.field("Payloads of at least (bytes, 0 for disabled)", "readonly", "primary", order=1),
+            }, methods={
+                "recompress": a.method("Compress", "primary")
+            }, data={"threshold": str(data["threshold"])}),
+            a.links("Navigate", [
+                a.link("jobs", "Background jobs", icon="tasks"),
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["message_admin"]
+
+    async def get(self):
+        history = self.application.history
+
+        try:
+            stats = await history.compression_stats(self.gamespace)
+        except MessageError as e:
+            raise a.ActionError(e.message)
+
+        return {
+            "stats": stats,
+            "threshold": history.compression.threshold
+        }
+
+    async def recompress(self, **ignored):
+        try:
+            await self.application.history.recompress(self.gamespace)
+        except MessageError as e:
+            raise a.ActionError("Failed to compress messages: " + e.message)
+
+        raise a.Redirect("jobs", message="Messages are being compressed")
@@ -15,6 +15,18 @@ import logging
 import ujson
 
 
+def dumps_messages(handler, data, messages, gamespace_id):
+    """
+    Writes a response the way handler.dumps does, with a list of messages (newest first) added to it
+        as "messages", oldest first. Messages are serialized with MessageAdapter.dump_json, so their
+        payloads go into the response as they're stored.
+    """
+    handler.set_header("Content-Type", "application/json")
+    handler.write(
+        ujson.dumps(data, escape_forward_slashes=False)[:-1] +
+        ',"messages":[' + ",".join(message.dump_json(gamespace_id) for message in reversed(messages)) + "]}")
+
+
 class ReadGroupInboxHandler(AuthenticatedHandler):
     @scoped()
     async def get(self, group_class, group_key):
@@ -47,32 +59,20 @@ class ReadGroupInboxHandler(AuthenticatedHandler):
             q.message_type = message_type
 
         q.limit = limit
+        q.count_mode = self.get_argument("count", None)
 
         try:
             messages, count = await q.query(count=True)
         except MessageQueryError as e:
             raise HTTPError(500, e.message)
 
-        self.dumps({
+        dumps_messages(self, {
             "reply_to": {
                 "recipient_class": message_recipient_class,
                 "recipient": message_recipient,
             },
-            "total_count": count,
-            "messages": [
-                {
-                    "uuid": message.message_uuid,
-                    "recipient_class": message.recipient_class,
-                    "sender": message.sender,
-                    "recipient": message.recipient,
-                    "gamespace": int(gamespace_id),
-                    "time": str(message.time),
-                    "type": message.message_type,
-                    "payload": message.payload
-                }
-                for message in reversed(messages)
-            ]
-        })
+            "total_count": count
+        }, messages, gamespace_id)
 
 
 class MessageHandler(AuthenticatedHandler):
@@ -135,35 +135,23 @@ class ReadMessagesHandler(AuthenticatedHandler):
         account_id = self.token.account
         gamespace_id = self.token.get(AccessToken.GAMESPACE)
 
-        async with history.db.acquire() as db:
+        async with history.read_db(gamespace_id).acquire() as db:
             try:
                 messages, count = await history.list_messages_account_with_count_db(
-                    gamespace_id, account_id, db=db, limit=limit, offset=offset)
+                    gamespace_id, account_id, db=db, limit=limit, offset=offset,
+                    count_mode=self.get_argument("count", None))
             except MessageError as e:
                 raise HTTPError(e.code, "Account is not joined in that group")
 
             read_messages = await history.list_read_messages(gamespace_id, account_id)
 
-            self.dumps({
+            dumps_messages(self, {
                 "last_read_messages": [
                     read_message.dump()
                     for read_message in read_messages
                 ],
-                "total_count": count,
-                "messages": [
-                    {
-                        "uuid": message.message_uuid,
-                        "recipient_class": message.recipient_class,
-                        "sender": message.sender,
-                        "recipient": message.recipient,
-                        "gamespace": int(gamespace_id),
-                        "time": str(message.time),
-                        "type": message.message_type,
-                        "payload": message.payload
-                    }
-                    for message in reversed(messages)
-                ]
-            })
+                "total_count": count
+            }, messages, gamespace_id)
 
 
 class ReadMessagesRecipientHandler(AuthenticatedHandler):
@@ -179,30 +167,18 @@ class ReadMessagesRecipientHandler(AuthenticatedHandler):
 
         try:
             messages, count = await history.list_messages_recipient_count(
-                gamespace_id, account_id, recipient_account_id, limit=limit, offset=offset)
+                gamespace_id, account_id, recipient_account_id, limit=limit, offset=offset,
+                count_mode=self.get_argument("count", None))
         except MessageError as e:
             raise HTTPError(e.code, "Account is not joined in that group")
 
-        self.dumps({
+        dumps_messages(self, {
             "reply_to": {
                 "recipient_class": CLASS_USER,
                 "recipient": str(recipient_account_id),
             },
-            "total_count": count,
-            "messages": [
-                {
-                    "uuid": message.message_uuid,
-                    "recipient_class": message.recipient_class,
-                    "sender": message.sender,
-                    "recipient": message.recipient,
-                    "gamespace": int(gamespace_id),
-                    "time": str(message.time),
-                    "type": message.message_type,
-                    "payload": message.payload
-                }
-                for message in reversed(messages)
-            ]
-        })
+            "total_count": count
+        }, messages, gamespace_id)
 
 
 class JoinGroupHandler(AuthenticatedHandler):
@@ -269,6 +245,7 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
         self.conversation.set_on_message(self._message)
         self.conversation.set_on_deleted(self._deleted)
         self.conversation.set_on_updated(self._updated)
+        self.conversation.set_on_unread(self._unread)
 
         self.authoritative = self.token.has_scope("message_authoritative")
 
@@ -276,6 +253,16 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
 
         logging.debug("Exchange has been opened!")
 
+        try:
+            unread = await self.application.history.list_unread(gamespace, account_id)
+        except MessageError as e:
+            logging.error("Failed to list unread messages: " + e.message)
+        else:
+            try:
+                await self.send_rpc(self, "unread", unread=[counter.dump() for counter in unread])
+            except JsonRPCError:
+                pass
+
     async def _message(self, gamespace_id, message_id, sender, recipient_class,
                        recipient_key, message_type, payload, time, flags):
 
@@ -326,9 +313,21 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
 
         return True
 
+    async def _unread(self, gamespace_id, unread):
+
+        try:
+            await self.send_rpc(
+                self,
+                "unread",
+                unread=unread)
+        except JsonRPCError as e:
+            return False
+
+        return True
+
     @validate(recipient_class="str", recipient_key="str", message_type="str", message="json_dict",
-              flags="json_list_of_strings")
-    def send_message(self, recipient_class, recipient_key, message_type, message, flags):
+              flags="json_list_of_strings", ttl="int")
+    def send_message(self, recipient_class, recipient_key, message_type, message, flags, ttl=0):
 
         sender = str(self.token.account)
         gamespace_id = self.token.get(AccessToken.GAMESPACE)
@@ -343,7 +342,8 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
             message_type,
             message,
             MessageFlags(flags),
-            authoritative=self.authoritative)
+            authoritative=self.authoritative,
+            ttl=ttl)
 
     @validate(message_id="str")
     async def delete_message(self, message_id):
@@ -385,6 +385,26 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
 
         return result
 
+    @validate(message_ids="json_list_of_strings")
+    async def mark_as_read_batch(self, message_ids):
+
+        account_id = str(self.token.account)
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+
+        history = self.application.history
+
+        try:
+            not_found = await history.mark_messages_as_read(
+                gamespace_id,
+                account_id,
+                message_ids)
+        except MessageError as e:
+            raise JsonRPCError(e.code, e.message)
+
+        return {
+            "not_found": not_found
+        }
+
     @validate(message_id="str", payload="json_dict")
     async def update_message(self, message_id, payload):
 
@@ -414,6 +434,66 @@ class ConversationEndpointHandler(JsonRPCWSHandler):
         self.conversation = None
 
 
+class ConversationsHandler(AuthenticatedHandler):
+    @scoped()
+    async def get(self):
+        history = self.application.history
+
+        limit = to_int(self.get_argument("limit", 100))
+        offset = to_int(self.get_argument("offset", 0))
+
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+
+        try:
+            conversations = await history.list_conversations(
+                gamespace_id, self.token.account, offset=offset, limit=limit)
+        except MessageError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({
+            "conversations": [conversation.dump() for conversation in conversations]
+        })
+
+
+class UnreadMessagesHandler(AuthenticatedHandler):
+    @scoped()
+    async def get(self):
+        history = self.application.history
+
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+
+        try:
+            unread = await history.list_unread(gamespace_id, self.token.account)
+        except MessageError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({
+            "unread": [counter.dump() for counter in unread]
+        })
+
+
+class MarkMessagesAsReadHandler(AuthenticatedHandler):
+    @scoped()
+    async def post(self):
+        history = self.application.history
+
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+
+        try:
+            message_ids = validate_value(ujson.loads(self.get_argument("messages")), "json_list_of_strings")
+        except (KeyError, ValueError, ValidationError):
+            raise HTTPError(400, "Corrupted messages")
+
+        try:
+            not_found = await history.mark_messages_as_read(gamespace_id, self.token.account, message_ids)
+        except MessageError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({
+            "not_found": not_found
+        })
+
+
 class SendMessagesHandler(AuthenticatedHandler):
     @scoped()
     async def post(self):
@@ -453,12 +533,14 @@ class SendMessageHandler(AuthenticatedHandler):
             raise HTTPError(400, "Corrupted payload")
 
         authoritative = self.token.has_scope("message_authoritative")
+        ttl = to_int(self.get_argument("ttl", 0), 0)
 
         try:
             await message_queue.add_message(
                 gamespace_id, self.token.account, recipient_class, recipient_key, message_type, payload,
                 MessageFlags(message_flags),
-                authoritative=authoritative)
+                authoritative=authoritative,
+                ttl=ttl)
 
         except MessageSendError as e:
             raise HTTPError(e.message, "Failed to deliver a message: " + e.message)
@@ -559,6 +641,61 @@ class InternalHandler(object):
             "status": "OK"
         }
 
+    @validate(gamespace="int", group_class="str_name", group_key="str", accounts="json_list_of_ints",
+              role="str_name", notify="json_dict", authoritative="bool")
+    async def join_group_bulk(self, gamespace, group_class, group_key, accounts, role="member",
+                              notify=None, authoritative=False):
+        groups = self.application.groups
+
+        try:
+            group = await groups.find_group(gamespace, group_class, group_key)
+        except GroupNotFound as e:
+            raise InternalError(404, "No such group")
+        except GroupError as e:
+            raise InternalError(e.code, e.message)
+
+        try:
+            participations, already_joined = await groups.join_group_bulk(
+                gamespace, group, accounts, role, notify=notify, authoritative=authoritative)
+        except GroupError as e:
+            raise InternalError(e.code, e.message)
+
+        return {
+            "participations": [
+                {
+                    "account_id": participation.account,
+                    "participation_id": participation.participation_id,
+                    "cluster_id": participation.cluster_id,
+                    "recipient_class": group.group_class,
+                    "recipient": participation.calculate_recipient()
+                }
+                for participation in participations
+            ],
+            "already_joined": already_joined
+        }
+
+    @validate(gamespace="int", group_class="str_name", group_key="str", accounts="json_list_of_ints",
+              notify="json_dict", authoritative="bool")
+    async def leave_group_bulk(self, gamespace, group_class, group_key, accounts, notify=None, authoritative=False):
+        groups = self.application.groups
+
+        try:
+            group = await groups.find_group(gamespace, group_class, group_key)
+        except GroupNotFound as e:
+            raise InternalError(404, "No such group")
+        except GroupError as e:
+            raise InternalError(e.code, e.message)
+
+        try:
+            participations = await groups.leave_group_bulk(
+                gamespace, group, accounts, notify=notify, authoritative=authoritative)
+        except GroupError as e:
+            raise InternalError(e.code, e.message)
+
+        return {
+            "left": [participation.account for participation in participations]
+        }
+
     async def send_batch(self, gamespace, sender, messages, authoritative=False):
         message_queue = self.application.message_queue
         logging.info("Delivering batched messages...")
@@ -567,12 +704,12 @@ class InternalHandler(object):
 
     @validate(gamespace="int", sender="int", recipient_class="str", recipient_key="str",
               message_type="str", payload="json_dict", flags="json_list_of_str_name",
-              authoritative="bool")
+              authoritative="bool", ttl="int")
     async def send_message(self, gamespace, sender, recipient_class, recipient_key, message_type,
-                           payload, flags, authoritative=False):
+                           payload, flags, authoritative=False, ttl=0):
         message_queue = self.application.message_queue
 
         await message_queue.add_message(
             gamespace, sender, recipient_class, recipient_key,
             message_type, payload, MessageFlags(flags),
-            authoritative=authoritative)
+            authoritative=authoritative, ttl=ttl)
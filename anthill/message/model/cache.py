@@ -0,0 +1,69 @@
+
+from collections import OrderedDict
+
+import time
+
+
+class LRUCache(object):
+    """
+    A small in-process cache with least-recently-used eviction and optional time to live.
+
+    It is not shared between processes, so everything put in here should either be safe to
+        serve slightly stale, or be invalidated explicitly.
+    """
+
+    def __init__(self, max_size=1000, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires and expires < time.time():
+            del self.items[key]
+            self.misses += 1
+            return default
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        self.items[key] = (value, time.time() + ttl if ttl else 0)
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        try:
+            value, expires = self.items.pop(key)
+        except KeyError:
+            return default
+        return value
+
+    def clear(self):
+        self.items.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / float(total)
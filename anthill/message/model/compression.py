@@ -0,0 +1,81 @@
+
+from . import MessageError
+
+import struct
+import ujson
+import zlib
+
+
+class PayloadCompression(object):
+    """
+    An opt-in compressed storage for large payloads, as `json` columns keep them verbatim, inflating both
+        the table and the buffer pool.
+
+    Payloads of at least `threshold` bytes (0 to disable) are compressed into `message_payload_packed`,
+        `message_payload` keeping a JSON null instead, unless compression does not save anything.
+        A compressed payload starts with a format marker and the size of the original JSON
+        (so the savings could be summed up with SQL alone), followed by the compressed JSON.
+
+    Compressed payloads are decoded by MessageAdapter, only once accessed. Payloads stored before
+        are compressed by a background job, see MessagesHistoryModel.recompress_stages.
+    """
+
+    FORMAT_ZLIB = b"z"
+
+    # a format marker, and the size of the original JSON
+    HEADER = struct.Struct(">cI")
+
+    # what `message_payload` holds for a compressed payload
+    PLACEHOLDER = "null"
+
+    def __init__(self, threshold=0, level=6):
+        self.threshold = threshold
+        self.level = level
+
+    def pack(self, payload_json, threshold=None):
+        """
+        Returns a (`message_payload`, `message_payload_packed`) tuple to store a payload (as JSON) with
+        """
+        threshold = self.threshold if threshold is None else threshold
+        if not threshold:
+            return payload_json, None
+
+        data = payload_json.encode("utf-8")
+        if len(data) < threshold:
+            return payload_json, None
+
+        packed = PayloadCompression.HEADER.pack(
+            PayloadCompression.FORMAT_ZLIB, len(data)) + zlib.compress(data, self.level)
+
+        if len(packed) >= len(data):
+            return payload_json, None
+
+        return PayloadCompression.PLACEHOLDER, packed
+
+    @staticmethod
+    def unpack(packed):
+        """
+        Returns the JSON of a compressed payload
+        """
+        packed = bytes(packed)
+        marker, size = PayloadCompression.HEADER.unpack_from(packed)
+
+        if marker != PayloadCompression.FORMAT_ZLIB:
+            raise MessageError(500, "Unknown payload format: {0}".format(marker))
+
+        return zlib.decompress(packed[PayloadCompression.HEADER.size:]).decode("utf-8")
+
+    @staticmethod
+    def payload_json(row):
+        """
+        Returns the payload of a message row as JSON, whether it's compressed or not
+        """
+        packed = row.get("message_payload_packed")
+        if packed is not None:
+            return PayloadCompression.unpack(packed)
+
+        payload = row["message_payload"]
+        if isinstance(payload, str):
+            return payload
+
+        return ujson.dumps(payload)
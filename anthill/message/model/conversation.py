@@ -33,10 +33,13 @@ class AccountConversation(object):
     TYPE = "type"
     PAYLOAD = "payload"
     FLAGS = "fl"
+    TTL = "ttl"
+    UNREAD = "unread"
 
     ACTION_NEW_MESSAGE = "m"
     ACTION_MESSAGE_DELETED = "d"
     ACTION_MESSAGE_UPDATED = "u"
+    ACTION_UNREAD_UPDATED = "n"
 
     EXCHANGE_PREFIX = "conv"
 
@@ -61,11 +64,13 @@ class AccountConversation(object):
         self.on_message = None
         self.on_deleted = None
         self.on_updated = None
+        self.on_unread = None
 
         self.actions = {
             AccountConversation.ACTION_NEW_MESSAGE: self.__action_new_message__,
             AccountConversation.ACTION_MESSAGE_UPDATED: self.__action_message_updated__,
-            AccountConversation.ACTION_MESSAGE_DELETED: self.__action_message_deleted__
+            AccountConversation.ACTION_MESSAGE_DELETED: self.__action_message_deleted__,
+            AccountConversation.ACTION_UNREAD_UPDATED: self.__action_unread_updated__
         }
 
     async def init(self, message_types=None):
@@ -146,6 +151,9 @@ class AccountConversation(object):
     def set_on_updated(self, callback):
         self.on_updated = callback
 
+    def set_on_unread(self, callback):
+        self.on_unread = callback
+
     # noinspection PyBroadException
     async def release(self):
 
@@ -203,6 +211,16 @@ class AccountConversation(object):
         if self.on_updated:
             return self.on_updated(gamespace_id, message_uuid, sender, payload)
 
+    def __action_unread_updated__(self, gamespace_id, message_uuid, sender, message):
+
+        try:
+            unread = message[AccountConversation.UNREAD]
+        except KeyError:
+            return
+
+        if self.on_unread:
+            return self.on_unread(gamespace_id, unread)
+
     async def __process__(self, channel, method, properties, body):
         try:
             message = ujson.loads(body)
@@ -0,0 +1,345 @@
+
+from anthill.common.database import DatabaseError
+
+from . import MessageError, CLASS_USER
+from . cache import LRUCache
+
+
+COUNT_NONE = "none"
+COUNT_APPROXIMATE = "approximate"
+COUNT_EXACT = "exact"
+
+# ordered from the cheapest to the most expensive one
+COUNT_MODES = [COUNT_NONE, COUNT_APPROXIMATE, COUNT_EXACT]
+
+KIND_RECIPIENT = "recipient"
+KIND_CONVERSATION = "conversation"
+KIND_SENDER = "sender"
+KIND_ACCOUNT = "account"
+
+
+def conversation_key(account_a, account_b):
+    """
+    Returns a canonical key for a direct conversation between two accounts,
+        so both directions of the conversation share it
+    """
+    try:
+        account_a, account_b = int(account_a), int(account_b)
+    except (TypeError, ValueError):
+        return None
+
+    return "{0}:{1}".format(min(account_a, account_b), max(account_a, account_b))
+
+
+class MessageCounters(object):
+    """
+    Maintains per-recipient, per-conversation and per-sender message counters, so list endpoints
+        could report total counts without counting matching rows on each request.
+
+    Counters are updated in the same transaction as the messages they count. Counts that cannot be
+        derived from counters are either counted exactly, or estimated from the query plan,
+        depending on the count mode. Either way the result is cached for a short period of time.
+    """
+
+    COUNTER_QUERY = """
+        SELECT `counter_value`
+        FROM `message_counters`
+        WHERE `gamespace_id`=%s AND `counter_kind`=%s AND `counter_class`=%s AND `counter_key`=%s
+        LIMIT 1;
+    """
+
+    def __init__(self, shards, mode=COUNT_EXACT, cache_ttl=5, cache_size=10000):
+        if mode not in COUNT_MODES:
+            raise MessageError(500, "Unknown count mode: " + str(mode))
+
+        self.shards = shards
+        self.mode = mode
+        self.cache = LRUCache(max_size=cache_size, ttl=cache_ttl)
+
+    def resolve_mode(self, mode=None):
+        """
+        Returns actual count mode for a request. A request can ask for a cheaper mode than the
+            default one, but never for a more expensive one.
+        """
+        if mode is None or mode not in COUNT_MODES:
+            return self.mode
+
+        return COUNT_MODES[min(COUNT_MODES.index(mode), COUNT_MODES.index(self.mode))]
+
+    @staticmethod
+    def message_keys(sender, recipient_class, recipient):
+        keys = [
+            (KIND_RECIPIENT, str(recipient_class), str(recipient)),
+            (KIND_SENDER, CLASS_USER, str(sender))
+        ]
+
+        if recipient_class == CLASS_USER:
+            conversation = conversation_key(sender, recipient)
+            if conversation:
+                keys.append((KIND_CONVERSATION, CLASS_USER, conversation))
+
+        return keys
+
+    async def update(self, db, gamespace, deltas):
+        """
+        Applies a dict of (kind, class, key) -> delta to the counters in a single statement
+        """
+
+        deltas = {
+            key: delta
+            for key, delta in deltas.items()
+            if delta
+        }
+
+        if not deltas:
+            return
+
+        values = []
+        data = []
+
+        for (kind, counter_class, counter_key), delta in deltas.items():
+            values.append("(%s, %s, %s, %s, %s)")
+            data.extend([gamespace, kind, counter_class, counter_key, delta])
+
+        await db.execute(
+            """
+                INSERT INTO `message_counters`
+                (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`, `counter_value`)
+                VALUES {0}
+                ON DUPLICATE KEY UPDATE `counter_value`=`counter_value` + VALUES(`counter_value`);
+            """.format(", ".join(values)), *data)
+
+    async def message_added(self, db, gamespace, sender, recipient_class, recipient, amount=1):
+        await self.update(db, gamespace, {
+            key: amount
+            for key in MessageCounters.message_keys(sender, recipient_class, recipient)
+        })
+
+    async def messages_removed(self, db, gamespace, messages):
+        """
+        :param messages: a list of (sender, recipient_class, recipient) tuples of messages being removed
+        """
+        deltas = {}
+
+        for sender, recipient_class, recipient in messages:
+            for key in MessageCounters.message_keys(sender, recipient_class, recipient):
+                deltas[key] = deltas.get(key, 0) - 1
+
+        await self.update(db, gamespace, deltas)
+
+    async def inbox_added(self, db, gamespace, accounts, amount=1):
+        await self.update(db, gamespace, {
+            (KIND_ACCOUNT, CLASS_USER, str(account)): amount
+            for account in accounts
+        })
+
+    async def inbox_group_added(self, db, condition, *args):
+        """
+        Increments account counters of every group participant matching the condition,
+            see MessagesHistoryModel.__inbox_fan_out__
+        """
+        await db.execute(
+            """
+                INSERT INTO `message_counters`
+                (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`, `counter_value`)
+                SELECT `p`.`gamespace_id`, %s, %s, `p`.`participation_account`, 1
+                FROM `groups` AS `g`
+                    INNER JOIN `group_participants` AS `p`
+                    ON `p`.`gamespace_id`=`g`.`gamespace_id` AND `p`.`group_id`=`g`.`group_id`
+                WHERE {0}
+                ON DUPLICATE KEY UPDATE `counter_value`=`counter_value` + VALUES(`counter_value`);
+            """.format(condition), KIND_ACCOUNT, CLASS_USER, *args)
+
+    async def inbox_removed(self, db, condition, *args, table="messages"):
+        """
+        Decrements account counters by the number of inbox entries (`i`) of messages (`m`)
+            matching the condition, should be called before those entries are actually deleted
+        """
+        await db.execute(
+            """
+                UPDATE `message_counters` AS `c`
+                INNER JOIN (
+                    SELECT `i`.`gamespace_id`, `i`.`account_id`, COUNT(*) AS `removed`
+                    FROM `account_inbox` AS `i`
+                        INNER JOIN `{0}` AS `m` ON `m`.`message_id`=`i`.`message_id`
+                    WHERE {1}
+                    GROUP BY `i`.`gamespace_id`, `i`.`account_id`
+                ) AS `r`
+                ON `c`.`gamespace_id`=`r`.`gamespace_id` AND `c`.`counter_kind`=%s AND `c`.`counter_class`=%s
+                    AND `c`.`counter_key`=CAST(`r`.`account_id` AS CHAR)
+                SET `c`.`counter_value`=`c`.`counter_value` - `r`.`removed`;
+            """.format(table, condition), *(args + (KIND_ACCOUNT, CLASS_USER)))
+
+    async def count_range(self, db, after, last, table="messages"):
+        """
+        Adds messages of a table with ids in (after, last] to recipient, sender and conversation counters,
+            only meant to fill up counters of an existing history, see MessagesHistoryModel.backfill_counters_stages
+        """
+        await db.execute(
+            """
+                INSERT INTO `message_counters`
+                (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`, `counter_value`)
+                SELECT `gamespace_id`, %s, `message_recipient_class`, `message_recipient`, COUNT(*)
+                FROM `{0}`
+                WHERE `message_id`>%s AND `message_id`<=%s
+                GROUP BY `gamespace_id`, `message_recipient_class`, `message_recipient`
+                ON DUPLICATE KEY UPDATE `counter_value`=`counter_value` + VALUES(`counter_value`);
+            """.format(table), KIND_RECIPIENT, after, last)
+
+        await db.execute(
+            """
+                INSERT INTO `message_counters`
+                (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`, `counter_value`)
+                SELECT `gamespace_id`, %s, %s, `message_sender`, COUNT(*)
+                FROM `{0}`
+                WHERE `message_id`>%s AND `message_id`<=%s
+                GROUP BY `gamespace_id`, `message_sender`
+                ON DUPLICATE KEY UPDATE `counter_value`=`counter_value` + VALUES(`counter_value`);
+            """.format(table), KIND_SENDER, CLASS_USER, after, last)
+
+        # same as conversation_key, `message_conversation` could be not filled up yet
+        await db.execute(
+            """
+                INSERT INTO `message_counters`
+                (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`, `counter_value`)
+                SELECT `gamespace_id`, %s, %s, CONCAT(
+                    LEAST(`message_sender`, CAST(`message_recipient` AS UNSIGNED)), ':',
+                    GREATEST(`message_sender`, CAST(`message_recipient` AS UNSIGNED))) AS `conversation`, COUNT(*)
+                FROM `{0}`
+                WHERE `message_id`>%s AND `message_id`<=%s AND `message_recipient_class`=%s
+                    AND `message_recipient` REGEXP '^[0-9]+$'
+                GROUP BY `gamespace_id`, `conversation`
+                ON DUPLICATE KEY UPDATE `counter_value`=`counter_value` + VALUES(`counter_value`);
+            """.format(table), KIND_CONVERSATION, CLASS_USER, after, last, CLASS_USER)
+
+    async def count_inbox_range(self, db, after, last):
+        """
+        Adds inbox entries of messages with ids in (after, last] to account counters,
+            only meant to fill up an inbox of an existing history, see MessagesHistoryModel.backfill_inbox_stages
+        """
+        await db.execute(
+            """
+                INSERT INTO `message_counters`
+                (`gamespace_id`, `counter_kind`, `counter_class`, `counter_key`, `counter_value`)
+                SELECT `gamespace_id`, %s, %s, `account_id`, COUNT(*)
+                FROM `account_inbox`
+                WHERE `message_id`>%s AND `message_id`<=%s
+                GROUP BY `gamespace_id`, `account_id`
+                ON DUPLICATE KEY UPDATE `counter_value`=`counter_value` + VALUES(`counter_value`);
+            """, KIND_ACCOUNT, CLASS_USER, after, last)
+
+    async def drop_recipient(self, db, gamespace, recipient_class, recipient):
+        await db.execute(
+            """
+                DELETE FROM `message_counters`
+                WHERE `gamespace_id`=%s AND `counter_kind`=%s AND `counter_class`=%s AND `counter_key`=%s;
+            """, gamespace, KIND_RECIPIENT, recipient_class, recipient)
+
+    async def drop_recipient_like(self, db, gamespace, recipient_class, recipient_like):
+        await db.execute(
+            """
+                DELETE FROM `message_counters`
+                WHERE `gamespace_id`=%s AND `counter_kind`=%s AND `counter_class`=%s AND `counter_key` LIKE %s;
+            """, gamespace, KIND_RECIPIENT, recipient_class, recipient_like)
+
+    async def accounts_deleted(self, db, gamespace, accounts, gamespace_only):
+        keys = [str(account) for account in accounts]
+
+        if gamespace_only:
+            await db.execute(
+                """
+                    DELETE FROM `message_counters`
+                    WHERE `gamespace_id`=%s AND `counter_kind` IN %s AND `counter_class`=%s
+                        AND `counter_key` IN %s;
+                """, gamespace, [KIND_RECIPIENT, KIND_SENDER, KIND_ACCOUNT], CLASS_USER, keys)
+            await db.execute(
+                """
+                    DELETE FROM `message_counters`
+                    WHERE `gamespace_id`=%s AND `counter_kind`=%s AND (
+                        SUBSTRING_INDEX(`counter_key`, ':', 1) IN %s OR
+                        SUBSTRING_INDEX(`counter_key`, ':', -1) IN %s);
+                """, gamespace, KIND_CONVERSATION, keys, keys)
+        else:
+            await db.execute(
+                """
+                    DELETE FROM `message_counters`
+                    WHERE `counter_kind` IN %s AND `counter_class`=%s AND `counter_key` IN %s;
+                """, [KIND_RECIPIENT, KIND_SENDER, KIND_ACCOUNT], CLASS_USER, keys)
+            await db.execute(
+                """
+                    DELETE FROM `message_counters`
+                    WHERE `counter_kind`=%s AND (
+                        SUBSTRING_INDEX(`counter_key`, ':', 1) IN %s OR
+                        SUBSTRING_INDEX(`counter_key`, ':', -1) IN %s);
+                """, KIND_CONVERSATION, keys, keys)
+
+    async def get(self, gamespace, kind, counter_class, counter_key, db=None):
+        try:
+            counter = await (db or self.shards.gamespace_db(gamespace)).get(
+                MessageCounters.COUNTER_QUERY, gamespace, kind, counter_class, counter_key)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to get a message counter: " + e.args[1])
+
+        if not counter:
+            return 0
+
+        return max(counter["counter_value"], 0)
+
+    async def count_rows(self, query, *args, db):
+        """
+        Counts rows exactly. The query is expected to return a single `count` column.
+        """
+        try:
+            result = await db.get(query, *args)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to count messages: " + e.args[1])
+
+        if not result:
+            return 0
+
+        return result["count"]
+
+    async def estimate_rows(self, query, *args, db):
+        """
+        Estimates how many rows a SELECT query would examine, using the query plan only
+        """
+        try:
+            plan = await db.query("EXPLAIN " + query, *args)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to estimate messages count: " + e.args[1])
+
+        if not plan:
+            return 0
+
+        return int(plan[0].get("rows") or 0)
+
+    async def count(self, cache_key, mode=None, exact=None, approximate=None):
+        """
+        Resolves a count according to the count mode.
+
+        :param cache_key: a tuple identifying the count being made
+        :param mode: a count mode requested, see resolve_mode
+        :param exact: a coroutine function returning the exact count
+        :param approximate: a coroutine function returning the approximate count, the exact one is used if omitted
+        :return: the count, or None if counts are omitted
+        """
+
+        mode = self.resolve_mode(mode)
+
+        if mode == COUNT_NONE:
+            return None
+
+        if mode == COUNT_APPROXIMATE and approximate is not None:
+            method = approximate
+        else:
+            method = exact
+
+        key = (mode,) + tuple(cache_key)
+        cached = self.cache.get(key)
+
+        if cached is not None:
+            return cached
+
+        result = await method()
+        self.cache.set(key, result)
+        return result
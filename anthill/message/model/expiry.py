@@ -0,0 +1,97 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.database import DatabaseError
+
+from . import MessageError
+
+import datetime
+import logging
+
+
+class MessageExpirySweeper(object):
+    """
+    Deletes messages past their time to live (see `message_expires`).
+
+    Expired messages are skipped by the drain and by message lists right away, the sweeper only
+        reclaims them: every `interval` seconds it walks the `expires` index of every shard from the
+        oldest expiry on, deleting up to `batch_size` messages per short transaction, `max_batches` at most
+        per shard and run, so a burst of expiring messages is spread over several runs. One process sweeps
+        a shard at a time. Gamespaces being moved between shards are left alone.
+    """
+
+    LOCK_NAME = "message_expiry"
+
+    def __init__(self, history, interval=5, batch_size=500, max_batches=100):
+        self.history = history
+        self.interval = interval
+        self.batch_size = max(batch_size, 1)
+        self.max_batches = max(max_batches, 1)
+
+        self.sweep_callback = None
+        self.sweeping = False
+
+    def start(self):
+        if self.interval:
+            self.sweep_callback = PeriodicCallback(self.__sweep__, self.interval * 1000)
+            self.sweep_callback.start()
+
+    def stop(self):
+        if self.sweep_callback:
+            self.sweep_callback.stop()
+            self.sweep_callback = None
+
+    def __sweep__(self):
+        IOLoop.current().spawn_callback(self.sweep)
+
+    async def sweep(self):
+        if self.sweeping:
+            return
+
+        self.sweeping = True
+
+        try:
+            for index, shard_db in enumerate(self.history.shards.all()):
+                await self.sweep_shard(index, shard_db)
+        finally:
+            self.sweeping = False
+
+    async def sweep_shard(self, index, shard_db):
+        # shards could be databases of the same server, so every shard has a lock of its own
+        lock_name = "{0}_{1}".format(MessageExpirySweeper.LOCK_NAME, index) if index else MessageExpirySweeper.LOCK_NAME
+
+        tables = ["messages", "messages_archive"] if self.history.archive_days else ["messages"]
+        moving = self.history.shards.list_moving()
+        now = datetime.datetime.utcnow()
+        deleted = 0
+
+        try:
+            async with shard_db.acquire() as db:
+                locked = await db.get(
+                    """
+                        SELECT GET_LOCK(%s, 0) AS `locked`;
+                    """, lock_name)
+
+                if not locked or not locked["locked"]:
+                    return
+
+                try:
+                    for table in tables:
+                        for batch in range(0, self.max_batches):
+                            swept = await self.history.sweep_expired_messages(
+                                shard_db, now, moving, limit=self.batch_size, table=table)
+                            deleted += swept
+                            if swept < self.batch_size:
+                                break
+                finally:
+                    await db.get(
+                        """
+                            SELECT RELEASE_LOCK(%s);
+                        """, lock_name)
+        except MessageError as e:
+            logging.error("Failed to sweep expired messages of shard {0}: {1}".format(index, e.message))
+        except DatabaseError as e:
+            logging.error("Failed to sweep expired messages of shard {0}: {1}".format(index, e.args[1]))
+
+        if deleted:
+            logging.info("Swept {0} expired messages of shard {1}".format(deleted, index))
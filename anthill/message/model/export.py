@@ -0,0 +1,316 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.common.database import DatabaseError
+
+from . import MessageError, MessageFlags, CLASS_USER
+from . counters import conversation_key
+from . compression import PayloadCompression
+
+import datetime
+import tempfile
+import gzip
+import ujson
+import os
+
+
+class MessagesExport(object):
+    """
+    Exports message history of a whole gamespace, or of a single account, into gzipped NDJSON,
+        and imports it back.
+
+    An export is a header line followed by one line per message, then one line per read position.
+        Rows are read in id order a batch at a time (each batch continues after the last id of the previous
+        one), and written straight into the gzip stream, so memory use does not depend on the history size.
+        Compression and file I/O run on an executor a batch (or a chunk of lines) at a time, off the IOLoop.
+
+    Import goes the other way with multi-row inserts, see MessagesHistoryModel.add_messages_bulk.
+        Messages keep their uuids, so importing the same file twice is harmless, but get new ids.
+        Inboxes, counters and conversation summaries of imported messages are filled up the same way
+        they're for new messages.
+    """
+
+    VERSION = 1
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    KIND_HEADER = "export"
+    KIND_MESSAGE = "message"
+    KIND_LAST_READ = "last_read"
+
+    # a size hint of lines read from an export at once
+    READ_CHUNK = 1024 * 1024
+
+    def __init__(self, history, path=None, batch_size=500):
+        self.shards = history.shards
+        self.history = history
+        self.path = path or tempfile.gettempdir()
+        self.batch_size = max(batch_size, 1)
+
+    @staticmethod
+    def __line__(item):
+        return ujson.dumps(item).encode("utf-8") + b"\n"
+
+    @staticmethod
+    async def __write__(stream, lines):
+        await IOLoop.current().run_in_executor(None, stream.write, b"".join(lines))
+
+    @staticmethod
+    async def __lines__(stream):
+        """
+        Yields lines of a stream, reading them on an executor a chunk at a time
+        """
+
+        while True:
+            lines = await IOLoop.current().run_in_executor(None, stream.readlines, MessagesExport.READ_CHUNK)
+            if not lines:
+                return
+
+            for line in lines:
+                yield line
+
+    async def __messages__(self, gamespace, account_id, table):
+        """
+        Yields batches of messages of a gamespace, or the ones in the inbox of an account, in id order
+        """
+
+        last_message_id = 0
+        db = self.shards.gamespace_db(gamespace)
+
+        while True:
+            if account_id is None:
+                messages = await db.query(
+                    """
+                        SELECT *
+                        FROM `{0}`
+                        WHERE `gamespace_id`=%s AND `message_id`>%s
+                        ORDER BY `message_id` ASC
+                        LIMIT %s;
+                    """.format(table), gamespace, last_message_id, self.batch_size)
+            else:
+                messages = await db.query(
+                    """
+                        SELECT `m`.*
+                        FROM `account_inbox` AS `i`
+                            INNER JOIN `{0}` AS `m` ON `m`.`message_id`=`i`.`message_id`
+                        WHERE `i`.`gamespace_id`=%s AND `i`.`account_id`=%s AND `i`.`message_id`>%s
+                        ORDER BY `i`.`message_id` ASC
+                        LIMIT %s;
+                    """.format(table), gamespace, account_id, last_message_id, self.batch_size)
+
+            if not messages:
+                return
+
+            yield messages
+
+            if len(messages) < self.batch_size:
+                return
+
+            last_message_id = messages[-1]["message_id"]
+
+    async def __last_read__(self, gamespace, account_id):
+        """
+        Yields batches of read positions of a gamespace, or of an account, in key order
+        """
+
+        last_key = (0, "", "")
+        db = self.shards.gamespace_db(gamespace)
+
+        while True:
+            conditions = ["`gamespace_id`=%s"]
+            args = [gamespace]
+
+            if account_id is not None:
+                conditions.append("`account_id`=%s")
+                args.append(account_id)
+
+            positions = await db.query(
+                """
+                    SELECT *
+                    FROM `last_read_message`
+                    WHERE {0} AND (`account_id`, `message_recipient_class`, `message_recipient`) > (%s, %s, %s)
+                    ORDER BY `account_id`, `message_recipient_class`, `message_recipient`
+                    LIMIT %s;
+                """.format(" AND ".join(conditions)), *args, *last_key, self.batch_size)
+
+            if not positions:
+                return
+
+            yield positions
+
+            if len(positions) < self.batch_size:
+                return
+
+            last = positions[-1]
+            last_key = (last["account_id"], last["message_recipient_class"], last["message_recipient"])
+
+    async def export(self, gamespace, stream, account_id=None):
+        """
+        Writes the history into a binary stream, returns the number of messages exported
+
+        :param account_id: an account to export history of, or None to export the whole gamespace
+        """
+
+        exported = 0
+        f = gzip.GzipFile(fileobj=stream, mode="wb")
+
+        try:
+            await MessagesExport.__write__(f, [MessagesExport.__line__({
+                "kind": MessagesExport.KIND_HEADER,
+                "version": MessagesExport.VERSION,
+                "gamespace": gamespace,
+                "account": account_id
+            })])
+
+            try:
+                for table in ["messages", "messages_archive"]:
+                    async for messages in self.__messages__(gamespace, account_id, table):
+                        lines = []
+
+                        for message in messages:
+                            payload = ujson.loads(PayloadCompression.payload_json(message))
+
+                            item = {
+                                "kind": MessagesExport.KIND_MESSAGE,
+                                "uuid": message["message_uuid"],
+                                "sender": message["message_sender"],
+                                "recipient_class": message["message_recipient_class"],
+                                "recipient": message["message_recipient"],
+                                "time": message["message_time"].strftime(MessagesExport.TIME_FORMAT),
+                                "type": message["message_type"],
+                                "payload": payload,
+                                "delivered": bool(message["message_delivered"]),
+                                "flags": MessageFlags((message["message_flags"] or "").lower().split(",")).as_list()
+                            }
+
+                            if message.get("message_expires"):
+                                item["expires"] = message["message_expires"].strftime(MessagesExport.TIME_FORMAT)
+
+                            lines.append(MessagesExport.__line__(item))
+
+                        await MessagesExport.__write__(f, lines)
+                        exported += len(messages)
+
+                async for positions in self.__last_read__(gamespace, account_id):
+                    await MessagesExport.__write__(f, [
+                        MessagesExport.__line__({
+                            "kind": MessagesExport.KIND_LAST_READ,
+                            "account": position["account_id"],
+                            "recipient_class": position["message_recipient_class"],
+                            "recipient": position["message_recipient"],
+                            "time": position["last_message_time"].strftime(MessagesExport.TIME_FORMAT),
+                            "uuid": position["last_message_uuid"]
+                        })
+                        for position in positions
+                    ])
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to export messages: " + e.args[1])
+        finally:
+            # flushes the rest of the compressed stream and the gzip trailer
+            await IOLoop.current().run_in_executor(None, f.close)
+
+        return exported
+
+    async def export_file(self, gamespace, account_id=None):
+        """
+        Exports the history into a new file in the export directory, returns a (file path, messages exported) tuple
+        """
+
+        name = "messages-{0}{1}-{2}.ndjson.gz".format(
+            gamespace, "-{0}".format(account_id) if account_id is not None else "",
+            datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+
+        path = os.path.join(self.path, name)
+
+        try:
+            f = await IOLoop.current().run_in_executor(None, open, path, "wb")
+
+            try:
+                exported = await self.export(gamespace, f, account_id=account_id)
+            finally:
+                await IOLoop.current().run_in_executor(None, f.close)
+        except OSError as e:
+            raise MessageError(500, "Failed to write an export: " + str(e))
+
+        return path, exported
+
+    async def import_(self, gamespace, stream):
+        """
+        Reads an export from a binary stream into a gamespace (regardless of the gamespace it has been
+            exported from). Returns a (messages imported, read positions imported) tuple.
+        """
+
+        messages = []
+        positions = []
+
+        imported_messages = 0
+        imported_positions = 0
+
+        try:
+            with gzip.GzipFile(fileobj=stream, mode="rb") as f:
+                header = None
+
+                async for line in MessagesExport.__lines__(f):
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    try:
+                        item = ujson.loads(line)
+                        kind = item["kind"]
+
+                        if header is None:
+                            if kind != MessagesExport.KIND_HEADER or item.get("version") != MessagesExport.VERSION:
+                                raise MessageError(400, "Not a message history export")
+                            header = item
+                            continue
+
+                        if kind == MessagesExport.KIND_MESSAGE:
+                            recipient_class = str(item["recipient_class"])
+                            recipient = str(item["recipient"])
+                            sender = int(item["sender"])
+
+                            messages.append({
+                                "message_uuid": str(item["uuid"]),
+                                "message_sender": sender,
+                                "message_recipient_class": recipient_class,
+                                "message_recipient": recipient,
+                                "message_time": datetime.datetime.strptime(item["time"], MessagesExport.TIME_FORMAT),
+                                "message_type": str(item["type"]),
+                                "message_payload": ujson.dumps(item["payload"]),
+                                "message_delivered": int(bool(item.get("delivered", True))),
+                                "message_flags": MessageFlags(item.get("flags") or []).dump(),
+                                "message_conversation": conversation_key(
+                                    sender, recipient) if recipient_class == CLASS_USER else None,
+                                "message_expires": datetime.datetime.strptime(
+                                    item["expires"], MessagesExport.TIME_FORMAT) if item.get("expires") else None
+                            })
+                        elif kind == MessagesExport.KIND_LAST_READ:
+                            positions.append((
+                                gamespace, int(item["account"]), str(item["recipient_class"]), str(item["recipient"]),
+                                datetime.datetime.strptime(item["time"], MessagesExport.TIME_FORMAT),
+                                str(item["uuid"])))
+                    except (KeyError, ValueError, TypeError):
+                        raise MessageError(400, "Corrupted export line: " + line.decode("utf-8", "replace")[:256])
+
+                    if len(messages) >= self.batch_size:
+                        imported_messages += await self.history.add_messages_bulk(gamespace, messages)
+                        messages = []
+
+                    if len(positions) >= self.batch_size:
+                        await self.history.read_positions.write(positions)
+                        imported_positions += len(positions)
+                        positions = []
+
+                if header is None:
+                    raise MessageError(400, "Export is empty")
+        except (OSError, EOFError):
+            raise MessageError(400, "Export is not a valid gzip file")
+
+        if messages:
+            imported_messages += await self.history.add_messages_bulk(gamespace, messages)
+
+        if positions:
+            await self.history.read_positions.write(positions)
+            imported_positions += len(positions)
+
+        return imported_messages, imported_positions
@@ -6,6 +6,11 @@ from anthill.common.options import options
 from anthill.common.validate import validate
 
 from . import MessageError, MessageFlags
+from . membership import GroupMembershipCache
+
+from collections import Counter
+
+import logging
 
 
 class GroupAdapter(object):
@@ -44,13 +49,67 @@ class GroupsModel(Model):
     MESSAGE_PLAYER_JOINED = "player_joined"
     MESSAGE_PLAYER_LEFT = "player_left"
 
+    GROUP_QUERY = """
+        SELECT *
+        FROM `groups`
+        WHERE `gamespace_id`=%s AND `group_class`=%s AND `group_key`=%s;
+    """
+
+    PARTICIPANTS_QUERY = """
+        SELECT *
+        FROM `group_participants`
+        WHERE `group_id`=%s AND `gamespace_id`=%s;
+    """
+
+    PARTICIPATIONS_QUERY = """
+        SELECT *
+        FROM `group_participants`
+        WHERE `participation_account`=%s AND `gamespace_id`=%s;
+    """
+
     def __init__(self, db, app):
         self.db = db
-        self.cluster = Cluster(db, "group_clusters", "group_cluster_accounts")
+        self.shards = app.shards
+        # every shard keeps clusters of its own gamespaces
+        self.clusters = [
+            Cluster(shard_db, "group_clusters", "group_cluster_accounts")
+            for shard_db in self.shards.all()
+        ]
         self.cluster_size = options.group_cluster_size
         self.app = app
         self.history = app.history
         self.online = None
+        self.cache = GroupMembershipCache(app, max_size=options.group_cache_size, ttl=options.group_cache_ttl)
+        self.bulk_max_accounts = options.group_bulk_max_accounts
+
+    def gamespace_db(self, gamespace, write=False):
+        """
+        Returns a database a gamespace is stored on, see ShardRouter
+        """
+        try:
+            return self.shards.gamespace_db(gamespace, write=write)
+        except MessageError as e:
+            raise GroupError(e.code, e.message)
+
+    def read_db(self, gamespace, primary=False):
+        """
+        Returns a database for reads of a gamespace that tolerate a bit of staleness, see ReplicaRouter
+        """
+        return self.history.read_db(gamespace, primary)
+
+    def cluster(self, gamespace):
+        self.gamespace_db(gamespace, write=True)
+        return self.clusters[self.shards.index(gamespace)]
+
+    def __invalidate__(self, gamespace, groups=(), accounts=()):
+        """
+        Drops changed groups and participations of accounts from caches of every process, see GroupMembershipCache
+        """
+        self.cache.forget(gamespace, groups=groups, accounts=accounts)
+        self.app.message_queue.broadcast(self.cache.event(gamespace, groups=groups, accounts=accounts))
+
+    def event_received(self, event):
+        self.cache.event_received(event)
 
     def get_setup_tables(self):
         return ["groups", "group_participants", "group_clusters", "group_cluster_accounts"]
@@ -64,25 +123,28 @@ class GroupsModel(Model):
     async def accounts_deleted(self, gamespace, accounts, gamespace_only):
         try:
             if gamespace_only:
-                await self.db.execute(
+                await self.shards.gamespace_db(gamespace, write=True).execute(
                     """
                         DELETE FROM `group_participants`
                         WHERE `gamespace_id`=%s AND `participation_account` IN %s;
                     """, gamespace, accounts)
             else:
-                await self.db.execute(
-                    """
-                        DELETE FROM `group_participants`
-                        WHERE `participation_account` IN %s;
-                    """, accounts)
+                for shard_db in self.shards.all():
+                    await shard_db.execute(
+                        """
+                            DELETE FROM `group_participants`
+                            WHERE `participation_account` IN %s;
+                        """, accounts)
         except DatabaseError as e:
             raise MessageError(500, "Failed to delete messages: " + e.args[1])
 
+        self.__invalidate__(gamespace if gamespace_only else None, accounts=accounts)
+
     @validate(gamespace="int", group_class="str", key="str", clustered="bool", cluster_size="int")
     async def new_group(self, gamespace, group_class, key, clustered=False, cluster_size=1000):
 
         try:
-            group_id = await self.db.insert(
+            group_id = await self.gamespace_db(gamespace, write=True).insert(
                 """
                     INSERT INTO `groups`
                     (`gamespace_id`, `group_class`, `group_key`,
@@ -98,7 +160,7 @@ class GroupsModel(Model):
 
     async def get_group(self, gamespace, group_id):
         try:
-            message = await self.db.get(
+            message = await self.gamespace_db(gamespace).get(
                 """
                     SELECT *
                     FROM `groups`
@@ -114,51 +176,66 @@ class GroupsModel(Model):
 
     @validate(gamespace="int", group_class="str", key="str")
     async def find_group(self, gamespace, group_class, key):
+        cached = self.cache.get_group(gamespace, group_class, key)
+        if cached is not None:
+            return GroupAdapter(cached)
+
         try:
-            group = await self.db.get(
-                """
-                    SELECT *
-                    FROM `groups`
-                    WHERE `gamespace_id`=%s AND `group_class`=%s AND `group_key`=%s;
-                """, gamespace, group_class, key)
+            group = await self.gamespace_db(gamespace).get(GroupsModel.GROUP_QUERY, gamespace, group_class, key)
         except DatabaseError as e:
             raise GroupError(500, "Failed to find a group: " + e.args[1])
 
         if not group:
             raise GroupNotFound()
 
+        group = dict(group)
+        self.cache.put_group(gamespace, group)
         return GroupAdapter(group)
 
     @validate(gamespace="int", group_class="str", key="str", account_id="int")
-    async def find_group_with_participation(self, gamespace, group_class, key, account_id):
-        try:
-            group = await self.db.get(
-                """
-                    SELECT *
-                    FROM `groups`
-                        LEFT JOIN `group_participants`
-                            ON `groups`.`group_id` = `group_participants`.`group_id`
-                            AND `groups`.`gamespace_id` = `group_participants`.`gamespace_id`
-                            AND `group_participants`.`participation_account`=%s
-
-                    WHERE `groups`.`gamespace_id`=%s AND `groups`.`group_class`=%s
-                        AND `groups`.`group_key`=%s;
-                """, account_id, gamespace, group_class, key)
-        except DatabaseError as e:
-            raise GroupError(500, "Failed to find a group: " + e.args[1])
-
-        if not group:
-            raise GroupNotFound()
-
-        if not group["participation_id"]:
-            raise GroupParticipantNotFound()
-
-        return GroupAndParticipationAdapter(group)
+    async def find_group_with_participation(self, gamespace, group_class, key, account_id, primary=False):
+        """
+        Looks up a group along with a participation of the account in it, both served from
+            GroupMembershipCache when possible
+        """
+        group = await self.find_group(gamespace, group_class, key)
+
+        participations = None if primary else self.cache.get_participations(gamespace, account_id)
+        cached = participations is not None
+
+        while True:
+            if participations is None:
+                participations = await self.__list_participations__(gamespace, account_id)
+
+            for participation in participations:
+                if str(participation["group_id"]) == str(group.group_id):
+                    data = dict(participation)
+                    data.update(group_id=group.group_id, group_class=group.group_class, group_key=group.key,
+                                group_clustered=int(group.clustered), group_cluster_size=group.cluster_size)
+                    return GroupAndParticipationAdapter(data)
+
+            if not cached:
+                raise GroupParticipantNotFound()
+
+            # the group could have just been joined by another process, so a miss is only trusted from the primary
+            participations, cached = None, False
+
+    def query_plans(self):
+        """
+        Returns queries on the hot path as they're run, see MigrationsModel.check_query_plans
+        """
+        return {
+            "group": (GroupsModel.GROUP_QUERY, (1, "group", ""), {"groups": ("group_unique",)}),
+            "group participants": (
+                GroupsModel.PARTICIPANTS_QUERY, (0, 1), {"group_participants": ("gamespace_id", "group_id")}),
+            "participations by account": (
+                GroupsModel.PARTICIPATIONS_QUERY, (0, 1), {"group_participants": ("account",)}),
+        }
 
     @validate(gamespace="int", group_class="str")
     async def list_groups(self, gamespace, group_class):
         try:
-            groups = await self.db.query(
+            groups = await self.gamespace_db(gamespace).query(
                 """
                     SELECT *
                     FROM `groups`
@@ -175,13 +252,12 @@ class GroupsModel(Model):
         group_id = group.group_id
 
         try:
-            await self.history.delete_messages_like(
-                gamespace_id, group.group_class, group.key + "-%")
+            await self.history.purge_group_messages(gamespace_id, group.group_class, group.key)
         except MessageError as e:
             raise GroupError(500, "Failed to delete group's messages: " + e.message)
 
         try:
-            await self.db.execute(
+            await self.gamespace_db(gamespace_id, write=True).execute(
                 """
                     DELETE FROM `groups`
                     WHERE `group_id`=%s AND `gamespace_id`=%s;
@@ -189,10 +265,17 @@ class GroupsModel(Model):
         except DatabaseError as e:
             raise GroupError(500, "Failed to delete a group: " + e.args[1])
 
+        self.__invalidate__(gamespace_id, groups=[(group.group_class, group.key)])
+
     @validate(gamespace="int", group_id="int", group_class="str", key="str", cluster_size="int")
     async def update_group(self, gamespace, group_id, group_class, key, cluster_size):
         try:
-            await self.db.execute(
+            previous = await self.get_group(gamespace, group_id)
+        except GroupNotFound:
+            return
+
+        try:
+            await self.gamespace_db(gamespace, write=True).execute(
                 """
                     UPDATE `groups`
                     SET `group_class`=%s, `group_key`=%s, `group_cluster_size`=%s
@@ -201,20 +284,22 @@ class GroupsModel(Model):
         except DatabaseError as e:
             raise GroupError(500, "Failed to update a group: " + e.args[1])
 
+        self.__invalidate__(gamespace, groups=[(previous.group_class, previous.key), (group_class, key)])
+
     @validate(gamespace="int", group=GroupAdapter, account="int", role="str", notify="json_dict", authoritative="bool")
     async def join_group(self, gamespace, group, account, role, notify=None, authoritative=False):
 
         group_id = group.group_id
 
         if group.clustered:
-            cluster_id = await self.cluster.get_cluster(
+            cluster_id = await self.cluster(gamespace).get_cluster(
                 gamespace, account, group_id,
                 cluster_size=group.cluster_size, auto_create=True)
         else:
             cluster_id = 0
 
         try:
-            participation_id = await self.db.execute(
+            participation_id = await self.gamespace_db(gamespace, write=True).execute(
                 """
                     INSERT INTO `group_participants`
                     (gamespace_id, `group_id`, `group_class`, `group_key`,
@@ -226,6 +311,8 @@ class GroupsModel(Model):
         except DatabaseError as e:
             raise GroupError(500, "Failed to join a group: " + e.args[1])
 
+        self.__invalidate__(gamespace, accounts=[account])
+
         participation = GroupParticipationAdapter({
             "participation_id": participation_id,
             "group_id": group_id,
@@ -236,6 +323,12 @@ class GroupsModel(Model):
             "role": role
         })
 
+        try:
+            await self.history.inbox_group_joined(
+                gamespace, account, group.group_class, participation.calculate_recipient())
+        except MessageError as e:
+            raise GroupError(500, "Failed to fill up account inbox: " + e.message)
+
         await self.online.bind_account_to_group(account, participation)
 
         if notify:
@@ -249,7 +342,7 @@ class GroupsModel(Model):
     @validate(gamespace="int", participation_id="int")
     async def get_group_participation(self, gamespace, participation_id):
         try:
-            participant = await self.db.get(
+            participant = await self.gamespace_db(gamespace).get(
                 """
                     SELECT *
                     FROM `group_participants`
@@ -266,7 +359,12 @@ class GroupsModel(Model):
     @validate(gamespace="int", participation_id="int", role="str")
     async def updated_group_participation(self, gamespace, participation_id, role):
         try:
-            await self.db.execute(
+            participation = await self.get_group_participation(gamespace, participation_id)
+        except GroupParticipantNotFound:
+            return
+
+        try:
+            await self.gamespace_db(gamespace, write=True).execute(
                 """
                     UPDATE `group_participants`
                     SET `participation_role`=%s
@@ -275,13 +373,15 @@ class GroupsModel(Model):
         except DatabaseError as e:
             raise GroupError(500, "Failed to update a group participation: " + e.args[1])
 
+        self.__invalidate__(gamespace, accounts=[participation.account])
+
     @validate(gamespace="int", group=GroupAdapter, account="int", notify="json_dict", authoritative="bool")
     async def leave_group(self, gamespace, group, account, notify=None, authoritative=False):
 
         participation = await self.find_group_participant(gamespace, group.group_id, account)
 
         try:
-            await self.db.execute(
+            await self.gamespace_db(gamespace, write=True).execute(
                 """
                     DELETE FROM `group_participants`
                     WHERE `gamespace_id`=%s AND `participation_id`=%s;
@@ -289,9 +389,17 @@ class GroupsModel(Model):
         except DatabaseError as e:
             raise GroupError(500, "Failed to leave a group: " + e.args[1])
 
+        self.__invalidate__(gamespace, accounts=[account])
+
+        try:
+            await self.history.inbox_group_left(
+                gamespace, account, group.group_class, participation.calculate_recipient())
+        except MessageError as e:
+            raise GroupError(500, "Failed to clean up account inbox: " + e.message)
+
         if participation.cluster_id:
             try:
-                await self.cluster.leave_cluster(
+                await self.cluster(gamespace).leave_cluster(
                     gamespace, account, group.group_id)
             except ClusterError:
                 # well
@@ -303,10 +411,303 @@ class GroupsModel(Model):
                 GroupsModel.MESSAGE_PLAYER_LEFT, notify, MessageFlags(),
                 authoritative=authoritative)
 
+    async def __assign_clusters__(self, db, gamespace, group, accounts):
+        """
+        Same as Cluster.get_cluster, for a number of accounts at once: clusters with vacant places are filled up
+            first, then new clusters of group's cluster size are created for the rest.
+            Should be called within a transaction.
+
+        :return: a dict of account -> cluster ID
+        """
+
+        group_id = group.group_id
+
+        existing = await db.query(
+            """
+                SELECT `account_id`, `cluster_id`
+                FROM `group_cluster_accounts`
+                WHERE `gamespace_id`=%s AND `cluster_data`=%s AND `account_id` IN %s;
+            """, gamespace, group_id, accounts)
+
+        clusters = {
+            cluster["account_id"]: cluster["cluster_id"]
+            for cluster in existing
+        }
+
+        remaining = [account for account in accounts if account not in clusters]
+
+        if not remaining:
+            return clusters
+
+        joined = []
+
+        vacant = await db.query(
+            """
+                SELECT `cluster_id`, `cluster_size`
+                FROM `group_clusters`
+                WHERE `gamespace_id`=%s AND `cluster_size` > 0 AND `cluster_data`=%s
+                ORDER BY `cluster_id`
+                FOR UPDATE;
+            """, gamespace, group_id)
+
+        for cluster in vacant:
+            if not remaining:
+                break
+
+            cluster_id = cluster["cluster_id"]
+            taken, remaining = remaining[:cluster["cluster_size"]], remaining[cluster["cluster_size"]:]
+
+            await db.execute(
+                """
+                    UPDATE `group_clusters`
+                    SET `cluster_size`=%s
+                    WHERE `cluster_id`=%s;
+                """, cluster["cluster_size"] - len(taken), cluster_id)
+
+            joined.extend((account, cluster_id) for account in taken)
+
+        cluster_size = max(group.cluster_size, 1)
+
+        while remaining:
+            taken, remaining = remaining[:cluster_size], remaining[cluster_size:]
+
+            cluster_id = await db.insert(
+                """
+                    INSERT INTO `group_clusters`
+                    (`gamespace_id`, `cluster_size`, `cluster_data`)
+                    VALUES (%s, %s, %s);
+                """, gamespace, cluster_size - len(taken), group_id)
+
+            joined.extend((account, cluster_id) for account in taken)
+
+        await db.execute(
+            """
+                INSERT INTO `group_cluster_accounts`
+                (`gamespace_id`, `account_id`, `cluster_id`, `cluster_data`)
+                VALUES {0};
+            """.format(", ".join(["(%s, %s, %s, %s)"] * len(joined))),
+            *[arg for account, cluster_id in joined for arg in (gamespace, account, cluster_id, group_id)])
+
+        clusters.update(joined)
+        return clusters
+
+    async def __release_clusters__(self, db, gamespace, group, accounts):
+        """
+        Same as Cluster.leave_cluster, for a number of accounts at once, a vacant place is added for each.
+            Should be called within a transaction.
+        """
+
+        released = await db.query(
+            """
+                SELECT `c`.`cluster_id`
+                FROM `group_cluster_accounts` AS `a`
+                    INNER JOIN `group_clusters` AS `c`
+                    ON `c`.`gamespace_id`=`a`.`gamespace_id` AND `c`.`cluster_id`=`a`.`cluster_id`
+                WHERE `a`.`gamespace_id`=%s AND `a`.`cluster_data`=%s AND `a`.`account_id` IN %s
+                FOR UPDATE;
+            """, gamespace, group.group_id, accounts)
+
+        if not released:
+            return
+
+        await db.execute(
+            """
+                DELETE FROM `group_cluster_accounts`
+                WHERE `gamespace_id`=%s AND `cluster_data`=%s AND `account_id` IN %s;
+            """, gamespace, group.group_id, accounts)
+
+        vacant = Counter(cluster["cluster_id"] for cluster in released)
+
+        for cluster_id, places in vacant.items():
+            await db.execute(
+                """
+                    UPDATE `group_clusters`
+                    SET `cluster_size`=`cluster_size` + %s
+                    WHERE `gamespace_id`=%s AND `cluster_id`=%s;
+                """, places, gamespace, cluster_id)
+
+    async def __notify_participants__(self, gamespace, group, participations, message_type, notify, authoritative):
+        """
+        Sends a notification from each of participations to its group (cluster), all of them over a single
+            channel, see MessagesQueueModel.publish_messages
+        """
+
+        message_queue = self.app.message_queue
+        flags = MessageFlags()
+
+        if authoritative:
+            flags.set(MessageFlags.SERVER)
+
+        messages = [
+            message_queue.new_message(
+                gamespace, participation.account, group.group_class, participation.calculate_recipient(),
+                message_type, notify, flags)
+            for participation in participations
+        ]
+
+        confirmed = await message_queue.publish_messages(messages)
+        failed = len(confirmed) - sum(1 for c in confirmed if c)
+
+        if failed:
+            logging.error("Failed to notify about {0} group participants of group {1}".format(failed, group.group_id))
+
+    def __check_bulk__(self, accounts):
+        if not accounts:
+            raise GroupError(400, "No accounts")
+
+        if len(accounts) > self.bulk_max_accounts:
+            raise GroupError(400, "Too many accounts, {0} at most".format(self.bulk_max_accounts))
+
+    @validate(gamespace="int", group=GroupAdapter, accounts="json_list_of_ints", role="str",
+              notify="json_dict", authoritative="bool")
+    async def join_group_bulk(self, gamespace, group, accounts, role, notify=None, authoritative=False):
+        """
+        Same as join_group, for a number of accounts at once. Clusters are assigned and participations are inserted
+            within a single transaction, exchange bindings go over a single channel, and notifications are
+            published all together.
+
+        :return: a (list of new participations, list of accounts that have already joined the group) tuple
+        """
+
+        accounts = list(dict.fromkeys(accounts))
+        self.__check_bulk__(accounts)
+
+        group_id = group.group_id
+
+        try:
+            async with self.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+                try:
+                    existing = await db.query(
+                        """
+                            SELECT `participation_account`
+                            FROM `group_participants`
+                            WHERE `gamespace_id`=%s AND `group_id`=%s AND `participation_account` IN %s
+                            FOR UPDATE;
+                        """, gamespace, group_id, accounts)
+
+                    already_joined = set(participant["participation_account"] for participant in existing)
+                    joining = [account for account in accounts if account not in already_joined]
+
+                    if not joining:
+                        return [], accounts
+
+                    if group.clustered:
+                        clusters = await self.__assign_clusters__(db, gamespace, group, joining)
+                    else:
+                        clusters = {}
+
+                    await db.execute(
+                        """
+                            INSERT INTO `group_participants`
+                            (gamespace_id, `group_id`, `group_class`, `group_key`,
+                                `participation_account`, `participation_role`, `cluster_id`)
+                            VALUES {0};
+                        """.format(", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(joining))),
+                        *[arg for account in joining for arg in (
+                            gamespace, group_id, group.group_class, group.key,
+                            account, role, clusters.get(account, 0))])
+
+                    participants = await db.query(
+                        """
+                            SELECT *
+                            FROM `group_participants`
+                            WHERE `gamespace_id`=%s AND `group_id`=%s AND `participation_account` IN %s;
+                        """, gamespace, group_id, joining)
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to join a group: " + e.args[1])
+
+        self.__invalidate__(gamespace, accounts=joining)
+
+        participations = list(map(GroupParticipationAdapter, participants))
+
+        recipients = {}
+        for participation in participations:
+            recipients.setdefault(participation.calculate_recipient(), []).append(participation.account)
+
+        try:
+            for recipient, recipient_accounts in recipients.items():
+                await self.history.inbox_group_joined_bulk(
+                    gamespace, recipient_accounts, group.group_class, recipient)
+        except MessageError as e:
+            raise GroupError(500, "Failed to fill up account inbox: " + e.message)
+
+        await self.online.bind_accounts_to_group(participations)
+
+        if notify:
+            await self.__notify_participants__(
+                gamespace, group, participations, GroupsModel.MESSAGE_PLAYER_JOINED, notify, authoritative)
+
+        return participations, [account for account in accounts if account in already_joined]
+
+    @validate(gamespace="int", group=GroupAdapter, accounts="json_list_of_ints", notify="json_dict",
+              authoritative="bool")
+    async def leave_group_bulk(self, gamespace, group, accounts, notify=None, authoritative=False):
+        """
+        Same as leave_group, for a number of accounts at once, accounts that are not participants are ignored
+
+        :return: a list of participations that have been left
+        """
+
+        accounts = list(dict.fromkeys(accounts))
+        self.__check_bulk__(accounts)
+
+        try:
+            async with self.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+                try:
+                    participants = await db.query(
+                        """
+                            SELECT *
+                            FROM `group_participants`
+                            WHERE `gamespace_id`=%s AND `group_id`=%s AND `participation_account` IN %s
+                            FOR UPDATE;
+                        """, gamespace, group.group_id, accounts)
+
+                    if not participants:
+                        return []
+
+                    participations = list(map(GroupParticipationAdapter, participants))
+                    leaving = [participation.account for participation in participations]
+
+                    await db.execute(
+                        """
+                            DELETE FROM `group_participants`
+                            WHERE `gamespace_id`=%s AND `participation_id` IN %s;
+                        """, gamespace, [participation.participation_id for participation in participations])
+
+                    clustered = [participation.account for participation in participations if participation.cluster_id]
+
+                    if clustered:
+                        await self.__release_clusters__(db, gamespace, group, clustered)
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to leave a group: " + e.args[1])
+
+        self.__invalidate__(gamespace, accounts=leaving)
+
+        recipients = {}
+        for participation in participations:
+            recipients.setdefault(participation.calculate_recipient(), []).append(participation.account)
+
+        try:
+            for recipient, recipient_accounts in recipients.items():
+                await self.history.inbox_group_left_bulk(
+                    gamespace, recipient_accounts, group.group_class, recipient)
+        except MessageError as e:
+            raise GroupError(500, "Failed to clean up account inbox: " + e.message)
+
+        if notify:
+            await self.__notify_participants__(
+                gamespace, group, participations, GroupsModel.MESSAGE_PLAYER_LEFT, notify, authoritative)
+
+        return participations
+
     @validate(gamespace="int", group_id="int", account="int")
     async def find_group_participant(self, gamespace, group_id, account):
         try:
-            participant = await self.db.get(
+            participant = await self.gamespace_db(gamespace).get(
                 """
                     SELECT *
                     FROM `group_participants`
@@ -323,12 +724,8 @@ class GroupsModel(Model):
     @validate(gamespace="int", group_id="int")
     async def list_group_participants(self, gamespace, group_id):
         try:
-            participants = await self.db.query(
-                """
-                    SELECT *
-                    FROM `group_participants`
-                    WHERE `group_id`=%s AND `gamespace_id`=%s;
-                """, group_id, gamespace)
+            participants = await self.gamespace_db(gamespace).query(
+                GroupsModel.PARTICIPANTS_QUERY, group_id, gamespace)
         except DatabaseError as e:
             raise GroupError(500, "Failed to list group participants: " + e.args[1])
 
@@ -337,7 +734,7 @@ class GroupsModel(Model):
     @validate(gamespace="int", account_id="int")
     async def list_groups_account_participates(self, gamespace, account_id):
         try:
-            groups = await self.db.query(
+            groups = await self.gamespace_db(gamespace).query(
                 """
                     SELECT g.*, p.*
                     FROM `group_participants` AS p
@@ -350,19 +747,28 @@ class GroupsModel(Model):
 
         return list(map(GroupAndParticipationAdapter, groups))
 
-    @validate(gamespace="int", account_id="int")
-    async def list_participants_by_account(self, gamespace, account_id):
+    async def __list_participations__(self, gamespace, account_id):
+        """
+        Reads participation rows of an account from the primary, and caches them
+        """
         try:
-            participants = await self.db.query(
-                """
-                    SELECT *
-                    FROM `group_participants`
-                    WHERE `participation_account`=%s AND `gamespace_id`=%s;
-                """, account_id, gamespace)
+            participations = await self.gamespace_db(gamespace).query(
+                GroupsModel.PARTICIPATIONS_QUERY, account_id, gamespace)
         except DatabaseError as e:
             raise GroupError(500, "Failed to list group account participate: " + e.args[1])
 
-        return list(map(GroupParticipationAdapter, participants))
+        participations = [dict(participation) for participation in participations]
+        self.cache.put_participations(gamespace, account_id, participations)
+        return participations
+
+    @validate(gamespace="int", account_id="int")
+    async def list_participants_by_account(self, gamespace, account_id, primary=False):
+        participations = None if primary else self.cache.get_participations(gamespace, account_id)
+
+        if participations is None:
+            participations = await self.__list_participations__(gamespace, account_id)
+
+        return list(map(GroupParticipationAdapter, participations))
 
 
 class GroupNotFound(Exception):
@@ -1,12 +1,31 @@
 
+from tornado.gen import multi
+from tornado.ioloop import IOLoop
+
 from anthill.common.model import Model
 from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.validate import validate
 from anthill.common.profile import Profile, ProfileError
+from anthill.common.options import options
 
 from . import MessageError, MessageFlags, CLASS_USER
-
+from . counters import MessageCounters, KIND_RECIPIENT, KIND_CONVERSATION, KIND_ACCOUNT, conversation_key
+from . recent import RecentMessages
+from . lookup import MessageLookupCache
+from . read import ReadPositions
+from . unread import UnreadCounters
+from . summary import ConversationSummaries
+from . outbox import MessageOutbox
+from . spool import MessageSpool
+from . quota import MailboxQuotasModel
+from . expiry import MessageExpirySweeper
+from . compression import PayloadCompression
+from . queue import MessagesQueueModel
+from . payload import PayloadUpdate
+
+import logging
 import ujson
+import datetime
 
 
 class MessageQueryError(Exception):
@@ -33,7 +52,22 @@ class LastReadMessageAdapter(object):
         }
 
 
+# a payload that has not been decoded yet
+NOT_DECODED = object()
+
+
 class MessageAdapter(object):
+    """
+    A message row. Pages of messages are mostly passed through as they are, so the payload is only
+        decoded (and the flags parsed) once accessed, and dump_json splices the payload as it is stored
+        into the response without decoding it at all. A compressed payload (see PayloadCompression)
+        is only decompressed once accessed too.
+    """
+
+    __slots__ = ("message_id", "message_uuid", "recipient_class", "sender", "recipient", "time",
+                 "message_type", "delivered", "expires", "_payload", "_payload_json", "_packed", "_flags",
+                 "_flags_raw")
+
     def __init__(self, data):
         self.message_id = data.get("message_id")
         self.message_uuid = data.get("message_uuid")
@@ -42,14 +76,52 @@ class MessageAdapter(object):
         self.recipient = str(data.get("message_recipient"))
         self.time = data.get("message_time")
         self.message_type = data.get("message_type")
-        self.payload = data.get("message_payload")
-        if isinstance(self.payload, str):
-            self.payload = ujson.loads(self.payload)
         self.delivered = data.get("message_delivered")
+        self.expires = data.get("message_expires")
 
-        flags = data.get("message_flags", "").lower().split(",")
+        payload = data.get("message_payload")
+        self._packed = data.get("message_payload_packed")
 
-        self.flags = MessageFlags(flags)
+        if self._packed is not None:
+            self._payload = NOT_DECODED
+            self._payload_json = None
+        elif isinstance(payload, str):
+            self._payload = NOT_DECODED
+            self._payload_json = payload
+        else:
+            self._payload = payload
+            self._payload_json = None
+
+        self._flags = None
+        self._flags_raw = data.get("message_flags", "")
+
+    @property
+    def payload(self):
+        if self._payload is NOT_DECODED:
+            self._payload = ujson.loads(self.payload_json())
+        # the caller may change the payload in place, so the stored one can't be trusted anymore
+        self._payload_json = None
+        return self._payload
+
+    @payload.setter
+    def payload(self, value):
+        self._payload = value
+        self._payload_json = None
+        self._packed = None
+
+    def payload_json(self):
+        if self._packed is not None:
+            self._payload_json = PayloadCompression.unpack(self._packed)
+            self._packed = None
+        if self._payload_json is None:
+            return ujson.dumps(self._payload, escape_forward_slashes=False)
+        return self._payload_json
+
+    @property
+    def flags(self):
+        if self._flags is None:
+            self._flags = MessageFlags((self._flags_raw or "").lower().split(","))
+        return self._flags
 
     def dump(self):
         return {
@@ -61,11 +133,54 @@ class MessageAdapter(object):
             "payload": self.payload
         }
 
+    def dump_json(self, gamespace):
+        """
+        Serializes the message the way message lists have it, without decoding the payload
+        """
+        fields = ujson.dumps({
+            "uuid": self.message_uuid,
+            "recipient_class": self.recipient_class,
+            "sender": self.sender,
+            "recipient": self.recipient,
+            "gamespace": int(gamespace),
+            "time": str(self.time),
+            "type": self.message_type
+        }, escape_forward_slashes=False)
+
+        return fields[:-1] + ',"payload":' + self.payload_json() + "}"
+
+
+async def list_archived(db, query, count_query, args, offset, limit, found):
+    """
+    Completes a page of hot messages with archived ones, archived messages being older than hot ones.
+
+    :param query: a query formatted with a table name, expected to end with "LIMIT %s, %s"
+    :param count_query: a query formatted with a table name, returning a single `count` column. It should
+        have the same conditions (and arguments) as the query, or the page would skip or repeat messages.
+    :param found: how many hot messages the page already has
+    :return: a list of archived rows to append to the page
+    """
+
+    if found >= limit:
+        return []
+
+    if found or not offset:
+        archive_offset = 0
+    else:
+        # the page starts past every hot message
+        hot = await db.get(count_query.format("messages"), *args)
+        archive_offset = max(offset - hot["count"], 0)
+
+    return list(await db.query(query.format("messages_archive"), *(tuple(args) + (archive_offset, limit - found))))
+
 
 class MessagesQuery(object):
-    def __init__(self, gamespace_id, db):
+    def __init__(self, gamespace_id, db, counters=None, primary_db=None):
         self.gamespace_id = gamespace_id
         self.db = db
+        # the buffer of recent messages is kept up to date by events, so it's only loaded from the primary
+        self.primary_db = primary_db or db
+        self.counters = counters
 
         self.message_sender = None
         self.message_recipient_class = None
@@ -73,9 +188,24 @@ class MessagesQuery(object):
         self.message_type = None
         self.message_delivered = None
 
+        # messages older than that are expired, also lets a partitioned table to be pruned
+        self.message_time_after = None
+
+        # messages past their time to live by then are skipped, though still counted until they're swept
+        self.message_expires_after = None
+
+        # fall through to archived messages once hot ones are exhausted
+        self.archived = False
+
+        # see RecentMessages
+        self.recent = None
+
         self.offset = 0
         self.limit = 0
 
+        # see MessageCounters.resolve_mode
+        self.count_mode = None
+
     def __values__(self):
         conditions = [
             "`gamespace_id`=%s"
@@ -105,34 +235,127 @@ class MessagesQuery(object):
             conditions.append("`message_delivered`=%s")
             data.append(str(int(bool(self.message_delivered))))
 
+        if self.message_time_after is not None:
+            conditions.append("`message_time`>=%s")
+            data.append(self.message_time_after)
+
         return conditions, data
 
-    async def query(self, one=False, count=False):
+    def __recipient_counter__(self):
+        """
+        Returns True if the total count of this query is maintained by a recipient counter
+        """
+
+        if self.message_sender or self.message_type or self.message_delivered is not None:
+            return False
+
+        if not self.message_recipient_class or not self.message_recipient:
+            return False
+
+        # recipient is matched with LIKE
+        return "%" not in self.message_recipient and "_" not in self.message_recipient
+
+    def __recent__(self):
+        """
+        Returns True if this query could be served from the buffer of recent messages
+        """
+        if self.recent is None or self.message_recipient_class == CLASS_USER:
+            return False
+
+        return self.__recipient_counter__() and self.recent.fits(int(self.offset), int(self.limit))
+
+    async def __count__(self, conditions, data):
+        where = " AND ".join(conditions)
+
+        if self.counters is None:
+            return None
+
+        if self.__recipient_counter__():
+            async def counter():
+                return await self.counters.get(
+                    self.gamespace_id, KIND_RECIPIENT, self.message_recipient_class, self.message_recipient)
+
+            return await self.counters.count(
+                ("recipient", self.gamespace_id, self.message_recipient_class, self.message_recipient),
+                self.count_mode, exact=counter)
+
+        async def exact():
+            count = await self.counters.count_rows(
+                """
+                    SELECT COUNT(*) AS `count` FROM `messages`
+                    WHERE {0};
+                """.format(where), *data, db=self.db)
+
+            if self.archived:
+                count += await self.counters.count_rows(
+                    """
+                        SELECT COUNT(*) AS `count` FROM `messages_archive`
+                        WHERE {0};
+                    """.format(where), *data, db=self.db)
+
+            return count
+
+        async def approximate():
+            return await self.counters.estimate_rows(
+                """
+                    SELECT `message_id` FROM `messages`
+                    WHERE {0};
+                """.format(where), *data, db=self.db)
+
+        return await self.counters.count(
+            ("query", where) + tuple(data), self.count_mode, exact=exact, approximate=approximate)
+
+    def __select__(self):
+        """
+        Returns a query of messages (with a table name to be formatted in), its where clause and arguments
+        """
         conditions, data = self.__values__()
 
-        query = """
-            SELECT {0} * FROM `messages`
-            WHERE {1}
-        """.format(
-            "SQL_CALC_FOUND_ROWS" if count else "",
-            " AND ".join(conditions))
+        if self.message_expires_after is not None:
+            conditions.append("(`message_expires` IS NULL OR `message_expires`>%s)")
+            data.append(self.message_expires_after)
+
+        where = " AND ".join(conditions)
 
-        query += """
+        query = """
+            SELECT * FROM `{{0}}`
+            WHERE {0}
             ORDER BY `message_time` DESC
+        """.format(where)
+
+        return query, where, data
+
+    def statement(self, table="messages"):
+        """
+        Returns a (query, arguments) tuple of a page of this query, as it's run, see MigrationsModel.check_query_plans
         """
+        query, where, data = self.__select__()
+        return query.format(table) + "LIMIT %s,%s;", tuple(data) + (int(self.offset), int(self.limit))
 
-        if self.limit:
-            query += """
-                LIMIT %s,%s
-            """
-            data.append(int(self.offset))
-            data.append(int(self.limit))
+    def count_statement(self, table="messages"):
+        """
+        Returns a (query, arguments) tuple counting messages pages of this query are taken from
+        """
+        query, where, data = self.__select__()
+        return MessagesQuery.__count_query__(where).format(table), tuple(data)
+
+    @staticmethod
+    def __count_query__(where):
+        return """
+            SELECT COUNT(*) AS `count` FROM `{{0}}`
+            WHERE {0};
+        """.format(where)
 
-        query += ";"
+    async def query(self, one=False, count=False):
+        count_conditions, count_data = self.__values__()
+        query, where, data = self.__select__()
 
         if one:
             try:
-                result = await self.db.get(query, *data)
+                result = await self.db.get(query.format("messages") + "LIMIT 1;", *data)
+
+                if not result and self.archived:
+                    result = await self.db.get(query.format("messages_archive") + "LIMIT 1;", *data)
             except DatabaseError as e:
                 raise MessageQueryError("Failed to add message: " + e.args[1])
 
@@ -141,419 +364,1961 @@ class MessagesQuery(object):
 
             return MessageAdapter(result)
         else:
-            async with self.db.acquire() as db:
-                try:
-                    result = await db.query(query, *data)
-                except DatabaseError as e:
-                    raise MessageQueryError("Failed to add message: " + e.args[1])
+            async def load(db, offset, limit):
+                if limit:
+                    result = list(await db.query(
+                        query.format("messages") + "LIMIT %s,%s;", *(data + [offset, limit])))
+
+                    if self.archived:
+                        result += await list_archived(
+                            db, query + "LIMIT %s,%s;", MessagesQuery.__count_query__(where),
+                            data, offset, limit, len(result))
+                else:
+                    result = list(await db.query(query.format("messages") + ";", *data))
 
-                count_result = 0
+                    if self.archived:
+                        result += await db.query(query.format("messages_archive") + ";", *data)
 
-                if count:
-                    count_result = await db.get(
-                        """
-                            SELECT FOUND_ROWS() AS count;
-                        """)
-                    count_result = count_result["count"]
+                return list(map(MessageAdapter, result))
+
+            try:
+                if self.__recent__():
+                    async def load_recent(size):
+                        return await load(self.primary_db, 0, size)
+
+                    recent = await self.recent.get(
+                        RecentMessages.key(self.gamespace_id, self.message_recipient_class, self.message_recipient),
+                        load_recent)
+
+                    # messages expire while they're buffered
+                    items = [
+                        message
+                        for message in recent
+                        if self.message_expires_after is None or message.expires is None or
+                        message.expires > self.message_expires_after
+                    ][:int(self.limit)]
+
+                    # a buffer holds as many messages as it could, so there may be more past the expired ones
+                    if len(items) < int(self.limit) and len(recent) >= self.recent.size:
+                        items = await load(self.db, int(self.offset), int(self.limit))
+                else:
+                    items = await load(self.db, int(self.offset), int(self.limit))
+            except DatabaseError as e:
+                raise MessageQueryError("Failed to add message: " + e.args[1])
 
-                items = map(MessageAdapter, result)
+            if count:
+                try:
+                    count_result = await self.__count__(count_conditions, count_data)
+                except MessageError as e:
+                    raise MessageQueryError(e.message)
 
-                if count:
-                    return (items, count_result)
+                return (items, count_result)
 
-                return items
+            return items
 
 
 class MessagesHistoryModel(Model):
 
+    # columns `messages` and `messages_archive` have in common, in the same order
+    COLUMNS = """
+        `message_id`, `gamespace_id`, `message_uuid`, `message_sender`, `message_recipient_class`,
+        `message_recipient`, `message_time`, `message_type`, `message_payload`, `message_delivered`,
+        `message_flags`, `message_conversation`, `message_expires`, `message_payload_packed`
+    """
+
+    EVENT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    # messages mark_messages_as_read accepts at once
+    MAX_READ_BATCH = 1000
+
+    JOB_ACCOUNTS_DELETED = "accounts_deleted"
+    JOB_GROUP_PURGED = "group_purged"
+    JOB_RECOMPRESS = "recompress_payloads"
+    JOB_BACKFILL_SUMMARIES = "backfill_summaries"
+    JOB_BACKFILL_COUNTERS = "backfill_counters"
+    JOB_BACKFILL_INBOX = "backfill_inbox"
+    JOB_BACKFILL_UNREAD = "backfill_unread"
+    JOB_BACKFILL_CONVERSATIONS = "backfill_conversations"
+
+    # a single message of a table ({0}) matching a condition ({1}), see __get_message__
+    MESSAGE_QUERY = """
+        SELECT *
+        FROM `{0}`
+        WHERE {1}
+        LIMIT 1;
+    """
+
+    MESSAGE_BY_UUID = "`message_uuid`=%s AND `gamespace_id`=%s"
+
+    # messages of a direct conversation, see list_messages_recipient_count
+    CONVERSATION_MESSAGES = """
+        FROM `{0}`
+        WHERE `gamespace_id`=%s AND `message_conversation`=%s
+            AND (`message_expires` IS NULL OR `message_expires`>%s)
+    """
+
+    # a page of a direct conversation, and how many messages there are, with the same conditions
+    CONVERSATION_QUERY = "SELECT *" + CONVERSATION_MESSAGES + """
+        ORDER BY `message_id` DESC
+        LIMIT %s, %s;
+    """
+    CONVERSATION_COUNT = "SELECT COUNT(*) AS `count`" + CONVERSATION_MESSAGES + ";"
+
+    # messages of an account inbox, see list_messages_account
+    ACCOUNT_INBOX_MESSAGES = """
+        FROM `account_inbox` AS `i`
+            INNER JOIN `{0}` AS `m` ON `m`.`message_id`=`i`.`message_id`
+        WHERE `i`.`gamespace_id`=%s AND `i`.`account_id`=%s
+            AND (`m`.`message_expires` IS NULL OR `m`.`message_expires`>%s)
+    """
+
+    # a page of an account inbox, and how many messages there are, with the same conditions
+    ACCOUNT_INBOX_QUERY = "SELECT `m`.*" + ACCOUNT_INBOX_MESSAGES + """
+        ORDER BY `i`.`message_id` DESC
+        LIMIT %s, %s;
+    """
+    ACCOUNT_INBOX_COUNT = "SELECT COUNT(*) AS `count`" + ACCOUNT_INBOX_MESSAGES + ";"
+
+    # primary keys of tables rows of deleted accounts are deleted from, see __rows_stage__
+    ACCOUNT_ROWS_KEYS = {
+        "account_inbox": ["gamespace_id", "account_id", "message_id"],
+        "last_read_message": ["gamespace_id", "account_id", "message_recipient_class", "message_recipient"],
+        "message_unread": ["gamespace_id", "account_id", "recipient_class", "recipient"],
+        "conversation_summary": ["gamespace_id", "account_id", "recipient_class", "recipient"],
+        "message_mailbox": ["gamespace_id", "recipient_class", "recipient", "message_type"],
+    }
+
     def __init__(self, db, app):
         self.db = db
         self.app = app
+        self.shards = app.shards
+        self.counters = MessageCounters(
+            self.shards,
+            mode=options.message_count_mode,
+            cache_ttl=options.message_count_cache_ttl)
+        self.inbox_backfill_limit = options.message_inbox_backfill_limit
+        self.drain_chunk_size = max(options.message_drain_chunk_size, 1)
+
+        # the oldest time a message could have according to retention policies, see MessagesRetentionModel
+        self.retention_cutoff = None
+
+        # a partitioned `messages` only has uuids unique along with the time (see MessagesRetentionModel),
+        #   so duplicates have to be looked for before messages are stored
+        self.uuids_partitioned = False
+
+        # delivered messages older than that are moved into `messages_archive`, 0 to disable
+        self.archive_days = options.message_archive_days
+
+        self.recent = RecentMessages(
+            size=options.message_recent_size,
+            max_recipients=options.message_recent_groups)
+        self.lookup = MessageLookupCache(
+            max_size=options.message_lookup_cache_size,
+            ttl=options.message_lookup_cache_ttl)
+
+        self.unread = UnreadCounters(self.shards)
+        self.summaries = ConversationSummaries(self.shards, preview_size=options.message_conversation_preview_size)
+        self.outbox = MessageOutbox(
+            self.shards, app,
+            interval=options.message_outbox_interval,
+            batch_size=options.message_outbox_batch_size)
+        self.read_positions = ReadPositions(
+            self.shards, interval=options.message_read_flush_interval,
+            on_written=self.__read_positions_written__)
+        self.spool = MessageSpool(
+            self, path=options.message_spool_path,
+            segment_size=options.message_spool_segment_size,
+            sync_delay=options.message_spool_sync_delay,
+            replay_interval=options.message_spool_replay_interval,
+            batch_size=options.message_spool_batch_size)
+        self.compression = PayloadCompression(
+            threshold=options.message_payload_compress_threshold,
+            level=options.message_payload_compress_level)
+        self.expiry = MessageExpirySweeper(
+            self, interval=options.message_expiry_interval,
+            batch_size=options.message_expiry_batch_size)
 
     def get_setup_tables(self):
-        return ["messages", "last_read_message"]
+        return ["messages", "messages_archive", "last_read_message", "message_counters", "account_inbox",
+                "message_unread", "conversation_summary", "message_outbox", "message_mailbox"]
 
     def get_setup_db(self):
         return self.db
 
-    def has_delete_account_event(self):
-        return True
+    async def started(self, application):
+        await super(MessagesHistoryModel, self).started(application)
+        self.read_positions.start()
+        self.outbox.start()
+        self.spool.start()
+        self.expiry.start()
+
+    async def stopped(self):
+        self.expiry.stop()
+        await self.spool.stop()
+        self.outbox.stop()
+        await self.read_positions.stop()
+        await super(MessagesHistoryModel, self).stopped()
+
+    async def setup_table_message_counters(self):
+        """
+        Counts messages of existing history (archived ones included, as they're counted too),
+            on installations that had no counters
+        """
+        await self.__backfill__(MessagesHistoryModel.JOB_BACKFILL_COUNTERS, tables=("messages", "messages_archive"))
 
-    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
-        try:
-            async with self.db.acquire() as db:
-                if gamespace_only:
-                    await db.execute(
-                        """
-                            DELETE FROM `last_read_message`
-                            WHERE `gamespace_id`=%s AND `account_id` IN %s;
-                        """, gamespace, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `gamespace_id`=%s AND `message_sender` IN %s;
-                        """, gamespace, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient` IN %s;
-                        """, gamespace, CLASS_USER, accounts)
-                else:
-                    await db.execute(
-                        """
-                            DELETE FROM `last_read_message`
-                            WHERE `account_id` IN %s;
-                        """, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `message_sender` IN %s;
-                        """, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `message_recipient_class`=%s AND `message_recipient` IN %s;
-                        """, CLASS_USER, accounts)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to delete messages: " + e.args[1])
+    async def setup_table_account_inbox(self):
+        """
+        Fills up the account inbox (and account counters) from existing history, on installations that had none
+        """
+        await self.__backfill__(MessagesHistoryModel.JOB_BACKFILL_INBOX)
 
-    def messages_query(self, gamespace):
-        return MessagesQuery(gamespace, self.db)
+    async def setup_table_message_unread(self):
+        """
+        Counts unread messages of existing history, on installations that had no counters.
+            Runs after the inbox backfill, if both tables are new, as jobs run in order.
+        """
+        await self.__backfill__(MessagesHistoryModel.JOB_BACKFILL_UNREAD)
 
-    @validate(gamespace="int", sender="int", message_uuid="str", recipient_class="str",
-              recipient_key="str", time="datetime", message_type="str", payload="json",
-              flags=MessageFlags, delivered="bool")
-    async def add_message(self, gamespace, sender, message_uuid, recipient_class, recipient_key, time,
-                          message_type, payload, flags, delivered=False):
+    async def setup_table_conversation_summary(self):
+        """
+        Summarizes conversations of existing history, on installations that had no summaries
+        """
+        await self.__backfill__(MessagesHistoryModel.JOB_BACKFILL_SUMMARIES)
 
-        if not isinstance(payload, dict):
-            raise MessageError(400, "payload should be a dict")
+    async def __backfill__(self, kind, tables=("messages",), shard=0):
+        """
+        Adds a job that fills up a table just created on an existing installation from the history stored
+            by now, see __backfill_stage__. Messages stored after are accounted for as usual.
 
-        try:
-            message_id = await self.db.insert(
-                """
-                    INSERT INTO `messages`
-                    (`gamespace_id`, `message_uuid`, `message_recipient_class`, `message_sender`,
-                        `message_recipient`, `message_time`, `message_type`, `message_payload`,
-                        `message_delivered`, `message_flags`)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                """, gamespace, message_uuid, recipient_class, sender,
-                recipient_key, time, message_type, ujson.dumps(payload), int(delivered), flags.dump())
-        except DuplicateError:
-            raise MessageError(400, "Message with that ID already exists")
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to add message: " + e.args[1])
-        else:
-            return message_id
+        A job is used as the history could be too big to go through on startup, and as setup_table_ hooks are
+            called before migrations are applied, while jobs only run once every model has started.
+        """
+        until = {}
+        shard_db = self.shards.all()[shard]
 
-    async def get_message(self, gamespace, message_id):
         try:
-            message = await self.db.get(
-                """
-                    SELECT *
-                    FROM `messages`
-                    WHERE `message_id`=%s AND `gamespace_id`=%s;
-                """, message_id, gamespace)
+            for table in tables:
+                last = await shard_db.get(
+                    """
+                        SELECT MAX(`message_id`) AS `last_id`
+                        FROM `{0}`;
+                    """.format(table))
+                until[table] = (last["last_id"] if last else None) or 0
         except DatabaseError as e:
-            raise MessageError(500, "Failed to get a message: " + e.args[1])
-
-        if not message:
-            raise MessageNotFound()
+            raise MessageError(500, "Failed to look up the history: " + e.args[1])
 
-        return MessageAdapter(message)
+        if not any(until.values()):
+            return
 
-    async def list_incoming_messages(self, gamespace, recipient_class, recipient, limit=100):
-        try:
-            messages = await self.db.query(
-                """
-                    SELECT *
-                    FROM `messages`
-                    WHERE `message_recipient_class`=%s AND `message_recipient`=%s AND `gamespace_id`=%s
-                    ORDER BY `message_time` DESC
-                    LIMIT %s;
-                """, recipient_class, recipient, gamespace, limit)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to list incoming messages: " + e.args[1])
+        await self.app.jobs.add(0, kind, {
+            "until": until,
+            "shard": shard
+        })
 
-        return list(map(MessageAdapter, messages))
+    def __backfill_stage__(self, table, args, fill):
+        """
+        Returns a job stage that calls fill(db, after, last) for chunks of messages of a table in id order,
+            `after` being the last id of the previous chunk and `last` the last one of this chunk,
+            up to the one a backfill job has been added with. Every chunk is filled up in a transaction of its own.
+        """
+        until = args["until"][table]
+        shard_db = self.shards.all()[args.get("shard", 0)]
 
-    @validate(gamespace="int", account_id="int", limit="int", offset="int")
-    async def list_messages_account_with_count(self, gamespace, account_id, limit=100, offset=0):
-        async with self.db.acquire() as db:
-            result = await self.list_messages_account_with_count_db(gamespace, account_id, db, limit, offset)
-            return result
+        async def stage(checkpoint, limit):
+            try:
+                async with shard_db.acquire(auto_commit=False) as db:
+                    try:
+                        chunk = await db.query(
+                            """
+                                SELECT `message_id`
+                                FROM `{0}`
+                                WHERE `message_id`>%s AND `message_id`<=%s
+                                ORDER BY `message_id` ASC
+                                LIMIT %s;
+                            """.format(table), checkpoint, until, limit)
+
+                        if chunk:
+                            await fill(db, checkpoint, chunk[-1]["message_id"])
+                    finally:
+                        await db.commit()
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to fill up from {0}: {1}".format(table, e.args[1]))
 
-    @validate(gamespace="int", account_id="int", limit="int", offset="int")
-    async def list_messages_account_with_count_db(self, gamespace, account_id, db, limit=100, offset=0):
-        messages = await self.list_messages_account(gamespace, account_id, limit, offset, db=db)
-        try:
-            count_result = await db.get(
-                """
-                    SELECT FOUND_ROWS() AS count;
-                """)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to count found rows for account messages: " + e.args[1])
+            if not chunk:
+                return 0, checkpoint
 
-        count_result = count_result["count"]
-        return messages, count_result
+            return len(chunk), chunk[-1]["message_id"]
+        return stage
 
-    @validate(gamespace="int", account_id="int", recipient_account_id="int", limit="int", offset="int")
-    async def list_messages_recipient_count(self, gamespace, account_id, recipient_account_id, limit=100, offset=0):
+    def backfill_counters_stages(self, gamespace, args):
+        def stage(table):
+            async def fill(db, after, last):
+                await self.counters.count_range(db, after, last, table=table)
+            return self.__backfill_stage__(table, args, fill)
 
-        """
-        Returns messages that were sent between account_id and recipient_account_id
-        """
+        return [stage(table) for table in ["messages", "messages_archive"]]
 
-        if limit < 1 or limit > 10000 or offset < 0 or offset > 10000:
-            raise MessageError(400, "Bad limit/offset")
+    def backfill_summaries_stages(self, gamespace, args):
+        return [self.__backfill_stage__("messages", args, self.summaries.summarize)]
 
-        async with self.db.acquire() as db:
-            try:
-                messages = await (db or self.db).query(
-                    """
-                        SELECT SQL_CALC_FOUND_ROWS * 
-                        FROM `messages` 
-                        WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND 
-                              `message_recipient`=%s AND `message_sender`=%s
-                        UNION DISTINCT
-                        (
-                            SELECT * 
-                            FROM `messages` 
-                            WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND 
-                                  `message_recipient`=%s AND `message_sender`=%s
-                        )
-                        ORDER BY `message_id` DESC
-                        LIMIT %s, %s;
-                    """, gamespace, CLASS_USER, str(account_id), str(recipient_account_id),
-                    gamespace, CLASS_USER, str(recipient_account_id), str(account_id),
-                    offset, limit)
-            except DatabaseError as e:
-                raise MessageError(500, "Failed to list incoming messages for account: " + e.args[1])
+    def backfill_inbox_stages(self, gamespace, args):
+        return [self.__backfill_stage__("messages", args, self.__fill_inbox__)]
 
-            count_result = await db.get(
-                """
-                    SELECT FOUND_ROWS() AS count;
-                """)
-            count_result = count_result["count"]
+    def backfill_unread_stages(self, gamespace, args):
+        return [self.__backfill_stage__("messages", args, self.unread.count_range)]
 
-            return list(map(MessageAdapter, messages)), count_result
+    def backfill_conversations_stages(self, gamespace, args):
+        def stage(table):
+            async def fill(db, after, last):
+                await db.execute(
+                    """
+                        UPDATE `{0}`
+                        SET `message_conversation`=CONCAT(
+                            LEAST(`message_sender`, CAST(`message_recipient` AS UNSIGNED)), ':',
+                            GREATEST(`message_sender`, CAST(`message_recipient` AS UNSIGNED)))
+                        WHERE `message_id`>%s AND `message_id`<=%s AND `message_recipient_class`=%s
+                            AND `message_conversation` IS NULL AND `message_recipient` REGEXP '^[0-9]+$';
+                    """.format(table), after, last, CLASS_USER)
+            return self.__backfill_stage__(table, args, fill)
+
+        return [stage(table) for table in ["messages", "messages_archive"]]
+
+    async def __fill_inbox__(self, db, after, last):
+        """
+        Puts messages with ids in (after, last] into inboxes of the accounts that should see them,
+            same as __inbox_fan_out__, and counts them
+        """
+        await db.execute(
+            """
+                INSERT IGNORE INTO `account_inbox`
+                (`gamespace_id`, `account_id`, `message_id`)
+                SELECT `gamespace_id`, `message_sender`, `message_id`
+                FROM `messages`
+                WHERE `message_id`>%s AND `message_id`<=%s;
+            """, after, last)
+        await db.execute(
+            """
+                INSERT IGNORE INTO `account_inbox`
+                (`gamespace_id`, `account_id`, `message_id`)
+                SELECT `gamespace_id`, CAST(`message_recipient` AS UNSIGNED), `message_id`
+                FROM `messages`
+                WHERE `message_id`>%s AND `message_id`<=%s AND `message_recipient_class`=%s
+                    AND `message_recipient` REGEXP '^[0-9]+$';
+            """, after, last, CLASS_USER)
+        await db.execute(
+            """
+                INSERT IGNORE INTO `account_inbox`
+                (`gamespace_id`, `account_id`, `message_id`)
+                SELECT `m`.`gamespace_id`, `p`.`participation_account`, `m`.`message_id`
+                FROM `messages` AS `m`
+                    INNER JOIN `groups` AS `g`
+                    ON `g`.`gamespace_id`=`m`.`gamespace_id` AND `g`.`group_class`=`m`.`message_recipient_class`
+                    INNER JOIN `group_participants` AS `p`
+                    ON `p`.`gamespace_id`=`g`.`gamespace_id` AND `p`.`group_id`=`g`.`group_id`
+                WHERE `m`.`message_id`>%s AND `m`.`message_id`<=%s AND `m`.`message_recipient`=IF(`p`.`cluster_id`,
+                    CONCAT(`g`.`group_key`, '-', `p`.`cluster_id`), `g`.`group_key`);
+            """, after, last)
+        await self.counters.count_inbox_range(db, after, last)
+
+    async def migration_messages_conversation_key(self, db):
+        """
+        Fills up conversation keys of direct messages stored before the key existed, with a job
+        """
+        await self.__backfill__(
+            MessagesHistoryModel.JOB_BACKFILL_CONVERSATIONS, tables=("messages", "messages_archive"),
+            shard=self.shards.all().index(db))
 
-    @validate(gamespace="int", account_id="int", limit="int", offset="int")
-    async def list_messages_account(self, gamespace, account_id, limit=100, offset=0, db=None):
+    @staticmethod
+    def __group_recipient__(recipient):
         """
-        Returns last N..M (offset to limit) messages being sent or received by the account,
-            including the ones being sent to the groups the account participates in.
+        Splits a group recipient into group key and cluster id, see GroupParticipationAdapter.calculate_recipient
         """
+        key, separator, cluster_id = recipient.rpartition("-")
+        if separator and cluster_id.isdigit():
+            return key, int(cluster_id)
+        return recipient, 0
 
-        if limit < 1 or limit > 10000 or offset < 0 or offset > 10000:
-            raise MessageError(400, "Bad limit/offset")
+    async def __inbox_fan_out__(self, db, gamespace, message_id, sender, recipient_class, recipient):
+        """
+        Puts a newly stored message into inboxes of every account that should see it in list_messages_account:
+            the sender, the recipient account for direct messages, or every participant of the recipient group
+        """
 
-        try:
-            messages = await (db or self.db).query(
-                # now this I call a query. yet it executes in 1ms with 40000 messages in db
-                """
-                    SELECT SQL_CALC_FOUND_ROWS * 
-                    FROM `messages` 
-                    WHERE `messages`.`gamespace_id`=%s
-                    AND (`messages`.`message_recipient_class`, `messages`.`message_recipient`) IN (
-                        SELECT `groups`.`group_class`, `groups`.`group_key` 
-                        FROM `groups`, `group_participants`
-                        WHERE `groups`.`group_class`=`messages`.`message_recipient_class` 
-                            AND `groups`.`group_key`=`messages`.`message_recipient`
-                            AND `groups`.`group_id`=`group_participants`.`group_id` 
-                            AND `group_participants`.`participation_account`=%s
-                    )
-                    UNION DISTINCT
-                    (
-                        SELECT * 
-                        FROM `messages` 
-                        WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
-                    )
-                    UNION DISTINCT
-                    (
-                        SELECT * 
-                        FROM `messages` 
-                        WHERE `gamespace_id`=%s AND `message_sender`=%s
-                    )
-                    ORDER BY `message_id` DESC
-                    LIMIT %s, %s;
-                """, gamespace, str(account_id), gamespace, CLASS_USER,
-                str(account_id), gamespace, str(account_id), offset, limit)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to list incoming messages for account: " + e.args[1])
+        accounts = [str(sender)]
 
-        return list(map(MessageAdapter, messages))
+        if recipient_class == CLASS_USER:
+            if recipient.isdigit() and recipient not in accounts:
+                accounts.append(recipient)
+        else:
+            group_key, cluster_id = MessagesHistoryModel.__group_recipient__(recipient)
 
-    async def read_incoming_messages(self, gamespace, recipient_class, recipient, receiver):
-        try:
-            async with self.db.acquire(auto_commit=False) as db:
-                messages = await db.query(
-                    """
-                        SELECT *
-                        FROM `messages`
-                        WHERE `message_recipient_class`=%s AND `message_recipient`=%s
-                            AND `gamespace_id`=%s AND `message_delivered`=0
-                        FOR UPDATE;
-                    """, recipient_class, recipient, gamespace)
-
-                mark_delivered_ids = []
-                remove_ids = []
-
-                for m in map(MessageAdapter, messages):
-                    recv = await receiver(m)
-                    if recv:
-                        if MessageFlags.REMOVE_DELIVERED in m.flags:
-                            remove_ids.append(m.message_id)
-                        else:
-                            mark_delivered_ids.append(m.message_id)
-
-                if mark_delivered_ids:
-                    await db.query(
-                        """
-                            UPDATE `messages`
-                            SET `message_delivered`=1
-                            WHERE `gamespace_id`=%s AND `message_id` IN %s;
-                        """, gamespace, mark_delivered_ids
-                    )
-
-                if remove_ids:
-                    await db.query(
-                        """
-                            DELETE FROM `messages`
-                            WHERE `gamespace_id`=%s AND `message_id` IN %s;
-                        """, gamespace, remove_ids
-                    )
+            condition = """
+                `g`.`gamespace_id`=%s AND `g`.`group_class`=%s AND `p`.`participation_account`<>%s AND (
+                    (`g`.`group_key`=%s AND `p`.`cluster_id`=0) OR
+                    (`g`.`group_key`=%s AND `p`.`cluster_id`=%s))
+            """
+            args = (gamespace, recipient_class, sender, recipient, group_key, cluster_id)
 
-                await db.commit()
+            await db.execute(
+                """
+                    INSERT IGNORE INTO `account_inbox`
+                    (`gamespace_id`, `account_id`, `message_id`)
+                    SELECT `p`.`gamespace_id`, `p`.`participation_account`, %s
+                    FROM `groups` AS `g`
+                        INNER JOIN `group_participants` AS `p`
+                        ON `p`.`gamespace_id`=`g`.`gamespace_id` AND `p`.`group_id`=`g`.`group_id`
+                    WHERE {0};
+                """.format(condition), message_id, *args)
+
+            await self.counters.inbox_group_added(db, condition, *args)
+            await self.unread.group_added(db, recipient_class, recipient, condition, *args)
+
+        await db.execute(
+            """
+                INSERT IGNORE INTO `account_inbox`
+                (`gamespace_id`, `account_id`, `message_id`)
+                VALUES {0};
+            """.format(", ".join(["(%s, %s, %s)"] * len(accounts))),
+            *[value for account in accounts for value in (gamespace, account, message_id)])
+
+        await self.counters.inbox_added(db, gamespace, accounts)
+        await self.unread.added(
+            db, gamespace, UnreadCounters.recipients(sender, recipient_class, recipient), recipient_class, recipient)
+        await self.summaries.message_added(db, gamespace, message_id)
+
+    async def messages_imported(self, db, gamespace, messages):
+        """
+        Does everything add_message does besides storing a message, for messages inserted in bulk
 
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to read incoming messages: " + e.args[1])
+        :param messages: a list of rows with `message_id`, `message_sender`, `message_recipient_class`
+            and `message_recipient` columns
+        """
+        for message in messages:
+            await self.counters.message_added(
+                db, gamespace, message["message_sender"],
+                message["message_recipient_class"], message["message_recipient"])
+            await self.__inbox_fan_out__(
+                db, gamespace, message["message_id"], message["message_sender"],
+                message["message_recipient_class"], message["message_recipient"])
 
-    async def delete_messages(self, gamespace, recipient_class, recipient):
-        try:
-            await self.db.execute(
-                """
-                    DELETE FROM `messages`
-                    WHERE `message_recipient_class`=%s AND `message_recipient`=%s AND `gamespace_id`=%s;
-                """, recipient_class, recipient, gamespace)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to delete messages: " + e.args[1])
+        self.__history_event__(RecentMessages.EVENT_CLEAR)
 
-    async def delete_messages_like(self, gamespace, recipient_class, recipient_like):
-        try:
-            await self.db.execute(
-                """
-                    DELETE FROM `messages`
-                    WHERE `message_recipient_class` LIKE %s AND `message_recipient`=%s AND `gamespace_id`=%s;
-                """, recipient_class, recipient_like, gamespace)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to delete messages: " + e.args[1])
+    async def add_messages_bulk(self, gamespace, messages):
+        """
+        Stores a batch of messages with multi-row inserts, skipping the ones that exist already (by uuid),
+            so storing the same batch twice is harmless. Returns how many messages have been stored.
 
-    async def delete_message(self, gamespace, message_id):
-        try:
-            await self.db.execute(
-                """
-                    DELETE FROM `messages`
-                    WHERE `message_id`=%s AND `gamespace_id`=%s;
-                """, message_id, gamespace)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to delete a message: " + e.args[1])
+        :param messages: a list of dicts with `message_uuid`, `message_sender`, `message_recipient_class`,
+            `message_recipient`, `message_time`, `message_type`, `message_payload` (JSON), `message_delivered`,
+            `message_flags` and `message_conversation` columns, and optionally `message_expires`
+        """
 
-    async def delete_message_concurrent(self, gamespace, sender, message_uuid):
-        async with self.db.acquire(auto_commit=False) as db:
+        async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
             try:
-                message = await db.get(
+                # a locking read keeps concurrent batches from storing the same uuids where the key won't
+                existing = await db.query(
                     """
-                        SELECT `message_recipient_class`, `message_recipient`, `message_flags`, `message_sender`,
-                            `message_type`
+                        SELECT `message_uuid`
                         FROM `messages`
-                        WHERE `message_uuid`=%s AND `gamespace_id`=%s
-                        LIMIT 1
-                        FOR UPDATE;
-                    """, message_uuid, gamespace)
-
-                if message is None:
-                    raise MessageNotFound()
-
-                # sender can always delete his message
-                if str(message["message_sender"]) != str(sender):
-                    flags = MessageFlags(message["message_flags"].lower().split(","))
+                        WHERE `message_uuid` IN %s{0};
+                    """.format(" FOR UPDATE" if self.uuids_partitioned else ""),
+                    [message["message_uuid"] for message in messages])
 
-                    if MessageFlags.DELETABLE not in flags:
-                        raise MessageError(409, "This message is not deletable")
+                existing = set(message["message_uuid"] for message in existing)
+                messages = [message for message in messages if message["message_uuid"] not in existing]
 
-                message_recipient_class = message["message_recipient_class"]
-                message_recipient = message["message_recipient"]
-                message_type = message["message_type"]
+                if not messages:
+                    return 0
 
-                await self.app.message_queue.delete_message(
-                    gamespace, sender, message_type, message_recipient_class, message_recipient, message_uuid)
+                packed = [self.compression.pack(message["message_payload"]) for message in messages]
 
                 await db.execute(
                     """
-                        DELETE FROM `messages`
-                        WHERE `message_uuid`=%s AND `gamespace_id`=%s
-                        LIMIT 1;
-                    """, message_uuid, gamespace)
-
-            except DatabaseError as e:
-                raise MessageError(500, "Failed to delete a message: " + e.args[1])
-            finally:
-                await db.commit()
-
-    async def update_message_concurrent(self, gamespace, sender, message_uuid, update):
-        async with self.db.acquire(auto_commit=False) as db:
-            try:
-                message = await db.get(
+                        INSERT IGNORE INTO `messages`
+                        (`gamespace_id`, `message_uuid`, `message_sender`, `message_recipient_class`,
+                            `message_recipient`, `message_time`, `message_type`, `message_payload`,
+                            `message_delivered`, `message_flags`, `message_conversation`, `message_expires`,
+                            `message_payload_packed`)
+                        VALUES {0};
+                    """.format(", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(messages))),
+                    *[value for message, (payload, payload_packed) in zip(messages, packed) for value in (
+                        gamespace, message["message_uuid"], message["message_sender"],
+                        message["message_recipient_class"], message["message_recipient"], message["message_time"],
+                        message["message_type"], payload, message["message_delivered"],
+                        message["message_flags"], message["message_conversation"], message.get("message_expires"),
+                        payload_packed)])
+
+                stored = await db.query(
                     """
-                        SELECT `message_recipient_class`, `message_recipient`, `message_payload`, 
-                            `message_flags`, `message_sender`, `message_type`
+                        SELECT `message_id`, `message_sender`, `message_recipient_class`, `message_recipient`,
+                            `message_type`, `message_delivered`
                         FROM `messages`
-                        WHERE `message_uuid`=%s AND `gamespace_id`=%s
-                        LIMIT 1
-                        FOR UPDATE;
-                    """, message_uuid, gamespace)
+                        WHERE `message_uuid` IN %s AND `gamespace_id`=%s;
+                    """, [message["message_uuid"] for message in messages], gamespace)
+
+                await self.messages_imported(db, gamespace, stored)
+                mailboxes = await self.app.quotas.stored(db, gamespace, [
+                    (message["message_recipient_class"], message["message_recipient"], message["message_type"])
+                    for message in stored
+                    if not message["message_delivered"]
+                ])
+            except DatabaseError as e:
+                await db.rollback()
+                raise MessageError(500, "Failed to store messages: " + e.args[1])
+            else:
+                await db.commit()
+                self.app.quotas.check(gamespace, mailboxes)
 
-                if message is None:
-                    raise MessageNotFound()
+        return len(stored)
 
-                # sender can always edit his message
-                if str(message["message_sender"]) != str(sender):
-                    flags = MessageFlags(message["message_flags"].lower().split(","))
+    async def __inbox_remove__(self, db, condition, *args, table="messages"):
+        """
+        Removes inbox entries (`i`) of messages (`m`) matching the condition, should be called
+            before messages themselves are deleted
+        """
 
-                    if MessageFlags.EDITABLE not in flags:
-                        raise MessageError(409, "This message is not editable")
+        await self.counters.inbox_removed(db, condition, *args, table=table)
+        await db.execute(
+            """
+                DELETE `i`
+                FROM `account_inbox` AS `i`
+                    INNER JOIN `{0}` AS `m` ON `m`.`message_id`=`i`.`message_id`
+                WHERE {1};
+            """.format(table, condition), *args)
 
-                message_recipient_class = message["message_recipient_class"]
-                message_recipient = message["message_recipient"]
-                message_payload = message["message_payload"]
-                message_type = message["message_type"]
+    async def inbox_group_joined(self, gamespace, account_id, recipient_class, recipient):
+        """
+        Backfills account's inbox with most recent messages of a group it has just joined
+        """
+        await self.inbox_group_joined_bulk(gamespace, [account_id], recipient_class, recipient)
+
+    async def inbox_group_joined_bulk(self, gamespace, accounts, recipient_class, recipient):
+        """
+        Same as inbox_group_joined, for a number of accounts that have just joined the same group (cluster),
+            in a single transaction
+        """
+        if not accounts:
+            return
+
+        try:
+            async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+                try:
+                    for account_id in accounts:
+                        added = await db.execute(
+                            """
+                                INSERT IGNORE INTO `account_inbox`
+                                (`gamespace_id`, `account_id`, `message_id`)
+                                SELECT `gamespace_id`, %s, `message_id`
+                                FROM `messages`
+                                WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                                ORDER BY `message_id` DESC
+                                LIMIT %s;
+                            """, account_id, gamespace, recipient_class, recipient, self.inbox_backfill_limit)
+
+                        await self.counters.inbox_added(db, gamespace, [account_id], amount=added)
+                        await self.summaries.recipient_joined(db, gamespace, account_id, recipient_class, recipient)
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to fill up account inbox: " + e.args[1])
+
+    async def inbox_group_left(self, gamespace, account_id, recipient_class, recipient):
+        """
+        Removes messages of a group an account has left from its inbox, except for the ones it has sent
+        """
+        await self.inbox_group_left_bulk(gamespace, [account_id], recipient_class, recipient)
+
+    async def inbox_group_left_bulk(self, gamespace, accounts, recipient_class, recipient):
+        """
+        Same as inbox_group_left, for a number of accounts that have just left the same group (cluster),
+            in a single transaction
+        """
+        if not accounts:
+            return
+
+        try:
+            async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+                try:
+                    await self.__inbox_remove__(
+                        db,
+                        """
+                            `i`.`gamespace_id`=%s AND `i`.`account_id` IN %s AND `m`.`message_recipient_class`=%s
+                                AND `m`.`message_recipient`=%s AND `m`.`message_sender`<>`i`.`account_id`
+                        """, gamespace, accounts, recipient_class, recipient)
+                    for account_id in accounts:
+                        await self.unread.drop(db, gamespace, account_id, recipient_class, recipient)
+                        await self.summaries.recipient_left(db, gamespace, account_id, recipient_class, recipient)
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to clean up account inbox: " + e.args[1])
+
+        self.__unread_changed__(gamespace, accounts)
+
+    def has_delete_account_event(self):
+        return True
+
+    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+        """
+        Deleting history of accounts may take a while, so it's done by a background job, see accounts_deleted_stages
+        """
+        await self.app.jobs.add(gamespace, MessagesHistoryModel.JOB_ACCOUNTS_DELETED, {
+            "accounts": [int(account) for account in accounts],
+            "gamespace_only": bool(gamespace_only)
+        })
+
+    def __messages_stage__(self, db, table, condition, args):
+        async def stage(checkpoint, limit):
+            return await self.delete_messages_after(db, condition, args, checkpoint, limit=limit, table=table)
+        return stage
+
+    @staticmethod
+    def __rows_stage__(db, table, condition, args, column, values):
+        """
+        Deletes rows matching the condition (a prefix to be followed by another one) for one value
+            of the column after another, in primary key order, so every chunk is an index range.
+            The checkpoint is the position of the value the previous chunk has stopped at.
+        """
+        key = ", ".join("`{0}`".format(name) for name in MessagesHistoryModel.ACCOUNT_ROWS_KEYS[table])
+
+        async def stage(checkpoint, limit):
+            deleted = 0
+            for position in range(checkpoint, len(values)):
+                try:
+                    deleted += await db.execute(
+                        """
+                            DELETE FROM `{0}`
+                            WHERE {1}`{2}`=%s
+                            ORDER BY {3}
+                            LIMIT %s;
+                        """.format(table, condition, column, key), *args, values[position], limit - deleted)
+                except DatabaseError as e:
+                    raise MessageError(500, "Failed to delete from {0}: {1}".format(table, e.args[1]))
+                if deleted >= limit:
+                    return deleted, position
+            return deleted, len(values)
+        return stage
+
+    def accounts_deleted_stages(self, gamespace, args):
+        accounts = args["accounts"]
+        gamespace_only = args["gamespace_only"]
+        recipients = [str(account) for account in accounts]
+
+        if gamespace_only:
+            scope, scope_args = "`gamespace_id`=%s AND ", [gamespace]
+            shards = [self.shards.gamespace_db(gamespace)]
+        else:
+            # accounts are deleted from every gamespace, wherever it's stored
+            scope, scope_args = "", []
+            shards = self.shards.all()
+
+        stages = []
+
+        for shard_db in shards:
+            for table in ["messages", "messages_archive"]:
+                stages.append(self.__messages_stage__(
+                    shard_db, table, scope + "`message_sender` IN %s", scope_args + [accounts]))
+                stages.append(self.__messages_stage__(
+                    shard_db, table, scope + "`message_recipient_class`=%s AND `message_recipient` IN %s",
+                    scope_args + [CLASS_USER, recipients]))
+
+            for table in ["account_inbox", "last_read_message", "message_unread", "conversation_summary"]:
+                stages.append(MessagesHistoryModel.__rows_stage__(
+                    shard_db, table, scope, scope_args, "account_id", accounts))
+
+            for table in ["conversation_summary", "message_mailbox"]:
+                stages.append(MessagesHistoryModel.__rows_stage__(
+                    shard_db, table, scope + "`recipient_class`=%s AND ", scope_args + [CLASS_USER],
+                    "recipient", recipients))
+
+            stages.append(self.__counters_deleted_stage__(shard_db, gamespace, accounts, gamespace_only))
+
+        return stages
+
+    def __counters_deleted_stage__(self, shard_db, gamespace, accounts, gamespace_only):
+        async def stage(checkpoint, limit):
+            try:
+                async with shard_db.acquire() as db:
+                    await self.counters.accounts_deleted(db, gamespace, accounts, gamespace_only)
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to delete counters: " + e.args[1])
+            return 0, 0
+        return stage
+
+    async def purge_group_messages(self, gamespace, group_class, group_key):
+        """
+        Deletes messages of a group and all of its clusters by a background job, see group_purged_stages
+        """
+        await self.app.jobs.add(gamespace, MessagesHistoryModel.JOB_GROUP_PURGED, {
+            "group_class": group_class,
+            "group_key": group_key
+        })
+
+    def group_purged_stages(self, gamespace, args):
+        group_class = args["group_class"]
+        group_key = args["group_key"]
+        # recipients of clusters look like <group key>-<cluster id>
+        clusters = group_key.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "-%"
+
+        condition = """
+            `gamespace_id`=%s AND `message_recipient_class`=%s AND
+                (`message_recipient`=%s OR `message_recipient` LIKE %s)
+        """
+        condition_args = [gamespace, group_class, group_key, clusters]
+        shard_db = self.shards.gamespace_db(gamespace)
+
+        stages = [
+            self.__messages_stage__(shard_db, table, condition, condition_args)
+            for table in ["messages", "messages_archive"]
+        ]
+
+        async def cleanup(checkpoint, limit):
+            try:
+                async with shard_db.acquire() as db:
+                    await self.counters.drop_recipient(db, gamespace, group_class, group_key)
+                    await self.counters.drop_recipient_like(db, gamespace, group_class, clusters)
+                    await self.summaries.recipient_removed(db, gamespace, group_class, group_key)
+                    await self.summaries.recipient_removed_like(db, gamespace, group_class, clusters)
+                    await MailboxQuotasModel.drop_mailboxes(db, gamespace, group_class, group_key)
+                    await MailboxQuotasModel.drop_mailboxes_like(db, gamespace, group_class, clusters)
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to clean up group messages: " + e.args[1])
+            return 0, 0
+
+        stages.append(cleanup)
+        return stages
+
+    async def recompress(self, gamespace):
+        """
+        Compresses large payloads of a gamespace stored before (or without) compression has been enabled,
+            by a background job, see recompress_stages
+        """
+        if not self.compression.threshold:
+            raise MessageError(400, "Payload compression is disabled")
+
+        return await self.app.jobs.add(gamespace, MessagesHistoryModel.JOB_RECOMPRESS, {
+            "threshold": self.compression.threshold
+        })
+
+    def recompress_stages(self, gamespace, args):
+        threshold = args["threshold"]
+
+        def stage(table):
+            async def recompress(checkpoint, limit):
+                try:
+                    async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+                        try:
+                            # only large payloads not compressed yet are fetched
+                            messages = await db.query(
+                                """
+                                    SELECT `message_id`,
+                                        IF(`message_payload_packed` IS NULL AND LENGTH(`message_payload`)>=%s,
+                                            `message_payload`, NULL) AS `message_payload`
+                                    FROM `{0}`
+                                    WHERE `gamespace_id`=%s AND `message_id`>%s
+                                    ORDER BY `message_id` ASC
+                                    LIMIT %s
+                                    FOR UPDATE;
+                                """.format(table), threshold, gamespace, checkpoint, limit)
+
+                            for message in messages:
+                                payload = message["message_payload"]
+                                if payload is None:
+                                    continue
+
+                                if not isinstance(payload, str):
+                                    payload = ujson.dumps(payload)
+
+                                payload, payload_packed = self.compression.pack(payload, threshold)
+                                if payload_packed is None:
+                                    continue
+
+                                await db.execute(
+                                    """
+                                        UPDATE `{0}`
+                                        SET `message_payload`=%s, `message_payload_packed`=%s
+                                        WHERE `message_id`=%s;
+                                    """.format(table), payload, payload_packed, message["message_id"])
+                        finally:
+                            await db.commit()
+                except DatabaseError as e:
+                    raise MessageError(500, "Failed to compress payloads: " + e.args[1])
+
+                if not messages:
+                    return 0, checkpoint
+
+                return len(messages), messages[-1]["message_id"]
+            return recompress
+
+        return [stage(table) for table in ["messages", "messages_archive"]]
+
+    async def compression_stats(self, gamespace):
+        """
+        Returns how many payloads of a gamespace are compressed, and how many bytes they take
+            compressed and originally, see PayloadCompression. Scans the whole gamespace.
+        """
+        stats = {
+            "messages": 0,
+            "packed": 0,
+            "original": 0
+        }
+
+        try:
+            async with self.read_db(gamespace).acquire() as db:
+                for table in ["messages", "messages_archive"]:
+                    row = await db.get(
+                        """
+                            SELECT COUNT(*) AS `messages`,
+                                IFNULL(SUM(LENGTH(`message_payload_packed`)), 0) AS `packed`,
+                                IFNULL(SUM(CONV(HEX(SUBSTRING(`message_payload_packed`, 2, 4)), 16, 10)), 0)
+                                    AS `original`
+                            FROM `{0}`
+                            WHERE `gamespace_id`=%s AND `message_payload_packed` IS NOT NULL;
+                        """.format(table), gamespace)
+
+                    for key in stats:
+                        stats[key] += int(row[key])
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to get compression stats: " + e.args[1])
+
+        return stats
+
+    async def delete_messages_after(self, shard_db, condition, args, last_message_id, limit=1000, table="messages"):
+        """
+        Deletes up to `limit` messages of a shard matching the condition with ids greater than `last_message_id`,
+            in id order and in a single short transaction.
+
+        :return: a (number of messages deleted, last id deleted) tuple, the caller is expected to repeat
+            from that id until it's less than the limit
+        """
+        try:
+            async with shard_db.acquire(auto_commit=False) as db:
+                try:
+                    messages = await db.query(
+                        """
+                            SELECT `gamespace_id`, `message_id`, `message_sender`,
+                                `message_recipient_class`, `message_recipient`, `message_type`, `message_delivered`
+                            FROM `{0}`
+                            WHERE {1} AND `message_id`>%s
+                            ORDER BY `message_id` ASC
+                            LIMIT %s
+                            FOR UPDATE;
+                        """.format(table, condition), *(tuple(args) + (last_message_id, limit)))
+
+                    if messages:
+                        await self.__messages_removed__(db, messages, table=table)
+                        await db.execute(
+                            """
+                                DELETE FROM `{0}`
+                                WHERE `message_id` IN %s;
+                            """.format(table), [message["message_id"] for message in messages])
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to delete messages: " + e.args[1])
+
+        if not messages:
+            return 0, last_message_id
+
+        self.__history_event__(RecentMessages.EVENT_CLEAR)
+        return len(messages), messages[-1]["message_id"]
+
+    def read_db(self, gamespace, primary=False):
+        """
+        Returns a database for reads of a gamespace that tolerate a bit of staleness, see ReplicaRouter.
+            Only the primary shard has a replica.
+        """
+        if self.shards.index(gamespace):
+            return self.shards.gamespace_db(gamespace)
+        return self.app.replica.read_db(primary)
+
+    def messages_query(self, gamespace, primary=False):
+        query = MessagesQuery(
+            gamespace, self.read_db(gamespace, primary), counters=self.counters,
+            primary_db=self.shards.gamespace_db(gamespace))
+        query.message_time_after = self.retention_cutoff
+        query.message_expires_after = datetime.datetime.utcnow()
+        query.archived = bool(self.archive_days)
+        query.recent = self.recent
+        return query
+
+    def query_plans(self):
+        """
+        Returns queries on the hot path as they're run, with indexes they're expected to use,
+            see MigrationsModel.check_query_plans
+        """
+        now = datetime.datetime.utcnow()
+        recipient_indexes = {"messages": ("recipient_delivered", "recipient_time")}
+        inbox_indexes = {"i": ("PRIMARY", "account_id"), "m": ("PRIMARY",)}
+
+        group_inbox = self.messages_query(1)
+        group_inbox.message_recipient_class = "group"
+        group_inbox.message_recipient = "0"
+        group_inbox.limit = 100
+
+        sent = self.messages_query(1)
+        sent.message_sender = 0
+        sent.limit = 100
+
+        return {
+            "group inbox": group_inbox.statement() + (recipient_indexes,),
+            "group inbox count": group_inbox.count_statement() + (recipient_indexes,),
+            "sent messages": sent.statement() + ({"messages": ("sender",)},),
+            "sent messages count": sent.count_statement() + ({"messages": ("sender",)},),
+            "incoming messages": self.__incoming_chunk_query__(1, CLASS_USER, "0", 0, self.drain_chunk_size) + (
+                {"messages": ("recipient_delivered",)},),
+            "account inbox": (
+                MessagesHistoryModel.ACCOUNT_INBOX_QUERY.format("messages"), (1, 0, now, 0, 100), inbox_indexes),
+            "account inbox count": (
+                MessagesHistoryModel.ACCOUNT_INBOX_COUNT.format("messages"), (1, 0, now), inbox_indexes),
+            "direct conversation": (
+                MessagesHistoryModel.CONVERSATION_QUERY.format("messages"), (1, "0:1", now, 0, 100),
+                {"messages": ("conversation",)}),
+            "direct conversation count": (
+                MessagesHistoryModel.CONVERSATION_COUNT.format("messages"), (1, "0:1", now),
+                {"messages": ("conversation",)}),
+            "message by uuid": (
+                MessagesHistoryModel.MESSAGE_QUERY.format("messages", MessagesHistoryModel.MESSAGE_BY_UUID), ("", 1),
+                {"messages": ("message_uuid",)}),
+            "message counter": (
+                MessageCounters.COUNTER_QUERY, (1, KIND_RECIPIENT, "group", "0"), {"message_counters": ("PRIMARY",)}),
+            "unread counters": (UnreadCounters.LIST_QUERY, (1, 0), {"message_unread": ("PRIMARY", "account_id")}),
+            "conversations": (
+                ConversationSummaries.LIST_QUERY.format(""), (1, 0, 0, 100),
+                {"conversation_summary": ("recent", "PRIMARY")}),
+        }
+
+    def __history_event__(self, event, gamespace=None, recipient_class=None, recipient=None, **data):
+        """
+        Applies a change of the history to caches of this process and broadcasts it to other processes.
+            Direct messages are never cached, so changes to them are not broadcast.
+        """
+        if recipient_class == CLASS_USER:
+            return
+
+        event = dict(data, event=event, gamespace=gamespace, recipient_class=recipient_class, recipient=recipient)
+
+        self.history_event_received(event)
+        self.app.message_queue.broadcast(event)
+
+    def __forget_messages__(self, gamespace, message_uuids=None):
+        """
+        Drops changed or removed messages from lookup caches of every process, direct messages included.
+            If no uuids are given, lookup caches are cleared altogether.
+        """
+        event = {
+            "event": MessageLookupCache.EVENT_FORGET,
+            "gamespace": gamespace,
+            "message_uuids": list(message_uuids) if message_uuids is not None else None
+        }
+
+        self.history_event_received(event)
+        self.app.message_queue.broadcast(event)
+
+    def history_event_received(self, event):
+        """
+        Applies a change of the history, made by this process or received from another one
+        """
+        action = event.get("event")
+
+        if action == RecentMessages.EVENT_CLEAR:
+            self.recent.clear()
+            self.lookup.clear()
+            return
+
+        if action == MessageLookupCache.EVENT_FORGET:
+            message_uuids = event.get("message_uuids")
+            if message_uuids is None:
+                self.lookup.clear()
+            else:
+                self.lookup.forget(event.get("gamespace"), message_uuids)
+            return
+
+        key = RecentMessages.key(event.get("gamespace"), event.get("recipient_class"), event.get("recipient"))
+
+        if action == RecentMessages.EVENT_NEW:
+            message = dict(event["message"])
+            for column in ["message_time", "message_expires"]:
+                if message.get(column) is not None:
+                    message[column] = datetime.datetime.strptime(
+                        message[column], MessagesHistoryModel.EVENT_TIME_FORMAT)
+            self.recent.message_added(key, MessageAdapter(message))
+        elif action == RecentMessages.EVENT_UPDATED:
+            self.recent.message_updated(key, event.get("message_uuid"), event.get("payload"))
+        elif action == RecentMessages.EVENT_INVALIDATE:
+            self.recent.invalidate(key)
+
+    def __time_condition__(self, column="`message_time`"):
+        """
+        Returns an extra condition (and its arguments) that skips messages expired by retention policies,
+            so time-partitioned table scans could skip expired partitions
+        """
+        if self.retention_cutoff is None:
+            return "", ()
+
+        return " AND {0}>=%s".format(column), (self.retention_cutoff,)
+
+    @staticmethod
+    def __expires_condition__(column="`message_expires`"):
+        """
+        Returns an extra condition (and its arguments) that skips messages past their time to live
+        """
+        return " AND ({0} IS NULL OR {0}>%s)".format(column), (datetime.datetime.utcnow(),)
+
+    async def __messages_removed__(self, db, messages, table="messages"):
+        """
+        Cleans up inboxes and counters of messages that are about to be removed, without removing
+            the messages themselves.
+
+        :param messages: a list of rows with `gamespace_id`, `message_id`, `message_sender`,
+            `message_recipient_class` and `message_recipient` columns. Rows that have `message_type`
+            and `message_delivered` too are counted off mailbox quotas if undelivered, while the drain
+            counts off the messages it removes itself.
+        """
+
+        if not messages:
+            return
+
+        by_gamespace = {}
+
+        for message in messages:
+            by_gamespace.setdefault(message["gamespace_id"], []).append(message)
+
+        for gamespace, gamespace_messages in by_gamespace.items():
+            await self.__inbox_remove__(
+                db, "`i`.`gamespace_id`=%s AND `m`.`message_id` IN %s", gamespace,
+                [message["message_id"] for message in gamespace_messages], table=table)
+
+            await self.summaries.messages_removed(db, gamespace, gamespace_messages)
+            await self.counters.messages_removed(db, gamespace, [
+                (message["message_sender"], message["message_recipient_class"], message["message_recipient"])
+                for message in gamespace_messages
+            ])
+            await self.app.quotas.delivered(db, gamespace, [
+                (message["message_recipient_class"], message["message_recipient"], message["message_type"])
+                for message in gamespace_messages
+                if "message_delivered" in message and not message["message_delivered"]
+            ])
+
+    async def expire_messages(self, shard_db, condition, args, before, limit=1000, table="messages"):
+        """
+        Deletes up to `limit` oldest messages of a shard matching the condition that are older than `before`,
+            in a single short transaction.
+
+        :return: a number of messages deleted, the caller is expected to repeat
+            until it's less than the limit
+        """
+        try:
+            async with shard_db.acquire(auto_commit=False) as db:
+                try:
+                    messages = await db.query(
+                        """
+                            SELECT `gamespace_id`, `message_id`, `message_sender`,
+                                `message_recipient_class`, `message_recipient`, `message_type`, `message_delivered`
+                            FROM `{0}`
+                            WHERE {1} AND `message_time`<%s
+                            ORDER BY `message_time` ASC
+                            LIMIT %s
+                            FOR UPDATE;
+                        """.format(table, condition), *(tuple(args) + (before, limit)))
+
+                    if messages:
+                        await self.__messages_removed__(db, messages, table=table)
+                        await db.execute(
+                            """
+                                DELETE FROM `{0}`
+                                WHERE `message_id` IN %s;
+                            """.format(table), [message["message_id"] for message in messages])
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to expire messages: " + e.args[1])
+
+        if messages:
+            self.__history_event__(RecentMessages.EVENT_CLEAR)
+
+        return len(messages)
+
+    async def sweep_expired_messages(self, shard_db, now, moving=None, limit=1000, table="messages"):
+        """
+        Deletes up to `limit` messages of a shard past their time to live by `now`, soonest expired first
+            (so it's a range scan of the `expires` index), in a single short transaction.
+
+        :param moving: a list of gamespaces to leave alone, see ShardRouter.list_moving
+        :return: a number of messages deleted, the caller is expected to repeat
+            until it's less than the limit
+        """
+        condition, args = "`message_expires`<%s", [now]
+
+        if moving:
+            condition, args = condition + " AND `gamespace_id` NOT IN %s", args + [moving]
+
+        try:
+            async with shard_db.acquire(auto_commit=False) as db:
+                try:
+                    messages = await db.query(
+                        """
+                            SELECT `gamespace_id`, `message_id`, `message_uuid`, `message_sender`,
+                                `message_recipient_class`, `message_recipient`, `message_type`, `message_delivered`
+                            FROM `{0}`
+                            WHERE {1}
+                            ORDER BY `message_expires` ASC
+                            LIMIT %s
+                            FOR UPDATE;
+                        """.format(table, condition), *(args + [limit]))
+
+                    if messages:
+                        await self.__messages_removed__(db, messages, table=table)
+                        await db.execute(
+                            """
+                                DELETE FROM `{0}`
+                                WHERE `message_id` IN %s;
+                            """.format(table), [message["message_id"] for message in messages])
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to sweep expired messages: " + e.args[1])
+
+        if messages:
+            self.__history_event__(RecentMessages.EVENT_CLEAR)
+
+            by_gamespace = {}
+            for message in messages:
+                by_gamespace.setdefault(message["gamespace_id"], []).append(message["message_uuid"])
+
+            for gamespace, message_uuids in by_gamespace.items():
+                self.__forget_messages__(gamespace, message_uuids)
+
+        return len(messages)
+
+    async def archive_gamespace_messages(self, gamespace, before, limit=1000):
+        """
+        Moves up to `limit` oldest delivered messages of a gamespace that are older than `before`
+            into `messages_archive`. Inbox entries and counters are left intact, as archived messages
+            are still a part of the history.
+
+        :return: a number of messages archived, the caller is expected to repeat
+            until it's less than the limit
+        """
+        try:
+            async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+                try:
+                    messages = await db.query(
+                        """
+                            SELECT `message_id`
+                            FROM `messages`
+                            WHERE `gamespace_id`=%s AND `message_time`<%s AND `message_delivered`=1
+                            ORDER BY `message_time` ASC
+                            LIMIT %s
+                            FOR UPDATE;
+                        """, gamespace, before, limit)
+
+                    if messages:
+                        message_ids = [message["message_id"] for message in messages]
+
+                        await db.execute(
+                            """
+                                INSERT IGNORE INTO `messages_archive`
+                                ({0})
+                                SELECT {0}
+                                FROM `messages`
+                                WHERE `message_id` IN %s;
+                            """.format(MessagesHistoryModel.COLUMNS), message_ids)
+                        await db.execute(
+                            """
+                                DELETE FROM `messages`
+                                WHERE `message_id` IN %s;
+                            """, message_ids)
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to archive messages: " + e.args[1])
+
+        return len(messages)
+
+    async def archive_messages(self, limit=1000, max_batches=100):
+        """
+        Moves delivered messages older than archive_days into `messages_archive`, gamespace by gamespace
+        """
+        if not self.archive_days:
+            return
+
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=self.archive_days)
+
+        for index, shard_db in enumerate(self.shards.all()):
+            try:
+                gamespaces = await shard_db.query(
+                    """
+                        SELECT DISTINCT `gamespace_id`
+                        FROM `messages`;
+                    """)
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to archive messages: " + e.args[1])
+
+            for gamespace in gamespaces:
+                # leftovers of a move, or a gamespace being moved
+                if not self.shards.owns(index, gamespace["gamespace_id"]):
+                    continue
+
+                for batch in range(0, max_batches):
+                    archived = await self.archive_gamespace_messages(gamespace["gamespace_id"], before, limit=limit)
+                    if archived < limit:
+                        break
+
+    async def __rehydrate__(self, db, condition, *args):
+        """
+        Moves archived messages matching the condition back into `messages`, so they could be
+            updated or deleted in place. Returns True if there were any.
+        """
+        if not self.archive_days:
+            return False
+
+        restored = await db.execute(
+            """
+                INSERT IGNORE INTO `messages`
+                ({0})
+                SELECT {0}
+                FROM `messages_archive`
+                WHERE {1};
+            """.format(MessagesHistoryModel.COLUMNS, condition), *args)
+
+        if not restored:
+            return False
+
+        await db.execute(
+            """
+                DELETE FROM `messages_archive`
+                WHERE {0};
+            """.format(condition), *args)
+
+        return True
+
+    async def partition_expiring(self, shard_db, partition, limit=1000):
+        """
+        Cleans up inboxes and counters of every message in a partition of `messages` of a shard that
+            is about to be dropped, chunk by chunk
+        """
+        last_message_id = 0
+
+        while True:
+            try:
+                async with shard_db.acquire(auto_commit=False) as db:
+                    try:
+                        messages = await db.query(
+                            """
+                                SELECT `gamespace_id`, `message_id`, `message_sender`, `message_recipient_class`,
+                                    `message_recipient`, `message_type`, `message_delivered`
+                                FROM `messages` PARTITION (`{0}`)
+                                WHERE `message_id`>%s
+                                ORDER BY `message_id` ASC
+                                LIMIT %s;
+                            """.format(partition), last_message_id, limit)
+
+                        await self.__messages_removed__(db, messages)
+                    finally:
+                        await db.commit()
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to clean up expiring messages: " + e.args[1])
+
+            if len(messages) < limit:
+                self.__history_event__(RecentMessages.EVENT_CLEAR)
+                return
+
+            last_message_id = messages[-1]["message_id"]
+
+    @staticmethod
+    async def __uuid_exists__(db, gamespace, message_uuid):
+        """
+        Looks for a message with the uuid, locking the range of the uuid key so the same uuid could not
+            be stored concurrently until the transaction is over
+        """
+        existing = await db.get(
+            """
+                SELECT `message_id`
+                FROM `messages`
+                WHERE `message_uuid`=%s AND `gamespace_id`=%s
+                LIMIT 1
+                FOR UPDATE;
+            """, message_uuid, gamespace)
+
+        return existing is not None
+
+    @validate(gamespace="int", sender="int", message_uuid="str", recipient_class="str",
+              recipient_key="str", time="datetime", message_type="str", payload="json",
+              flags=MessageFlags, delivered="bool", ttl="int")
+    async def add_message(self, gamespace, sender, message_uuid, recipient_class, recipient_key, time,
+                          message_type, payload, flags, delivered=False, ttl=0):
+        """
+        :param ttl: if positive, the message expires in that many seconds since its time, see MessageExpirySweeper
+        """
+
+        if not isinstance(payload, dict):
+            raise MessageError(400, "payload should be a dict")
+
+        if ttl < 0:
+            raise MessageError(400, "ttl should not be negative")
+
+        # times are naive UTC, the same as in rows read from the database (and cached, see MessageLookupCache)
+        if time.tzinfo is not None:
+            time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        expires = time + datetime.timedelta(seconds=ttl) if ttl else None
+
+        # direct messages are keyed by both accounts, so a conversation could be read with a single range scan
+        conversation = conversation_key(sender, recipient_key) if recipient_class == CLASS_USER else None
+        payload_json = ujson.dumps(payload)
+        stored_payload, payload_packed = self.compression.pack(payload_json)
+
+        async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+            try:
+                if self.uuids_partitioned and await self.__uuid_exists__(db, gamespace, message_uuid):
+                    await db.rollback()
+                    raise MessageError(400, "Message with that ID already exists")
+
+                message_id = await db.insert(
+                    """
+                        INSERT INTO `messages`
+                        (`gamespace_id`, `message_uuid`, `message_recipient_class`, `message_sender`,
+                            `message_recipient`, `message_time`, `message_type`, `message_payload`,
+                            `message_delivered`, `message_flags`, `message_conversation`, `message_expires`,
+                            `message_payload_packed`)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+                    """, gamespace, message_uuid, recipient_class, sender,
+                    recipient_key, time, message_type, stored_payload, int(delivered), flags.dump(),
+                    conversation, expires, payload_packed)
+
+                await self.counters.message_added(db, gamespace, sender, recipient_class, recipient_key)
+                await self.__inbox_fan_out__(db, gamespace, message_id, sender, recipient_class, recipient_key)
+
+                mailboxes = [] if delivered else await self.app.quotas.stored(
+                    db, gamespace, [(recipient_class, recipient_key, message_type)])
+            except DuplicateError:
+                await db.rollback()
+                raise MessageError(400, "Message with that ID already exists")
+            except DatabaseError as e:
+                await db.rollback()
+                raise MessageError(500, "Failed to add message: " + e.args[1])
+            else:
+                await db.commit()
+                self.app.quotas.check(gamespace, mailboxes)
+
+                self.__history_event__(
+                    RecentMessages.EVENT_NEW, gamespace, recipient_class, recipient_key, message={
+                        "message_id": message_id,
+                        "message_uuid": message_uuid,
+                        "message_sender": sender,
+                        "message_recipient_class": recipient_class,
+                        "message_recipient": recipient_key,
+                        "message_time": time.strftime(MessagesHistoryModel.EVENT_TIME_FORMAT),
+                        "message_type": message_type,
+                        "message_payload": payload,
+                        "message_delivered": int(delivered),
+                        "message_flags": flags.dump(),
+                        "message_expires": expires.strftime(MessagesHistoryModel.EVENT_TIME_FORMAT) if expires else None
+                    })
+
+                # a fresh message is likely to be looked up right away
+                self.lookup.put(gamespace, {
+                    "message_id": message_id,
+                    "message_uuid": message_uuid,
+                    "message_sender": sender,
+                    "message_recipient_class": recipient_class,
+                    "message_recipient": recipient_key,
+                    "message_time": time,
+                    "message_type": message_type,
+                    "message_payload": payload_json,
+                    "message_delivered": int(delivered),
+                    "message_flags": flags.dump(),
+                    "message_expires": expires
+                })
+
+                return message_id
+
+    async def __get_message__(self, db, condition, *args):
+        """
+        Looks up a single message in `messages`, falling through to `messages_archive`
+        """
+        query = MessagesHistoryModel.MESSAGE_QUERY
+
+        message = await db.get(query.format("messages", condition), *args)
+
+        if not message and self.archive_days:
+            message = await db.get(query.format("messages_archive", condition), *args)
+
+        return message
+
+    async def get_message(self, gamespace, message_id):
+        try:
+            message = await self.__get_message__(
+                self.shards.gamespace_db(gamespace), "`message_id`=%s AND `gamespace_id`=%s", message_id, gamespace)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to get a message: " + e.args[1])
+
+        if not message:
+            raise MessageNotFound()
+
+        return MessageAdapter(message)
+
+    async def list_incoming_messages(self, gamespace, recipient_class, recipient, limit=100):
+        time_condition, time_args = self.__time_condition__()
+        expires_condition, expires_args = MessagesHistoryModel.__expires_condition__()
+
+        try:
+            messages = await self.shards.gamespace_db(gamespace).query(
+                """
+                    SELECT *
+                    FROM `messages`
+                    WHERE `message_recipient_class`=%s AND `message_recipient`=%s AND `gamespace_id`=%s{0}{1}
+                    ORDER BY `message_time` DESC
+                    LIMIT %s;
+                """.format(time_condition, expires_condition), recipient_class, recipient, gamespace,
+                *(time_args + expires_args + (limit,)))
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list incoming messages: " + e.args[1])
+
+        return list(map(MessageAdapter, messages))
+
+    @validate(gamespace="int", account_id="int", limit="int", offset="int")
+    async def list_messages_account_with_count(self, gamespace, account_id, limit=100, offset=0, count_mode=None,
+                                               primary=False):
+        async with self.read_db(gamespace, primary).acquire() as db:
+            result = await self.list_messages_account_with_count_db(
+                gamespace, account_id, db, limit, offset, count_mode=count_mode)
+            return result
+
+    @validate(gamespace="int", account_id="int", limit="int", offset="int")
+    async def list_messages_account_with_count_db(self, gamespace, account_id, db, limit=100, offset=0,
+                                                  count_mode=None):
+        messages = await self.list_messages_account(gamespace, account_id, limit, offset, db=db)
+        count_result = await self.count_messages_account(gamespace, account_id, count_mode=count_mode, db=db)
+        return messages, count_result
+
+    @validate(gamespace="int", account_id="int")
+    async def count_messages_account(self, gamespace, account_id, count_mode=None, db=None):
+        """
+        Returns total count of messages list_messages_account would list, or None if counts are omitted
+        """
+
+        db = db or self.read_db(gamespace)
+
+        async def counter():
+            return await self.counters.get(gamespace, KIND_ACCOUNT, CLASS_USER, str(account_id), db=db)
+
+        async def approximate():
+            return await self.counters.estimate_rows(
+                """
+                    SELECT `message_id`
+                    FROM `account_inbox`
+                    WHERE `gamespace_id`=%s AND `account_id`=%s;
+                """, gamespace, account_id, db=db)
+
+        return await self.counters.count(
+            ("account", gamespace, account_id), count_mode, exact=counter, approximate=approximate)
+
+    @validate(gamespace="int", account_id="int", recipient_account_id="int", limit="int", offset="int")
+    async def list_messages_recipient_count(self, gamespace, account_id, recipient_account_id, limit=100, offset=0,
+                                            count_mode=None, primary=False):
+
+        """
+        Returns messages that were sent between account_id and recipient_account_id
+        """
+
+        if limit < 1 or limit > 10000 or offset < 0 or offset > 10000:
+            raise MessageError(400, "Bad limit/offset")
+
+        conversation = conversation_key(account_id, recipient_account_id)
+
+        if conversation is None:
+            raise MessageError(400, "Bad recipient")
+
+        query = MessagesHistoryModel.CONVERSATION_QUERY
+        args = (gamespace, conversation, datetime.datetime.utcnow())
+
+        db = self.read_db(gamespace, primary)
+
+        try:
+            messages = list(await db.query(query.format("messages"), *(args + (offset, limit))))
+
+            if self.archive_days:
+                messages += await list_archived(
+                    db, query, MessagesHistoryModel.CONVERSATION_COUNT, args, offset, limit, len(messages))
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list incoming messages for account: " + e.args[1])
+
+        async def counter():
+            return await self.counters.get(gamespace, KIND_CONVERSATION, CLASS_USER, conversation)
+
+        count_result = await self.counters.count(
+            ("conversation", gamespace, conversation), count_mode, exact=counter)
+
+        return list(map(MessageAdapter, messages)), count_result
+
+    @validate(gamespace="int", account_id="int", limit="int", offset="int")
+    async def list_messages_account(self, gamespace, account_id, limit=100, offset=0, db=None, primary=False):
+        """
+        Returns last N..M (offset to limit) messages being sent or received by the account,
+            including the ones being sent to the groups the account participates in.
+        """
+
+        if limit < 1 or limit > 10000 or offset < 0 or offset > 10000:
+            raise MessageError(400, "Bad limit/offset")
+
+        db = db or self.read_db(gamespace, primary)
+
+        query = MessagesHistoryModel.ACCOUNT_INBOX_QUERY
+        args = (gamespace, account_id, datetime.datetime.utcnow())
+
+        try:
+            messages = list(await db.query(query.format("messages"), *(args + (offset, limit))))
+
+            if self.archive_days:
+                messages += await list_archived(
+                    db, query, MessagesHistoryModel.ACCOUNT_INBOX_COUNT, args, offset, limit, len(messages))
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list incoming messages for account: " + e.args[1])
+
+        return list(map(MessageAdapter, messages))
+
+    async def read_incoming_messages(self, gamespace, recipient_class, recipient, receiver):
+        """
+        Delivers undelivered messages of a recipient to the receiver, in chunks by ascending message id.
+
+        Rows are never locked while the receiver is being awaited: every message of a chunk is passed to
+            the receiver at once (so websocket sends are pipelined), and only once they're all done
+            the received ones are marked as delivered (or removed) in a short transaction.
+            If the receiver fails to receive a message (the socket has dropped), the drain stops,
+            and the rest is drained on the next call, starting from the first message not delivered.
+
+        :param receiver: a function that takes a MessageAdapter, and returns a future resolved with True
+            if the message has been received
+        """
+
+        last_message_id = 0
+
+        while True:
+            messages = await self.__read_incoming_chunk__(
+                gamespace, recipient_class, recipient, last_message_id, self.drain_chunk_size)
+
+            if not messages:
+                return
+
+            received = await multi([receiver(message) for message in messages])
+
+            delivered_ids = []
+            remove_ids = []
+            drained_types = []
+
+            for message, recv in zip(messages, received):
+                if not recv:
+                    continue
+
+                drained_types.append(message.message_type)
+
+                if MessageFlags.REMOVE_DELIVERED in message.flags:
+                    remove_ids.append(message.message_id)
+                else:
+                    delivered_ids.append(message.message_id)
+
+            await self.__mark_incoming_delivered__(
+                gamespace, recipient_class, recipient, delivered_ids, remove_ids, drained_types)
+
+            if not all(received) or len(messages) < self.drain_chunk_size:
+                return
+
+            last_message_id = messages[-1].message_id
+
+    def __incoming_chunk_query__(self, gamespace, recipient_class, recipient, last_message_id, limit):
+        time_condition, time_args = self.__time_condition__()
+        # expired messages are left undelivered for the sweeper
+        expires_condition, expires_args = MessagesHistoryModel.__expires_condition__()
+
+        query = """
+            SELECT *
+            FROM `messages`
+            WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                AND `message_delivered`=0 AND `message_id`>%s{0}{1}
+            ORDER BY `message_id` ASC
+            LIMIT %s;
+        """.format(time_condition, expires_condition)
+
+        return query, (gamespace, recipient_class, recipient, last_message_id) + time_args + expires_args + (limit,)
+
+    async def __read_incoming_chunk__(self, gamespace, recipient_class, recipient, last_message_id, limit):
+        query, args = self.__incoming_chunk_query__(gamespace, recipient_class, recipient, last_message_id, limit)
+
+        try:
+            messages = await self.shards.gamespace_db(gamespace).query(query, *args)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to read incoming messages: " + e.args[1])
+
+        return list(map(MessageAdapter, messages))
+
+    async def __mark_incoming_delivered__(self, gamespace, recipient_class, recipient, delivered_ids, remove_ids,
+                                          drained_types=()):
+        """
+        :param drained_types: message types of every message delivered or removed, for mailbox quotas
+        """
+        if not delivered_ids and not remove_ids:
+            return
+
+        try:
+            async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+                try:
+                    if delivered_ids:
+                        await db.execute(
+                            """
+                                UPDATE `messages`
+                                SET `message_delivered`=1
+                                WHERE `gamespace_id`=%s AND `message_id` IN %s;
+                            """, gamespace, delivered_ids)
+
+                    if remove_ids:
+                        # the same messages could be drained by another connection in the meantime
+                        removed = await db.query(
+                            """
+                                SELECT `gamespace_id`, `message_id`, `message_uuid`, `message_sender`,
+                                    `message_recipient_class`, `message_recipient`
+                                FROM `messages`
+                                WHERE `gamespace_id`=%s AND `message_id` IN %s
+                                FOR UPDATE;
+                            """, gamespace, remove_ids)
+
+                        if removed:
+                            await self.__messages_removed__(db, removed)
+                            await db.execute(
+                                """
+                                    DELETE FROM `messages`
+                                    WHERE `gamespace_id`=%s AND `message_id` IN %s;
+                                """, gamespace, [message["message_id"] for message in removed])
+
+                    await self.app.quotas.delivered(db, gamespace, [
+                        (recipient_class, recipient, message_type)
+                        for message_type in drained_types
+                    ])
+                finally:
+                    await db.commit()
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to mark incoming messages as delivered: " + e.args[1])
+
+        if remove_ids:
+            self.__history_event__(RecentMessages.EVENT_INVALIDATE, gamespace, recipient_class, recipient)
+
+            if removed:
+                self.__forget_messages__(gamespace, [message["message_uuid"] for message in removed])
+
+    async def delete_messages(self, gamespace, recipient_class, recipient):
+        try:
+            async with self.shards.gamespace_db(gamespace, write=True).acquire() as db:
+                for table in ["messages", "messages_archive"]:
+                    await self.__inbox_remove__(
+                        db, "`m`.`message_recipient_class`=%s AND `m`.`message_recipient`=%s "
+                            "AND `m`.`gamespace_id`=%s", recipient_class, recipient, gamespace, table=table)
+                    await db.execute(
+                        """
+                            DELETE FROM `{0}`
+                            WHERE `message_recipient_class`=%s AND `message_recipient`=%s AND `gamespace_id`=%s;
+                        """.format(table), recipient_class, recipient, gamespace)
+                await self.counters.drop_recipient(db, gamespace, recipient_class, recipient)
+                await self.summaries.recipient_removed(db, gamespace, recipient_class, recipient)
+                await MailboxQuotasModel.drop_mailboxes(db, gamespace, recipient_class, recipient)
+
+            self.__history_event__(RecentMessages.EVENT_INVALIDATE, gamespace, recipient_class, recipient)
+            self.__forget_messages__(gamespace)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to delete messages: " + e.args[1])
+
+    async def delete_messages_like(self, gamespace, recipient_class, recipient_like):
+        try:
+            async with self.shards.gamespace_db(gamespace, write=True).acquire() as db:
+                for table in ["messages", "messages_archive"]:
+                    await self.__inbox_remove__(
+                        db, "`m`.`message_recipient_class`=%s AND `m`.`message_recipient` LIKE %s "
+                            "AND `m`.`gamespace_id`=%s", recipient_class, recipient_like, gamespace, table=table)
+                    await db.execute(
+                        """
+                            DELETE FROM `{0}`
+                            WHERE `message_recipient_class`=%s AND `message_recipient` LIKE %s AND `gamespace_id`=%s;
+                        """.format(table), recipient_class, recipient_like, gamespace)
+                await self.counters.drop_recipient_like(db, gamespace, recipient_class, recipient_like)
+                await self.summaries.recipient_removed_like(db, gamespace, recipient_class, recipient_like)
+                await MailboxQuotasModel.drop_mailboxes_like(db, gamespace, recipient_class, recipient_like)
+
+            self.__history_event__(RecentMessages.EVENT_CLEAR)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to delete messages: " + e.args[1])
+
+    async def delete_message(self, gamespace, message_id):
+        async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+            try:
+                query = """
+                    SELECT `message_uuid`, `message_sender`, `message_recipient_class`, `message_recipient`,
+                        `message_type`, `message_delivered`
+                    FROM `messages`
+                    WHERE `message_id`=%s AND `gamespace_id`=%s
+                    FOR UPDATE;
+                """
+
+                message = await db.get(query, message_id, gamespace)
+
+                if message is None and await self.__rehydrate__(
+                        db, "`message_id`=%s AND `gamespace_id`=%s", message_id, gamespace):
+                    message = await db.get(query, message_id, gamespace)
+
+                if message is None:
+                    return
+
+                await self.__inbox_remove__(
+                    db, "`i`.`gamespace_id`=%s AND `m`.`message_id`=%s", gamespace, message_id)
+
+                await db.execute(
+                    """
+                        DELETE FROM `messages`
+                        WHERE `message_id`=%s AND `gamespace_id`=%s;
+                    """, message_id, gamespace)
+
+                await self.summaries.messages_removed(db, gamespace, [dict(message, message_id=message_id)])
+                await self.counters.messages_removed(db, gamespace, [
+                    (message["message_sender"], message["message_recipient_class"], message["message_recipient"])
+                ])
+
+                if not message["message_delivered"]:
+                    await self.app.quotas.delivered(db, gamespace, [
+                        (message["message_recipient_class"], message["message_recipient"], message["message_type"])
+                    ])
+
+                self.__history_event__(
+                    RecentMessages.EVENT_INVALIDATE, gamespace,
+                    message["message_recipient_class"], message["message_recipient"])
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to delete a message: " + e.args[1])
+            finally:
+                await db.commit()
+
+        if message is not None:
+            self.__forget_messages__(gamespace, [message["message_uuid"]])
+
+    def __check_cached_permission__(self, gamespace, sender, message_uuid, flag, error):
+        """
+        Rejects a change of a message the sender is not allowed to make without going to the database,
+            if the message is cached. Senders and flags never change, so a cached row is good enough for that.
+        """
+        message = self.lookup.get(gamespace, message_uuid)
+
+        if message is None or str(message["message_sender"]) == str(sender):
+            return
+
+        if flag not in MessageFlags((message["message_flags"] or "").lower().split(",")):
+            raise MessageError(409, error)
+
+    async def delete_message_concurrent(self, gamespace, sender, message_uuid):
+        self.__check_cached_permission__(
+            gamespace, sender, message_uuid, MessageFlags.DELETABLE, "This message is not deletable")
+
+        async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+            try:
+                query = """
+                    SELECT `message_id`, `message_recipient_class`, `message_recipient`, `message_flags`,
+                        `message_sender`, `message_type`, `message_delivered`
+                    FROM `messages`
+                    WHERE `message_uuid`=%s AND `gamespace_id`=%s
+                    LIMIT 1
+                    FOR UPDATE;
+                """
+
+                message = await db.get(query, message_uuid, gamespace)
+
+                if message is None and await self.__rehydrate__(
+                        db, "`message_uuid`=%s AND `gamespace_id`=%s", message_uuid, gamespace):
+                    message = await db.get(query, message_uuid, gamespace)
+
+                if message is None:
+                    raise MessageNotFound()
+
+                # sender can always delete his message
+                if str(message["message_sender"]) != str(sender):
+                    flags = MessageFlags(message["message_flags"].lower().split(","))
+
+                    if MessageFlags.DELETABLE not in flags:
+                        raise MessageError(409, "This message is not deletable")
+
+                message_recipient_class = message["message_recipient_class"]
+                message_recipient = message["message_recipient"]
+                message_type = message["message_type"]
+
+                await self.__inbox_remove__(
+                    db, "`i`.`gamespace_id`=%s AND `m`.`message_id`=%s", gamespace, message["message_id"])
+
+                await db.execute(
+                    """
+                        DELETE FROM `messages`
+                        WHERE `message_uuid`=%s AND `gamespace_id`=%s
+                        LIMIT 1;
+                    """, message_uuid, gamespace)
+
+                await self.summaries.messages_removed(db, gamespace, [message])
+                await self.counters.messages_removed(db, gamespace, [
+                    (message["message_sender"], message_recipient_class, message_recipient)
+                ])
+
+                if not message["message_delivered"]:
+                    await self.app.quotas.delivered(db, gamespace, [
+                        (message_recipient_class, message_recipient, message_type)
+                    ])
+
+                # recipients are notified once the change is committed, see MessageOutbox
+                await self.outbox.add(db, gamespace, MessagesQueueModel.deleted_message(
+                    gamespace, sender, message_type, message_recipient_class, message_recipient, message_uuid))
+
+                self.__history_event__(
+                    RecentMessages.EVENT_INVALIDATE, gamespace, message_recipient_class, message_recipient)
+
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to delete a message: " + e.args[1])
+            finally:
+                await db.commit()
+
+        self.__forget_messages__(gamespace, [message_uuid])
+        self.outbox.notify()
+
+    async def __update_message_in_place__(self, gamespace, sender, message_uuid, compiled):
+        """
+        Updates a message with a single statement, see PayloadUpdate. Returns False if the message hasn't
+            been updated for whatever reason (not found, archived, not editable, compressed, or the update would
+            behave differently than a Python merge), so the caller should fall back to the regular way.
+        """
+
+        expression, expression_args = compiled.expression()
+        condition, condition_args = compiled.condition()
+
+        async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+            try:
+                updated = await db.execute(
+                    """
+                        UPDATE `messages`
+                        SET `message_payload`={0}
+                        WHERE `message_uuid`=%s AND `gamespace_id`=%s
+                            AND (`message_sender`=%s OR FIND_IN_SET(%s, `message_flags`))
+                            AND `message_payload_packed` IS NULL AND {1}
+                        LIMIT 1;
+                    """.format(expression, condition), *expression_args, message_uuid, gamespace,
+                    sender, MessageFlags.EDITABLE, *condition_args)
+
+                if not updated:
+                    await db.rollback()
+                    return False
+
+                message = await db.get(
+                    """
+                        SELECT `message_id`, `message_recipient_class`, `message_recipient`,
+                            `message_type`, `message_payload`
+                        FROM `messages`
+                        WHERE `message_uuid`=%s AND `gamespace_id`=%s
+                        LIMIT 1;
+                    """, message_uuid, gamespace)
+
+                payload = message["message_payload"]
+                if isinstance(payload, str):
+                    payload = ujson.loads(payload)
+
+                await self.summaries.message_updated(db, gamespace, message["message_id"], payload)
+
+                await self.outbox.add(db, gamespace, MessagesQueueModel.updated_message(
+                    gamespace, sender, message["message_type"], message["message_recipient_class"],
+                    message["message_recipient"], message_uuid, payload))
+            except DatabaseError as e:
+                await db.rollback()
+                raise MessageError(500, "Failed to update a message: " + e.args[1])
+            else:
+                await db.commit()
+
+        self.__history_event__(
+            RecentMessages.EVENT_UPDATED, gamespace, message["message_recipient_class"],
+            message["message_recipient"], message_uuid=message_uuid, payload=payload)
+
+        self.__forget_messages__(gamespace, [message_uuid])
+        self.outbox.notify()
+        return True
+
+    async def update_message_concurrent(self, gamespace, sender, message_uuid, update):
+        self.__check_cached_permission__(
+            gamespace, sender, message_uuid, MessageFlags.EDITABLE, "This message is not editable")
+
+        # common updates (fields set, removed or incremented) are applied in place with a single statement
+        compiled = PayloadUpdate.compile(update)
+
+        if compiled is not None and await self.__update_message_in_place__(
+                gamespace, sender, message_uuid, compiled):
+            return
+
+        async with self.shards.gamespace_db(gamespace, write=True).acquire(auto_commit=False) as db:
+            try:
+                query = """
+                    SELECT `message_id`, `message_recipient_class`, `message_recipient`, `message_payload`,
+                        `message_payload_packed`, `message_flags`, `message_sender`, `message_type`
+                    FROM `messages`
+                    WHERE `message_uuid`=%s AND `gamespace_id`=%s
+                    LIMIT 1
+                    FOR UPDATE;
+                """
+
+                message = await db.get(query, message_uuid, gamespace)
+
+                if message is None and await self.__rehydrate__(
+                        db, "`message_uuid`=%s AND `gamespace_id`=%s", message_uuid, gamespace):
+                    message = await db.get(query, message_uuid, gamespace)
+
+                if message is None:
+                    raise MessageNotFound()
+
+                # sender can always edit his message
+                if str(message["message_sender"]) != str(sender):
+                    flags = MessageFlags(message["message_flags"].lower().split(","))
+
+                    if MessageFlags.EDITABLE not in flags:
+                        raise MessageError(409, "This message is not editable")
+
+                message_recipient_class = message["message_recipient_class"]
+                message_recipient = message["message_recipient"]
+                message_payload = message["message_payload"]
+                message_type = message["message_type"]
+
+                if message["message_payload_packed"] is not None:
+                    message_payload = ujson.loads(PayloadCompression.unpack(message["message_payload_packed"]))
 
                 try:
                     updated = Profile.merge_data(message_payload, update, None, merge=True)
                 except ProfileError as e:
                     raise MessageError(400, e.message)
 
-                await self.app.message_queue.update_message(
-                    gamespace, sender, message_type, message_recipient_class,
-                    message_recipient, message_uuid, updated)
-
                 await db.execute(
                     """
                         UPDATE `messages`
-                        SET `message_payload`=%s
+                        SET `message_payload`=%s, `message_payload_packed`=%s
                         WHERE `message_uuid`=%s AND `gamespace_id`=%s
                         LIMIT 1;
-                    """, ujson.dumps(updated), message_uuid, gamespace)
+                    """, *self.compression.pack(ujson.dumps(updated)), message_uuid, gamespace)
+
+                await self.summaries.message_updated(db, gamespace, message["message_id"], updated)
+
+                await self.outbox.add(db, gamespace, MessagesQueueModel.updated_message(
+                    gamespace, sender, message_type, message_recipient_class,
+                    message_recipient, message_uuid, updated))
+
+                self.__history_event__(
+                    RecentMessages.EVENT_UPDATED, gamespace, message_recipient_class, message_recipient,
+                    message_uuid=message_uuid, payload=updated)
 
             except DatabaseError as e:
                 raise MessageError(500, "Failed to delete a message: " + e.args[1])
             finally:
                 await db.commit()
 
+        self.__forget_messages__(gamespace, [message_uuid])
+        self.outbox.notify()
+
     async def list_read_messages(self, gamespace_id, account_id, db=None):
         try:
-            read_messages = await (db or self.db).query(
+            read_messages = await (db or self.shards.gamespace_db(gamespace_id)).query(
                 """
                     SELECT *
                     FROM `last_read_message`
@@ -562,64 +2327,169 @@ class MessagesHistoryModel(Model):
         except DatabaseError as e:
             raise MessageError(500, "Failed to get a message: " + e.args[1])
 
-        return list(map(LastReadMessageAdapter, read_messages))
+        positions = {
+            (read_message["message_recipient_class"], read_message["message_recipient"]): read_message
+            for read_message in read_messages
+        }
 
-    async def get_message_uuid(self, gamespace, message_uuid):
-        try:
-            message = await self.db.get(
-                """
-                    SELECT *
-                    FROM `messages`
-                    WHERE `message_uuid`=%s AND `gamespace_id`=%s
-                    LIMIT 1;
-                """, message_uuid, gamespace)
-        except DatabaseError as e:
-            raise MessageError(500, "Failed to get a message: " + e.args[1])
+        # positions marked recently may not be flushed yet
+        pending = self.read_positions.get_pending(gamespace_id, account_id)
 
-        if not message:
-            raise MessageNotFound()
+        for (recipient_class, recipient), (time, message_uuid) in pending.items():
+            existing = positions.get((recipient_class, recipient))
+            if existing is None or time >= existing["last_message_time"]:
+                positions[(recipient_class, recipient)] = {
+                    "message_recipient_class": recipient_class,
+                    "message_recipient": recipient,
+                    "last_message_time": time,
+                    "last_message_uuid": message_uuid
+                }
 
-        return MessageAdapter(message)
+        return list(map(LastReadMessageAdapter, positions.values()))
 
-    async def mark_message_as_read(self, gamespace, account_id, message_uuid):
-        async with self.db.acquire() as db:
+    async def get_message_uuid(self, gamespace, message_uuid):
+        message = self.lookup.get(gamespace, message_uuid)
+
+        if message is None:
             try:
-                message = await db.get(
-                    """
-                        SELECT *
-                        FROM `messages`
-                        WHERE `message_uuid`=%s AND `gamespace_id`=%s
-                        LIMIT 1;
-                    """, message_uuid, gamespace)
+                message = await self.__get_message__(
+                    self.shards.gamespace_db(gamespace), MessagesHistoryModel.MESSAGE_BY_UUID,
+                    message_uuid, gamespace)
             except DatabaseError as e:
                 raise MessageError(500, "Failed to get a message: " + e.args[1])
 
             if not message:
                 raise MessageNotFound()
 
-            recipient_class = message["message_recipient_class"]
-            recipient = message["message_recipient"]
-            time = message["message_time"]
+            self.lookup.put(gamespace, message)
 
-            rows_updated = await db.execute(
-                # this statement add a new record and updates if a record already exists, but only
-                # if the message is newer than the older one
-                """
-                INSERT INTO `last_read_message`
-                (gamespace_id, account_id, message_recipient_class, 
-                    message_recipient, last_message_time, last_message_uuid) 
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE 
-                    last_message_time = IF(
-                        VALUES(last_message_time) > last_message_time,
-                        VALUES(last_message_time),
-                        last_message_time
-                    ),
-                    last_message_uuid = VALUES(last_message_uuid);
-                """, gamespace, account_id, recipient_class, recipient, time, message_uuid
-            )
-
-            return bool(rows_updated)
+        return MessageAdapter(message)
+
+    async def mark_message_as_read(self, gamespace, account_id, message_uuid):
+        not_found = await self.mark_messages_as_read(gamespace, account_id, [message_uuid])
+
+        if not_found:
+            raise MessageNotFound()
+
+        return True
+
+    @validate(gamespace="int", account_id="int", message_uuids="json_list_of_strings")
+    async def mark_messages_as_read(self, gamespace, account_id, message_uuids):
+        """
+        Moves read positions of an account forward to the given messages, only the newest message
+            per recipient actually matters. Positions are written behind, see ReadPositions.
+
+        :return: a list of message uuids that do not exist
+        """
+
+        if not message_uuids:
+            return []
+
+        if len(message_uuids) > MessagesHistoryModel.MAX_READ_BATCH:
+            raise MessageError(400, "Too many messages to mark at once")
+
+        query = """
+            SELECT *
+            FROM `{0}`
+            WHERE `gamespace_id`=%s AND `message_uuid` IN %s;
+        """
+
+        messages = []
+        missing = []
+
+        for message_uuid in set(message_uuids):
+            message = self.lookup.get(gamespace, message_uuid)
+            if message is None:
+                missing.append(message_uuid)
+            else:
+                messages.append(message)
+
+        if missing:
+            db = self.shards.gamespace_db(gamespace)
+
+            try:
+                found = list(await db.query(query.format("messages"), gamespace, missing))
+
+                if self.archive_days and len(found) < len(missing):
+                    found_uuids = set(message["message_uuid"] for message in found)
+                    found += await db.query(query.format("messages_archive"), gamespace, [
+                        message_uuid for message_uuid in missing if message_uuid not in found_uuids
+                    ])
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to get messages: " + e.args[1])
+
+            for message in found:
+                self.lookup.put(gamespace, message)
+
+            messages += found
+
+        await self.read_positions.add(gamespace, account_id, [
+            (message["message_recipient_class"], message["message_recipient"],
+             message["message_time"], message["message_uuid"])
+            for message in messages
+        ])
+
+        found = set(message["message_uuid"] for message in messages)
+        return [message_uuid for message_uuid in message_uuids if message_uuid not in found]
+
+    async def __read_positions_written__(self, rows):
+        """
+        Recalculates unread counters once read positions are moved, see ReadPositions
+        """
+        changed = set()
+
+        for gamespace, account_id, recipient_class, recipient, time, message_uuid in rows:
+            # a position in a direct conversation is the one of the last message read, including the ones sent
+            #   by the account, while only messages received count as unread
+            if recipient_class == CLASS_USER and str(recipient) != str(account_id):
+                continue
+
+            try:
+                await self.unread.read(gamespace, account_id, recipient_class, recipient)
+            except MessageError as e:
+                logging.error("Failed to update unread counter: " + e.message)
+            else:
+                changed.add((gamespace, account_id))
+
+        for gamespace, account_id in changed:
+            self.__unread_changed__(gamespace, [account_id])
+
+    def __unread_changed__(self, gamespace, accounts):
+        """
+        Pushes unread counters to accounts once they're set rather than incremented (an online account
+            receives every new message anyway, and counts it), so every device of an account stays in sync
+        """
+        for account_id in accounts:
+            IOLoop.current().spawn_callback(self.__push_unread__, gamespace, account_id)
+
+    async def __push_unread__(self, gamespace, account_id):
+        try:
+            unread = await self.unread.list(gamespace, account_id)
+        except MessageError as e:
+            logging.error("Failed to push unread counters: " + e.message)
+            return
+
+        await self.app.message_queue.update_unread(gamespace, account_id, [counter.dump() for counter in unread])
+
+    async def list_unread(self, gamespace, account_id):
+        return await self.unread.list(gamespace, account_id)
+
+    @validate(gamespace="int", account_id="int", offset="int", limit="int")
+    async def list_conversations(self, gamespace, account_id, offset=0, limit=100):
+        if limit < 1 or limit > 10000 or offset < 0 or offset > 10000:
+            raise MessageError(400, "Bad limit/offset")
+
+        return await self.summaries.list(
+            gamespace, account_id, offset=offset, limit=limit, time_after=self.retention_cutoff)
+
+    async def recount_unread(self, gamespace, account_id):
+        try:
+            async with self.shards.gamespace_db(gamespace, write=True).acquire() as db:
+                await self.unread.recount(db, gamespace, account_id)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to recount unread messages: " + e.args[1])
+
+        self.__unread_changed__(gamespace, [account_id])
 
 
 class MessageNotFound(Exception):
@@ -0,0 +1,248 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.gen import sleep
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+from . import MessageError
+
+import datetime
+import logging
+import ujson
+
+
+class JobAdapter(object):
+    def __init__(self, data):
+        self.job_id = data.get("job_id")
+        self.gamespace = data.get("gamespace_id")
+        self.kind = data.get("job_kind")
+        self.args = data.get("job_args")
+        if isinstance(self.args, str):
+            self.args = ujson.loads(self.args)
+        self.status = data.get("job_status")
+        self.stage = data.get("job_stage", 0)
+        self.stages = data.get("job_stages", 0)
+        self.checkpoint = data.get("job_checkpoint", 0)
+        self.progress = data.get("job_progress", 0)
+        self.error = data.get("job_error")
+        self.created = data.get("job_created")
+        self.updated = data.get("job_updated")
+
+
+class MessageJobsModel(Model):
+    """
+    Persistent background jobs for deletions too big for a single statement (deleted accounts,
+        purged groups), so they never lock a table for long.
+
+    A job kind is a list of stages, each stage deleting rows in chunks of `chunk_size`
+        in primary key order, with a pause of `throttle` seconds between chunks. A stage is called
+        as stage(checkpoint, limit) and returns (rows processed, new checkpoint), it's complete once
+        it has processed less than the limit. Stage and checkpoint are stored after every chunk,
+        so a job interrupted by a restart resumes where it has stopped.
+
+    One process runs jobs at a time, oldest first. Jobs could be added as soon as the model has started,
+        but only run once start is called, after every other model has started (and migrations have been
+        applied), as a job may depend on any of them.
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    LOCK_NAME = "message_jobs"
+
+    def __init__(self, db, interval=5, chunk_size=1000, throttle=0.1):
+        self.db = db
+        self.interval = interval
+        self.chunk_size = max(chunk_size, 1)
+        self.throttle = throttle
+
+        # kind -> a function (gamespace, args) that returns a list of stages
+        self.kinds = {}
+
+        self.run_callback = None
+        self.active = False
+        self.running = False
+        self.pending = False
+
+    def get_setup_tables(self):
+        return ["message_jobs"]
+
+    def get_setup_db(self):
+        return self.db
+
+    def register(self, kind, stages):
+        self.kinds[kind] = stages
+
+    def start(self):
+        self.active = True
+
+        if self.interval:
+            self.run_callback = PeriodicCallback(self.__run__, self.interval * 1000)
+            self.run_callback.start()
+
+        self.__run__()
+
+    async def stopped(self):
+        self.active = False
+
+        if self.run_callback:
+            self.run_callback.stop()
+            self.run_callback = None
+
+        await super(MessageJobsModel, self).stopped()
+
+    def __run__(self):
+        if self.active:
+            IOLoop.current().spawn_callback(self.run)
+
+    async def add(self, gamespace, kind, args):
+        if kind not in self.kinds:
+            raise MessageError(400, "Unknown job kind: " + kind)
+
+        stages = len(self.kinds[kind](gamespace, args))
+        now = datetime.datetime.utcnow()
+
+        try:
+            job_id = await self.db.insert(
+                """
+                    INSERT INTO `message_jobs`
+                    (`gamespace_id`, `job_kind`, `job_args`, `job_status`, `job_stages`, `job_created`, `job_updated`)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s);
+                """, gamespace, kind, ujson.dumps(args), MessageJobsModel.STATUS_PENDING, stages, now, now)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to add a job: " + e.args[1])
+
+        self.__run__()
+        return job_id
+
+    async def list_jobs(self, gamespace, limit=100):
+        try:
+            jobs = await self.db.query(
+                """
+                    SELECT *
+                    FROM `message_jobs`
+                    WHERE `gamespace_id`=%s
+                    ORDER BY `job_id` DESC
+                    LIMIT %s;
+                """, gamespace, limit)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list jobs: " + e.args[1])
+
+        return list(map(JobAdapter, jobs))
+
+    async def retry_job(self, gamespace, job_id):
+        """
+        Puts a failed job back into the queue, it continues from the last checkpoint
+        """
+        try:
+            updated = await self.db.execute(
+                """
+                    UPDATE `message_jobs`
+                    SET `job_status`=%s, `job_error`=NULL
+                    WHERE `gamespace_id`=%s AND `job_id`=%s AND `job_status`=%s;
+                """, MessageJobsModel.STATUS_PENDING, gamespace, job_id, MessageJobsModel.STATUS_FAILED)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to retry a job: " + e.args[1])
+
+        if not updated:
+            raise MessageError(404, "No such failed job")
+
+        self.__run__()
+
+    async def __update__(self, job_id, **fields):
+        fields["job_updated"] = datetime.datetime.utcnow()
+
+        await self.db.execute(
+            """
+                UPDATE `message_jobs`
+                SET {0}
+                WHERE `job_id`=%s;
+            """.format(", ".join("`{0}`=%s".format(field) for field in fields.keys())),
+            *fields.values(), job_id)
+
+    async def run(self):
+        if self.running:
+            self.pending = True
+            return
+
+        self.running = True
+
+        try:
+            async with self.db.acquire() as db:
+                locked = await db.get(
+                    """
+                        SELECT GET_LOCK(%s, 0) AS `locked`;
+                    """, MessageJobsModel.LOCK_NAME)
+
+                if not locked or not locked["locked"]:
+                    return
+
+                try:
+                    while True:
+                        self.pending = False
+
+                        # a job left running has been interrupted, so it's resumed
+                        job = await db.get(
+                            """
+                                SELECT *
+                                FROM `message_jobs`
+                                WHERE `job_status` IN %s
+                                ORDER BY `job_id` ASC
+                                LIMIT 1;
+                            """, [MessageJobsModel.STATUS_PENDING, MessageJobsModel.STATUS_RUNNING])
+
+                        if job is None:
+                            break
+
+                        await self.run_job(JobAdapter(job))
+                finally:
+                    await db.get(
+                        """
+                            SELECT RELEASE_LOCK(%s);
+                        """, MessageJobsModel.LOCK_NAME)
+        except DatabaseError as e:
+            logging.error("Failed to run message jobs: " + e.args[1])
+        finally:
+            self.running = False
+
+    async def run_job(self, job):
+        stages_factory = self.kinds.get(job.kind)
+
+        if stages_factory is None:
+            await self.__update__(
+                job.job_id, job_status=MessageJobsModel.STATUS_FAILED, job_error="Unknown job kind")
+            return
+
+        stages = stages_factory(job.gamespace, job.args)
+
+        stage = job.stage
+        checkpoint = job.checkpoint
+        progress = job.progress
+
+        await self.__update__(job.job_id, job_status=MessageJobsModel.STATUS_RUNNING)
+
+        try:
+            while stage < len(stages):
+                processed, checkpoint = await stages[stage](checkpoint, self.chunk_size)
+                progress += processed
+
+                if processed < self.chunk_size:
+                    stage += 1
+                    checkpoint = 0
+
+                await self.__update__(
+                    job.job_id, job_stage=stage, job_checkpoint=checkpoint, job_progress=progress)
+
+                if self.throttle:
+                    await sleep(self.throttle)
+        except MessageError as e:
+            logging.error("Message job {0} has failed: {1}".format(job.job_id, e.message))
+            await self.__update__(
+                job.job_id, job_status=MessageJobsModel.STATUS_FAILED, job_error=e.message[:1024])
+            return
+
+        await self.__update__(job.job_id, job_status=MessageJobsModel.STATUS_DONE)
+        logging.info("Message job {0} '{1}' is done, {2} rows processed".format(job.job_id, job.kind, progress))
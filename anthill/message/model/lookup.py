@@ -0,0 +1,43 @@
+
+from . cache import LRUCache
+
+
+class MessageLookupCache(object):
+    """
+    A per-process cache of message rows by uuid, so repeated lookups of the same (usually fresh) message,
+        to get it, mark it as read, or check whether it could be updated or deleted, do not go to the database.
+
+    Rows are put in when a message is stored, and when it's looked up. Whatever changes or removes a message
+        drops it from the caches of every process with an EVENT_FORGET history event (see
+        MessagesHistoryModel.__forget_messages__), and the time to live limits how stale a row could get
+        if an event is lost. The payload is kept as JSON, so every reader decodes its own copy.
+    """
+
+    EVENT_FORGET = "forget"
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.rows = LRUCache(max_size=max_size, ttl=ttl) if max_size > 0 else None
+
+    @staticmethod
+    def key(gamespace, message_uuid):
+        return str(gamespace), str(message_uuid)
+
+    def get(self, gamespace, message_uuid):
+        if self.rows is None:
+            return None
+        return self.rows.get(MessageLookupCache.key(gamespace, message_uuid))
+
+    def put(self, gamespace, row):
+        if self.rows is None:
+            return
+        self.rows.set(MessageLookupCache.key(gamespace, row["message_uuid"]), row)
+
+    def forget(self, gamespace, message_uuids):
+        if self.rows is None:
+            return
+        for message_uuid in message_uuids:
+            self.rows.pop(MessageLookupCache.key(gamespace, message_uuid))
+
+    def clear(self):
+        if self.rows is not None:
+            self.rows.clear()
@@ -0,0 +1,122 @@
+
+from . cache import LRUCache
+
+
+class GroupMembershipCache(object):
+    """
+    A per-process cache of groups (by class and key) and of group participations of accounts, as every
+        websocket connection, group inbox read and join looks them up, while they rarely change.
+
+    Rows are only put in as read from the primary, so a lagging replica can't put back what has just been
+        invalidated. Whatever changes a group or a participation drops it from the caches of every process
+        with an EVENT_GROUPS broadcast (see GroupsModel.__invalidate__), and the time to live limits how stale
+        an entry could get if an event is lost. Nothing is cached about groups or participations that don't exist,
+        so a miss always goes to the database.
+
+    Participations are keyed by account, each entry holding participations of that account per gamespace,
+        so forgetting an account in every gamespace (as when accounts are deleted) doesn't scan the cache.
+        A gamespace put into an existing entry shares its time to live, so it can only expire earlier.
+
+    Hits and misses are sent to monitoring as `message.group_cache` rates.
+    """
+
+    EVENT_GROUPS = "groups"
+
+    def __init__(self, app, max_size=10000, ttl=60):
+        self.app = app
+        self.groups = LRUCache(max_size=max_size, ttl=ttl) if max_size > 0 else None
+        self.participations = LRUCache(max_size=max_size, ttl=ttl) if max_size > 0 else None
+
+    @staticmethod
+    def group_key(gamespace, group_class, key):
+        return str(gamespace), str(group_class), str(key)
+
+    @staticmethod
+    def account_key(account_id):
+        return str(account_id)
+
+    def __hit__(self, cache, hit):
+        monitoring = getattr(self.app, "monitoring", None)
+        if monitoring is not None:
+            monitoring.add_rate("message.group_cache", "hit" if hit else "miss", cache=cache)
+
+    def get_group(self, gamespace, group_class, key):
+        """
+        Returns a row of a group, or None if it's not cached
+        """
+        if self.groups is None:
+            return None
+
+        group = self.groups.get(GroupMembershipCache.group_key(gamespace, group_class, key))
+        self.__hit__("groups", group is not None)
+        return group
+
+    def put_group(self, gamespace, group):
+        if self.groups is None:
+            return
+        self.groups.set(GroupMembershipCache.group_key(gamespace, group["group_class"], group["group_key"]), group)
+
+    def get_participations(self, gamespace, account_id):
+        """
+        Returns a list of participation rows of an account, or None if they're not cached
+        """
+        if self.participations is None:
+            return None
+
+        gamespaces = self.participations.get(GroupMembershipCache.account_key(account_id))
+        participations = gamespaces.get(str(gamespace)) if gamespaces is not None else None
+        self.__hit__("participations", participations is not None)
+        return participations
+
+    def put_participations(self, gamespace, account_id, participations):
+        if self.participations is None:
+            return
+
+        key = GroupMembershipCache.account_key(account_id)
+        gamespaces = self.participations.get(key)
+
+        if gamespaces is None:
+            self.participations.set(key, {str(gamespace): participations})
+        else:
+            gamespaces[str(gamespace)] = participations
+
+    def forget(self, gamespace, groups=(), accounts=()):
+        """
+        :param gamespace: a gamespace, or None to forget participations of the accounts in every gamespace
+        :param groups: a list of (group class, group key) tuples
+        :param accounts: a list of accounts to forget participations of
+        """
+        if self.groups is not None and gamespace is not None:
+            for group_class, key in groups:
+                self.groups.pop(GroupMembershipCache.group_key(gamespace, group_class, key))
+
+        if self.participations is None or not accounts:
+            return
+
+        for account_id in accounts:
+            key = GroupMembershipCache.account_key(account_id)
+
+            if gamespace is None:
+                self.participations.pop(key)
+                continue
+
+            gamespaces = self.participations.get(key)
+            if gamespaces is not None:
+                gamespaces.pop(str(gamespace), None)
+
+    def event(self, gamespace, groups=(), accounts=()):
+        return {
+            "event": GroupMembershipCache.EVENT_GROUPS,
+            "gamespace": gamespace,
+            "groups": [[group_class, key] for group_class, key in groups],
+            "accounts": list(accounts)
+        }
+
+    def event_received(self, event):
+        if event.get("event") != GroupMembershipCache.EVENT_GROUPS:
+            return
+
+        self.forget(
+            event.get("gamespace"),
+            groups=[tuple(group) for group in event.get("groups", [])],
+            accounts=event.get("accounts", []))
@@ -0,0 +1,234 @@
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+import logging
+import datetime
+import pytz
+import os
+import re
+
+
+class MigrationError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class MigrationsModel(Model):
+    """
+    Applies versioned schema changes from sql/migrations to existing installations.
+
+    Fresh installations get the latest schema straight from sql/*.sql, so every migration should be
+        written so that applying it over the latest schema is a no-op: statements failing because
+        the change is already there (a duplicate key or column, a missing key to drop) are skipped.
+
+    A migration file is named <version>_<name>.sql and holds one or more statements separated by ';'.
+        Schema changes should be online ones wherever possible (ALGORITHM=INPLACE, LOCK=NONE).
+        Once a migration is applied, a method named migration_<name> is called on every model
+        that has it, so data could be converted too.
+
+    Migrations are applied to every shard (see ShardRouter), and migration_<name> methods are called
+        once per shard with its database. Applied versions are recorded on the primary.
+    """
+
+    MIGRATIONS_PATH = "sql/migrations"
+    MIGRATION_PATTERN = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+    # mysql errors that mean the change is already in place
+    ALREADY_APPLIED_ERRORS = {
+        1060,  # ER_DUP_FIELDNAME
+        1061,  # ER_DUP_KEYNAME
+        1091,  # ER_CANT_DROP_FIELD_OR_KEY
+        1826,  # ER_FK_DUP_NAME
+    }
+
+    def __init__(self, db, models, shards=None, check_query_plans=False, strict_query_plans=False):
+        self.db = db
+        self.models = models
+        self.shards = shards
+        self.check_plans = check_query_plans
+        self.strict_plans = strict_query_plans
+
+    def get_setup_tables(self):
+        return ["schema_migrations"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(MigrationsModel, self).started(application)
+
+        migrations = self.list_migrations(application.module_path(MigrationsModel.MIGRATIONS_PATH))
+        await self.apply_migrations(migrations)
+
+        if self.check_plans:
+            await self.check_query_plans()
+
+    @staticmethod
+    def list_migrations(path):
+        """
+        Returns a list of (version, name, file path) tuples, sorted by version
+        """
+        if not os.path.isdir(path):
+            return []
+
+        migrations = []
+
+        for file_name in os.listdir(path):
+            match = MigrationsModel.MIGRATION_PATTERN.match(file_name)
+            if not match:
+                continue
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(path, file_name)))
+
+        migrations.sort(key=lambda migration: migration[0])
+        return migrations
+
+    @staticmethod
+    def split_statements(sql):
+        statements = [statement.strip() for statement in sql.split(";")]
+        return [statement for statement in statements if statement]
+
+    async def list_applied(self):
+        try:
+            applied = await self.db.query(
+                """
+                    SELECT `migration_version`
+                    FROM `schema_migrations`;
+                """)
+        except DatabaseError as e:
+            raise MigrationError("Failed to list applied migrations: " + e.args[1])
+
+        return set(migration["migration_version"] for migration in applied)
+
+    async def apply_migrations(self, migrations):
+        applied = await self.list_applied()
+
+        for version, name, path in migrations:
+            if version in applied:
+                continue
+
+            with open(path) as f:
+                statements = MigrationsModel.split_statements(f.read())
+
+            logging.warning("Applying migration {0} '{1}'".format(version, name))
+
+            await self.apply_migration(version, name, statements)
+
+    async def apply_migration(self, version, name, statements):
+        shards = self.shards.all() if self.shards is not None else [self.db]
+        method_name = "migration_" + name
+
+        for shard_db in shards:
+            async with shard_db.acquire() as db:
+                for statement in statements:
+                    try:
+                        await db.execute(statement)
+                    except DatabaseError as e:
+                        if e.args[0] in MigrationsModel.ALREADY_APPLIED_ERRORS:
+                            logging.info("Migration {0} '{1}': skipping, {2}".format(version, name, e.args[1]))
+                            continue
+                        raise MigrationError("Failed to apply migration {0} '{1}': {2}".format(
+                            version, name, e.args[1]))
+
+            for model in self.models:
+                if hasattr(model, method_name):
+                    await getattr(model, method_name)(shard_db)
+
+        async with self.db.acquire() as db:
+            try:
+                await db.execute(
+                    """
+                        INSERT INTO `schema_migrations`
+                        (`migration_version`, `migration_name`, `migration_applied`)
+                        VALUES (%s, %s, %s);
+                    """, version, name, datetime.datetime.now(tz=pytz.utc))
+            except DatabaseError as e:
+                raise MigrationError("Failed to record migration {0} '{1}': {2}".format(
+                    version, name, e.args[1]))
+
+        logging.warning("Applied migration {0} '{1}'".format(version, name))
+
+    async def explain(self, query, *args):
+        """
+        Returns the query plan of a query, a list of steps
+        """
+        try:
+            return list(await self.db.query("EXPLAIN " + query, *args))
+        except DatabaseError as e:
+            raise MigrationError("Failed to explain a query: " + e.args[1])
+
+    @staticmethod
+    def check_plan(plan, indexes):
+        """
+        Returns a list of problems of a query plan: tables scanned fully, and tables not read with an index
+            they're expected to be read with
+
+        :param indexes: a dict of table (or its alias) -> a tuple of names of indexes it could be read with
+        """
+        problems = []
+
+        for step in plan:
+            # tables optimized away (read as constants) are not accessed at all
+            if step.get("type") is None:
+                continue
+
+            table = step.get("table")
+
+            if step.get("type") == "ALL":
+                problems.append("`{0}` is scanned fully".format(table))
+                continue
+
+            expected = indexes.get(table)
+
+            if expected and step.get("key") not in expected:
+                problems.append("`{0}` is read with `{1}` instead of {2}".format(
+                    table, step.get("key"), ", ".join("`{0}`".format(index) for index in expected)))
+
+        return problems
+
+    def list_query_plans(self):
+        """
+        Returns queries on the hot path that should never scan a whole table, exactly as models run them:
+            every model that has a query_plans method returns a dict of them as
+            name: (query, arguments, indexes), see check_plan
+        """
+        plans = {}
+
+        for model in self.models:
+            if hasattr(model, "query_plans"):
+                plans.update(model.query_plans())
+
+        return plans
+
+    async def check_query_plans(self):
+        """
+        Makes sure every query of list_query_plans uses the index it's expected to, to catch schema regressions
+            early. See also anthill/message/tests/test_query_plans.py, that checks them on a scratch database.
+        Only meaningful on a populated database, as the optimizer may prefer to scan tiny tables.
+
+        :raises MigrationError: if some query does not use an index and plans are checked strictly,
+            so a regression fails the startup instead of a warning in logs
+        """
+        failed = []
+
+        for name, (query, args, indexes) in sorted(self.list_query_plans().items()):
+            try:
+                plan = await self.explain(query, *args)
+            except MigrationError as e:
+                logging.error("Failed to check query plan of '{0}': {1}".format(name, e.message))
+                failed.append(name)
+                continue
+
+            problems = MigrationsModel.check_plan(plan, indexes)
+
+            if problems:
+                logging.warning("Query '{0}' does not use indexes: {1}".format(name, "; ".join(problems)))
+                failed.append(name)
+
+        if failed and self.strict_plans:
+            raise MigrationError("Queries do not use indexes: " + ", ".join(failed))
+
+        return failed
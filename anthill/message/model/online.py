@@ -86,3 +86,40 @@ class OnlineModel(Model):
             await account_online.bind(exchange=group_exchange)
         finally:
             channel.close()
+
+    async def bind_accounts_to_group(self, participations):
+        """
+        Same as bind_account_to_group, for a number of participations (of the same group) at once:
+            everything goes over a single channel, and every group (cluster) exchange is declared only once
+        """
+        if not participations:
+            return
+
+        connection = await self.connections.get()
+
+        channel = await connection.channel()
+
+        try:
+            group_exchanges = {}
+
+            for participation in participations:
+                account_online = await self.get_account_exchange(participation.account, channel)
+
+                if not account_online:
+                    continue
+
+                group_exchange_name = AccountConversation.__id__(
+                    participation.group_class, participation.calculate_recipient())
+
+                group_exchange = group_exchanges.get(group_exchange_name)
+
+                if group_exchange is None:
+                    group_exchange = await channel.exchange(
+                        exchange=group_exchange_name,
+                        exchange_type='fanout',
+                        auto_delete=True)
+                    group_exchanges[group_exchange_name] = group_exchange
+
+                await account_online.bind(exchange=group_exchange)
+        finally:
+            channel.close()
@@ -0,0 +1,175 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.database import DatabaseError
+
+from . import MessageError
+
+import logging
+import ujson
+
+
+class MessageOutbox(object):
+    """
+    A transactional outbox of notifications about updated or deleted messages.
+
+    A notification is written into `message_outbox` in the same transaction as the change itself,
+        so row locks are only held for as long as the database needs, and a notification is never
+        lost or sent about a change that has been rolled back. Outbox rows are then published
+        into the incoming queue in batches (see MessagesQueueModel.publish_messages) and removed
+        once the broker confirms them.
+
+    The outbox is relayed right after a change has been committed, and once per interval to pick up
+        whatever has failed to be published before. Every shard has an outbox of its own, and one process
+        relays it at a time, so notifications go out in the order they have been written. Notifications of
+        a gamespace being moved to another shard are held, and copied over with the gamespace, see ShardRouter.
+    """
+
+    LOCK_NAME = "message_outbox"
+
+    def __init__(self, shards, app, interval=1, batch_size=100):
+        self.shards = shards
+        self.app = app
+        self.interval = interval
+        self.batch_size = max(batch_size, 1)
+
+        self.relay_callback = None
+        self.relaying = False
+        # a relay has been requested while relaying
+        self.pending = False
+
+    def start(self):
+        if self.interval:
+            self.relay_callback = PeriodicCallback(self.__relay__, self.interval * 1000)
+            self.relay_callback.start()
+
+    def stop(self):
+        if self.relay_callback:
+            self.relay_callback.stop()
+            self.relay_callback = None
+
+    def __relay__(self):
+        IOLoop.current().spawn_callback(self.relay)
+
+    async def add(self, db, gamespace, message):
+        """
+        Writes a notification (a message for the incoming queue) into the outbox, using the caller's
+            transaction, the caller is expected to call notify once it's committed
+        """
+        await db.execute(
+            """
+                INSERT INTO `message_outbox`
+                (`gamespace_id`, `outbox_message`)
+                VALUES (%s, %s);
+            """, gamespace, ujson.dumps(message))
+
+    def notify(self):
+        self.__relay__()
+
+    async def relay(self):
+        if self.relaying:
+            self.pending = True
+            return
+
+        self.relaying = True
+
+        try:
+            while True:
+                self.pending = False
+
+                for index, db in enumerate(self.shards.all()):
+                    await self.relay_shard(index, db)
+
+                if not self.pending:
+                    break
+        finally:
+            self.relaying = False
+
+    async def relay_shard(self, index, shard_db):
+        # shards could be databases of the same server, so every shard has a lock of its own
+        lock_name = "{0}_{1}".format(MessageOutbox.LOCK_NAME, index) if index else MessageOutbox.LOCK_NAME
+
+        try:
+            async with shard_db.acquire() as db:
+                locked = await db.get(
+                    """
+                        SELECT GET_LOCK(%s, 0) AS `locked`;
+                    """, lock_name)
+
+                if not locked or not locked["locked"]:
+                    return
+
+                try:
+                    held = [
+                        gamespace
+                        for gamespace in self.shards.list_moving()
+                        if self.shards.index(gamespace) == index
+                    ]
+
+                    while True:
+                        published = await self.relay_batch(db, held)
+
+                        if published < self.batch_size:
+                            break
+                finally:
+                    await db.get(
+                        """
+                            SELECT RELEASE_LOCK(%s);
+                        """, lock_name)
+        except MessageError as e:
+            logging.error("Failed to relay message outbox of shard {0}: {1}".format(index, e.message))
+        except DatabaseError as e:
+            logging.error("Failed to relay message outbox of shard {0}: {1}".format(index, e.args[1]))
+
+    async def relay_batch(self, db, held=None):
+        """
+        Publishes a batch of outbox rows and removes the ones confirmed, returns how many have been published.
+            Publishing stops at the first row not confirmed, to keep the order.
+
+        :param held: gamespaces which notifications are not to be published
+        """
+
+        if held:
+            rows = await db.query(
+                """
+                    SELECT `outbox_id`, `outbox_message`
+                    FROM `message_outbox`
+                    WHERE `gamespace_id` NOT IN %s
+                    ORDER BY `outbox_id` ASC
+                    LIMIT %s;
+                """, held, self.batch_size)
+        else:
+            rows = await db.query(
+                """
+                    SELECT `outbox_id`, `outbox_message`
+                    FROM `message_outbox`
+                    ORDER BY `outbox_id` ASC
+                    LIMIT %s;
+                """, self.batch_size)
+
+        if not rows:
+            return 0
+
+        messages = []
+
+        for row in rows:
+            message = row["outbox_message"]
+            messages.append(ujson.loads(message) if isinstance(message, str) else message)
+
+        confirmed = await self.app.message_queue.publish_messages(messages)
+
+        published = 0
+        while published < len(rows) and confirmed[published]:
+            published += 1
+
+        if published:
+            await db.execute(
+                """
+                    DELETE FROM `message_outbox`
+                    WHERE `outbox_id` IN %s;
+                """, [row["outbox_id"] for row in rows[:published]])
+
+        if published < len(rows):
+            raise MessageError(503, "Broker has not confirmed {0} notifications".format(len(rows) - published))
+
+        return published
@@ -0,0 +1,137 @@
+
+import ujson
+
+
+class PayloadUpdate(object):
+    """
+    An update document (as accepted by Profile.merge_data) compiled into a single JSON_SET/JSON_REMOVE
+        expression over `message_payload`, so a message could be updated in place with one statement.
+
+    Only the common subset is compiled: fields being set, fields being removed (None), nested objects
+        merged into existing objects, and integer increments/decrements. Anything else can't be compiled,
+        and should be merged in Python instead.
+
+    Cases where the compiled statement would behave differently than the Python merge (a nested object
+        merged into a missing or non-object value, an increment of a non-integer value) are turned into
+        conditions, so the statement does not match the row and the caller should fall back too.
+    """
+
+    INCREMENTS = {
+        "++": 1,
+        "increment": 1,
+        "--": -1,
+        "decrement": -1
+    }
+
+    def __init__(self):
+        # a list of (path, expression, args)
+        self.sets = []
+        # a list of paths
+        self.removals = []
+        # a list of (condition, args)
+        self.conditions = []
+
+    @staticmethod
+    def compile(update):
+        """
+        Returns a PayloadUpdate, or None if the update can't be compiled
+        """
+        if not isinstance(update, dict) or not update:
+            return None
+
+        compiled = PayloadUpdate()
+
+        if not compiled.__compile__(update, "$"):
+            return None
+
+        return compiled
+
+    @staticmethod
+    def __path__(parent, key):
+        if not isinstance(key, str) or '"' in key or "\\" in key:
+            return None
+        return '{0}."{1}"'.format(parent, key)
+
+    def __compile__(self, fields, parent):
+        for key, value in fields.items():
+            path = PayloadUpdate.__path__(parent, key)
+
+            if path is None:
+                return False
+
+            if value is None:
+                self.removals.append(path)
+                continue
+
+            if not isinstance(value, dict):
+                self.sets.append((path, "CAST(%s AS JSON)", [ujson.dumps(value)]))
+                continue
+
+            func = value.get("@func")
+
+            if func is None:
+                self.conditions.append(("JSON_TYPE(JSON_EXTRACT(`message_payload`, %s))='OBJECT'", [path]))
+
+                if not self.__compile__(value, path):
+                    return False
+
+                continue
+
+            sign = PayloadUpdate.INCREMENTS.get(func)
+            amount = value.get("@value")
+
+            if sign is None or set(value.keys()) != {"@func", "@value"}:
+                return False
+
+            if isinstance(amount, bool) or not isinstance(amount, int) or not amount:
+                return False
+
+            self.conditions.append((
+                "IFNULL(JSON_TYPE(JSON_EXTRACT(`message_payload`, %s)), 'NULL') "
+                "IN ('INTEGER', 'UNSIGNED INTEGER', 'NULL')", [path]))
+
+            self.sets.append((
+                path,
+                "IF(JSON_TYPE(JSON_EXTRACT(`message_payload`, %s)) IN ('INTEGER', 'UNSIGNED INTEGER'), "
+                "CAST(JSON_EXTRACT(`message_payload`, %s) AS SIGNED), 0) + %s", [path, path, sign * amount]))
+
+        return True
+
+    def expression(self):
+        """
+        Returns an (expression, args) tuple for the new value of `message_payload`
+        """
+
+        expression = "`message_payload`"
+        args = []
+
+        if self.removals:
+            expression = "JSON_REMOVE({0}, {1})".format(expression, ", ".join(["%s"] * len(self.removals)))
+            args.extend(self.removals)
+
+        if self.sets:
+            values = []
+
+            for path, value, value_args in self.sets:
+                values.append("%s, " + value)
+                args.append(path)
+                args.extend(value_args)
+
+            expression = "JSON_SET({0}, {1})".format(expression, ", ".join(values))
+
+        return expression, args
+
+    def condition(self):
+        """
+        Returns a (condition, args) tuple the row should match for the expression to behave like a Python merge
+        """
+
+        if not self.conditions:
+            return "TRUE", []
+
+        args = []
+
+        for condition, condition_args in self.conditions:
+            args.extend(condition_args)
+
+        return " AND ".join(condition for condition, condition_args in self.conditions), args
@@ -1,5 +1,5 @@
 
-from tornado.gen import Future, with_timeout, TimeoutError, convert_yielded
+from tornado.gen import Future, with_timeout, TimeoutError, convert_yielded, multi
 from tornado.queues import Queue, QueueEmpty
 from tornado.ioloop import IOLoop
 
@@ -9,8 +9,9 @@ from anthill.common.options import options
 from anthill.common.validate import validate
 from anthill.common.access import utc_time
 
-from . import MessageSendError, MessageError
+from . import MessageSendError, MessageError, CLASS_USER
 from . conversation import AccountConversation, MessageFlags
+from . spool import MessageSpool
 
 import logging
 import ujson
@@ -43,6 +44,9 @@ class MessagesQueueModel(Model):
 
     Same cycle applies for updating and deleting the message
 
+    Besides that, every process is bound to a broadcast exchange, so changes made by one process
+        could be reflected in caches of the others, see broadcast and add_broadcast_listener.
+
     """
 
     DELIVERY_TIMEOUT = 5
@@ -58,6 +62,13 @@ class MessagesQueueModel(Model):
         self.callback_queue = None
         self.handle_futures = {}
 
+        self.broadcast_exchange_name = options.message_broadcast_exchange_name
+        self.broadcast_exchange = None
+        self.broadcast_queue = None
+        self.broadcast_listeners = []
+        # to tell own broadcasts apart
+        self.broadcast_id = str(uuid.uuid4())
+
         self.outgoing_message_workers = options.outgoing_message_workers
         self.message_incoming_queue_name = options.message_incoming_queue_name
         self.message_prefetch_count = options.message_prefetch_count
@@ -80,6 +91,14 @@ class MessagesQueueModel(Model):
             await self.queue.consume(self.__on_message__)
             await self.callback_queue.consume(self.__on_callback__, no_ack=True)
 
+            self.broadcast_exchange = await self.channel.exchange(
+                exchange=self.broadcast_exchange_name,
+                exchange_type='fanout')
+            self.broadcast_queue = await self.channel.queue(exclusive=True)
+
+            await self.broadcast_queue.bind(exchange=self.broadcast_exchange)
+            await self.broadcast_queue.consume(self.__on_broadcast__, no_ack=True)
+
         except Exception:
             logging.exception("Failed to start message consuming queue")
         else:
@@ -102,6 +121,49 @@ class MessagesQueueModel(Model):
 
         self.exchange = None
         self.queue = None
+        self.broadcast_exchange = None
+        self.broadcast_queue = None
+
+    def add_broadcast_listener(self, listener):
+        """
+        Adds a function to be called with every event broadcast by other processes
+        """
+        self.broadcast_listeners.append(listener)
+
+    def broadcast(self, event):
+        """
+        Sends an event (a dict) to every other process, on a best effort basis: events are not persisted
+            and may be lost, so listeners should only use them to keep caches up to date
+        """
+        if not self.channel or not self.broadcast_exchange:
+            return
+
+        # noinspection PyBroadException
+        try:
+            self.channel.basic_publish(
+                self.broadcast_exchange_name,
+                '',
+                ujson.dumps(event),
+                properties=BasicProperties(app_id=self.broadcast_id))
+        except Exception:
+            logging.exception("Failed to broadcast an event")
+
+    def __on_broadcast__(self, channel, method, properties, body):
+        if properties.app_id == self.broadcast_id:
+            return
+
+        try:
+            event = ujson.loads(body)
+        except (KeyError, ValueError):
+            logging.error("Corrupted broadcast event")
+            return
+
+        for listener in self.broadcast_listeners:
+            # noinspection PyBroadException
+            try:
+                listener(event)
+            except Exception:
+                logging.exception("Failed to process a broadcast event")
 
     def __on_message__(self, channel, method, properties, body):
         try:
@@ -187,6 +249,7 @@ class MessagesQueueModel(Model):
         history = self.history
 
         flags = MessageFlags(message.get(AccountConversation.FLAGS, []))
+        ttl = message.get(AccountConversation.TTL, 0)
 
         if MessageFlags.DO_NOT_STORE in flags:
             return delivered
@@ -194,20 +257,41 @@ class MessagesQueueModel(Model):
         if delivered and (MessageFlags.REMOVE_DELIVERED in flags):
             return delivered
 
+        time = datetime.datetime.fromtimestamp(time, tz=pytz.utc)
+        spool = history.spool
+
+        # once anything is spooled, everything is, until the spool is replayed, to keep the order
+        if not spool.pending():
+            try:
+                await history.add_message(
+                    gamespace_id,
+                    sender,
+                    message_uuid,
+                    str(recipient_class),
+                    str(recipient_key),
+                    time,
+                    message_type,
+                    payload,
+                    flags,
+                    delivered=delivered,
+                    ttl=ttl)
+            except MessageError as e:
+                if e.code < 500 or not spool.enabled:
+                    raise MessagesQueueError(e.message, e.code >= 500)
+
+                logging.warning("Failed to store a message, spooling it: " + e.message)
+            else:
+                return delivered
+
+        if not isinstance(payload, dict):
+            raise MessagesQueueError("payload should be a dict", False)
+
         try:
-            await history.add_message(
-                gamespace_id,
-                sender,
-                message_uuid,
-                str(recipient_class),
-                str(recipient_key),
-                datetime.datetime.fromtimestamp(time, tz=pytz.utc),
-                message_type,
-                payload,
-                flags,
-                delivered=delivered)
+            await spool.append(MessageSpool.record(
+                gamespace_id, sender, message_uuid, str(recipient_class), str(recipient_key), time,
+                message_type, payload, flags, delivered, ttl))
         except MessageError as e:
-            raise MessagesQueueError(e.message, e.code >= 500)
+            raise MessagesQueueError(e.message, True)
 
         return delivered
 
@@ -364,6 +448,12 @@ class MessagesQueueModel(Model):
 
             flags = MessageFlags(flags_)
 
+            ttl = message.get("ttl", 0)
+
+            if not isinstance(ttl, int) or ttl < 0:
+                logging.error("A message '{0}' ttl should be a non-negative number.".format(ujson.dumps(message)))
+                continue
+
             if MessageFlags.SERVER in flags:
                 raise MessageSendError(409, "Cannot set 'server' flag directly, "
                                             "use scope 'message_authoritative' instead.")
@@ -373,7 +463,7 @@ class MessagesQueueModel(Model):
 
             message_uuid = str(uuid.uuid4())
 
-            body = ujson.dumps({
+            body = {
                 AccountConversation.ACTION: AccountConversation.ACTION_NEW_MESSAGE,
                 AccountConversation.GAMESPACE: gamespace,
                 AccountConversation.MESSAGE_UUID: message_uuid,
@@ -384,9 +474,12 @@ class MessagesQueueModel(Model):
                 AccountConversation.PAYLOAD: payload,
                 AccountConversation.FLAGS: flags.as_list(),
                 AccountConversation.TIME: time
-            })
+            }
+
+            if ttl:
+                body[AccountConversation.TTL] = ttl
 
-            out_queue.put_nowait(body)
+            out_queue.put_nowait(ujson.dumps(body))
 
         workers_count = min(self.outgoing_message_workers, out_queue.qsize())
 
@@ -397,9 +490,15 @@ class MessagesQueueModel(Model):
 
     @validate(gamespace="int", sender="int", recipient_class="str",
               recipient_key="str", message_type="str", payload="json_dict",
-              flags=MessageFlags, authoritative="bool")
+              flags=MessageFlags, authoritative="bool", ttl="int")
     def add_message(self, gamespace, sender, recipient_class, recipient_key, message_type, payload, flags,
-                    authoritative=False):
+                    authoritative=False, ttl=0):
+        """
+        :param ttl: if positive, the message is not delivered nor listed after that many seconds
+        """
+
+        if ttl < 0:
+            raise MessageSendError(400, "ttl should not be negative")
 
         if MessageFlags.SERVER in flags:
             raise MessageSendError(409, "Cannot set 'server' flag directly, "
@@ -408,12 +507,18 @@ class MessagesQueueModel(Model):
         if authoritative:
             flags.set(MessageFlags.SERVER)
 
-        message_uuid = str(uuid.uuid4())
+        return self.__enqueue_message__(MessagesQueueModel.new_message(
+            gamespace, sender, recipient_class, recipient_key, message_type, payload, flags, ttl=ttl))
 
+    @staticmethod
+    def new_message(gamespace, sender, recipient_class, recipient_key, message_type, payload, flags, ttl=0):
+        """
+        Returns a message for the incoming queue that delivers a new message
+        """
         message = {
             AccountConversation.ACTION: AccountConversation.ACTION_NEW_MESSAGE,
             AccountConversation.GAMESPACE: gamespace,
-            AccountConversation.MESSAGE_UUID: message_uuid,
+            AccountConversation.MESSAGE_UUID: str(uuid.uuid4()),
             AccountConversation.SENDER: sender,
             AccountConversation.RECIPIENT_CLASS: recipient_class,
             AccountConversation.RECIPIENT_KEY: recipient_key,
@@ -423,13 +528,17 @@ class MessagesQueueModel(Model):
             AccountConversation.TIME: utc_time()
         }
 
-        return self.__enqueue_message__(message)
+        if ttl:
+            message[AccountConversation.TTL] = ttl
 
-    @validate(gamespace="int", sender="int", message_type="str", recipient_class="str",
-              recipient_key="str", message_uuid="str")
-    def delete_message(self, gamespace, sender, message_type, recipient_class, recipient_key, message_uuid):
+        return message
 
-        message = {
+    @staticmethod
+    def deleted_message(gamespace, sender, message_type, recipient_class, recipient_key, message_uuid):
+        """
+        Returns a message for the incoming queue that notifies about a message being deleted
+        """
+        return {
             AccountConversation.ACTION: AccountConversation.ACTION_MESSAGE_DELETED,
             AccountConversation.TYPE: message_type,
             AccountConversation.GAMESPACE: gamespace,
@@ -439,13 +548,12 @@ class MessagesQueueModel(Model):
             AccountConversation.RECIPIENT_KEY: recipient_key
         }
 
-        return self.__enqueue_message__(message)
-
-    @validate(gamespace="int", sender="int", message_type="str", recipient_class="str",
-              recipient_key="str", message_uuid="str", payload="json_dict")
-    def update_message(self, gamespace, sender, message_type, recipient_class, recipient_key, message_uuid, payload):
-
-        message = {
+    @staticmethod
+    def updated_message(gamespace, sender, message_type, recipient_class, recipient_key, message_uuid, payload):
+        """
+        Returns a message for the incoming queue that notifies about a message being updated
+        """
+        return {
             AccountConversation.ACTION: AccountConversation.ACTION_MESSAGE_UPDATED,
             AccountConversation.TYPE: message_type,
             AccountConversation.GAMESPACE: gamespace,
@@ -456,7 +564,102 @@ class MessagesQueueModel(Model):
             AccountConversation.PAYLOAD: payload,
         }
 
-        return self.__enqueue_message__(message)
+    @staticmethod
+    def unread_message(gamespace, account_id, unread):
+        """
+        Returns a message for the incoming queue that pushes unread counters to an account,
+            see MessagesHistoryModel.__unread_changed__
+        """
+        return {
+            AccountConversation.ACTION: AccountConversation.ACTION_UNREAD_UPDATED,
+            AccountConversation.TYPE: AccountConversation.UNREAD,
+            AccountConversation.GAMESPACE: gamespace,
+            AccountConversation.MESSAGE_UUID: str(uuid.uuid4()),
+            AccountConversation.SENDER: 0,
+            AccountConversation.RECIPIENT_CLASS: CLASS_USER,
+            AccountConversation.RECIPIENT_KEY: str(account_id),
+            AccountConversation.UNREAD: unread,
+        }
+
+    @validate(gamespace="int", sender="int", message_type="str", recipient_class="str",
+              recipient_key="str", message_uuid="str")
+    def delete_message(self, gamespace, sender, message_type, recipient_class, recipient_key, message_uuid):
+        return self.__enqueue_message__(MessagesQueueModel.deleted_message(
+            gamespace, sender, message_type, recipient_class, recipient_key, message_uuid))
+
+    @validate(gamespace="int", sender="int", message_type="str", recipient_class="str",
+              recipient_key="str", message_uuid="str", payload="json_dict")
+    def update_message(self, gamespace, sender, message_type, recipient_class, recipient_key, message_uuid, payload):
+        return self.__enqueue_message__(MessagesQueueModel.updated_message(
+            gamespace, sender, message_type, recipient_class, recipient_key, message_uuid, payload))
+
+    @validate(gamespace="int", account_id="int", unread="json_list")
+    def update_unread(self, gamespace, account_id, unread):
+        return self.__enqueue_message__(MessagesQueueModel.unread_message(gamespace, account_id, unread))
+
+    async def publish_messages(self, messages):
+        """
+        Publishes a batch of messages into the incoming queue over a single channel,
+            and waits for the broker to confirm them.
+
+        :return: a list of booleans, whether each message has been confirmed
+        """
+
+        if not messages:
+            return []
+
+        # noinspection PyBroadException
+        try:
+            channel = await self.connection.channel()
+        except Exception:
+            logging.exception("Failed to open a channel to publish messages.")
+            return [False] * len(messages)
+
+        properties = BasicProperties(
+            delivery_mode=2,  # make message persistent
+        )
+
+        # delivery tags of a fresh channel in confirm mode start from 1
+        confirms = [Future() for _ in messages]
+
+        def delivered_(m):
+            tag = m.method.delivery_tag
+            acked = isinstance(m.method, pika.spec.Basic.Ack)
+
+            # a single confirm may cover every message up to the tag
+            for index in (range(0, tag) if m.method.multiple else [tag - 1]):
+                if 0 <= index < len(confirms) and not confirms[index].done():
+                    confirms[index].set_result(acked)
+
+        def closed(ch, reason, param):
+            for confirm in confirms:
+                if not confirm.done():
+                    confirm.set_result(False)
+
+        # noinspection PyBroadException
+        try:
+            channel.confirm_delivery(delivered_)
+            channel.add_on_close_callback(closed)
+
+            for message in messages:
+                channel.basic_publish(
+                    '',
+                    self.message_incoming_queue_name,
+                    ujson.dumps(message),
+                    mandatory=True,
+                    properties=properties)
+
+            return await with_timeout(
+                datetime.timedelta(seconds=MessagesQueueModel.DELIVERY_TIMEOUT),
+                multi(confirms))
+        except TimeoutError:
+            logging.error("Broker has not confirmed published messages in time.")
+            return [confirm.done() and confirm.result() for confirm in confirms]
+        except Exception:
+            logging.exception("Failed to publish messages.")
+            return [confirm.done() and confirm.result() for confirm in confirms]
+        finally:
+            channel.close()
 
     @validate(message="json_dict")
     async def __enqueue_message__(self, message):
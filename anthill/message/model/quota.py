@@ -0,0 +1,410 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+from anthill.common.validate import validate
+
+from . import MessageError
+
+import hashlib
+import logging
+
+
+class QuotaAdapter(object):
+    def __init__(self, data):
+        self.gamespace_id = data.get("gamespace_id")
+        self.recipient_class = str(data.get("recipient_class"))
+        self.message_type = str(data.get("message_type") or "")
+        self.messages = int(data.get("quota_messages", 0))
+
+
+class MailboxAdapter(object):
+    def __init__(self, data):
+        self.recipient_class = str(data.get("recipient_class"))
+        self.recipient = str(data.get("recipient"))
+        self.message_type = str(data.get("message_type") or "")
+        self.undelivered = data.get("mailbox_undelivered", 0)
+        self.evicted = data.get("mailbox_evicted", 0)
+
+
+class MailboxQuotasModel(Model):
+    """
+    Limits how many undelivered messages a recipient could have, so mailboxes nobody drains (abandoned
+        accounts, bot targets, huge groups) don't grow forever.
+
+    A quota is defined per gamespace, recipient class and optionally message type (an empty type means
+        every message type without a quota of its own), and a message falls under the most specific one.
+        Undelivered messages are counted per recipient and quota in `message_mailbox`, in the same
+        transaction they're stored, delivered or removed in by the drain.
+
+    Once a mailbox is `eviction_batch` messages over its quota, the oldest undelivered messages are evicted
+        down to the quota, in batches. The counter is recounted before every eviction, so it's fine for it to
+        drift (messages removed some other way are not counted off). Evictions are logged, sent to monitoring
+        as `message.evicted`, and summed up per mailbox for the admin tool.
+
+    Quotas are kept on the primary and cached by every process, counters are kept next to messages.
+    """
+
+    EVENT_QUOTAS = "quotas"
+
+    def __init__(self, db, app, eviction_batch=100, refresh_interval=60):
+        self.db = db
+        self.app = app
+        self.eviction_batch = max(eviction_batch, 1)
+        self.refresh_interval = refresh_interval
+
+        # gamespace -> {(recipient class, message type): quota}
+        self.quotas = {}
+        self.refresh_callback = None
+
+        # mailboxes being evicted by this process
+        self.evicting = set()
+        # messages evicted by this process since it has started
+        self.evicted = 0
+
+    def get_setup_tables(self):
+        return ["message_quotas"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(MailboxQuotasModel, self).started(application)
+        await self.reload()
+
+        if self.refresh_interval:
+            self.refresh_callback = PeriodicCallback(self.__refresh__, self.refresh_interval * 1000)
+            self.refresh_callback.start()
+
+    async def stopped(self):
+        if self.refresh_callback:
+            self.refresh_callback.stop()
+            self.refresh_callback = None
+
+        await super(MailboxQuotasModel, self).stopped()
+
+    def __refresh__(self):
+        IOLoop.current().spawn_callback(self.reload)
+
+    async def reload(self):
+        try:
+            quotas = await self.db.query(
+                """
+                    SELECT *
+                    FROM `message_quotas`;
+                """)
+        except DatabaseError as e:
+            logging.error("Failed to load mailbox quotas: " + e.args[1])
+            return
+
+        result = {}
+
+        for quota in map(QuotaAdapter, quotas):
+            result.setdefault(quota.gamespace_id, {})[(quota.recipient_class, quota.message_type)] = quota.messages
+
+        self.quotas = result
+
+    def event_received(self, event):
+        """
+        A broadcast listener, see MessagesQueueModel.add_broadcast_listener
+        """
+        if event.get("event") == MailboxQuotasModel.EVENT_QUOTAS:
+            IOLoop.current().spawn_callback(self.reload)
+
+    async def __changed__(self):
+        await self.reload()
+        self.app.message_queue.broadcast({"event": MailboxQuotasModel.EVENT_QUOTAS})
+
+    @validate(gamespace="int")
+    async def list_quotas(self, gamespace):
+        try:
+            quotas = await self.db.query(
+                """
+                    SELECT *
+                    FROM `message_quotas`
+                    WHERE `gamespace_id`=%s
+                    ORDER BY `recipient_class`, `message_type`;
+                """, gamespace)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list mailbox quotas: " + e.args[1])
+
+        return list(map(QuotaAdapter, quotas))
+
+    @validate(gamespace="int", recipient_class="str", message_type="str", messages="int")
+    async def set_quota(self, gamespace, recipient_class, message_type, messages):
+        if messages <= 0:
+            raise MessageError(400, "Quota should be positive")
+
+        try:
+            await self.db.execute(
+                """
+                    INSERT INTO `message_quotas`
+                    (`gamespace_id`, `recipient_class`, `message_type`, `quota_messages`)
+                    VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE `quota_messages`=VALUES(`quota_messages`);
+                """, gamespace, recipient_class, message_type, messages)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to set a mailbox quota: " + e.args[1])
+
+        await self.__changed__()
+
+    @validate(gamespace="int", recipient_class="str", message_type="str")
+    async def delete_quota(self, gamespace, recipient_class, message_type):
+        try:
+            await self.db.execute(
+                """
+                    DELETE FROM `message_quotas`
+                    WHERE `gamespace_id`=%s AND `recipient_class`=%s AND `message_type`=%s;
+                """, gamespace, recipient_class, message_type)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to delete a mailbox quota: " + e.args[1])
+
+        await self.__changed__()
+
+    def quota(self, gamespace, recipient_class, message_type):
+        """
+        Returns a (quota type, quota) tuple a message falls under, or None if it has no quota
+        """
+        quotas = self.quotas.get(int(gamespace))
+        if not quotas:
+            return None
+
+        quota = quotas.get((recipient_class, message_type))
+        if quota is not None:
+            return message_type, quota
+
+        quota = quotas.get((recipient_class, ""))
+        if quota is not None:
+            return "", quota
+
+        return None
+
+    def __typed__(self, gamespace, recipient_class):
+        """
+        Returns message types of a recipient class that have quotas of their own
+        """
+        return [
+            message_type
+            for (quota_class, message_type) in self.quotas.get(int(gamespace), {}).keys()
+            if quota_class == recipient_class and message_type
+        ]
+
+    def __deltas__(self, gamespace, messages):
+        """
+        Groups a list of (recipient class, recipient, message type) tuples by mailbox, skipping
+            the ones without a quota, returns a dict of (recipient class, recipient, quota type) -> count
+        """
+        deltas = {}
+
+        for recipient_class, recipient, message_type in messages:
+            quota = self.quota(gamespace, recipient_class, message_type)
+            if quota is None:
+                continue
+            key = (recipient_class, recipient, quota[0])
+            deltas[key] = deltas.get(key, 0) + 1
+
+        return deltas
+
+    async def stored(self, db, gamespace, messages):
+        """
+        Counts undelivered messages that have just been stored, in the caller's transaction
+
+        :param messages: a list of (recipient class, recipient, message type) tuples
+        :return: a list of mailboxes to check once the transaction is committed, see check
+        """
+        deltas = self.__deltas__(gamespace, messages)
+        if not deltas:
+            return []
+
+        await db.execute(
+            """
+                INSERT INTO `message_mailbox`
+                (`gamespace_id`, `recipient_class`, `recipient`, `message_type`, `mailbox_undelivered`)
+                VALUES {0}
+                ON DUPLICATE KEY UPDATE `mailbox_undelivered`=`mailbox_undelivered` + VALUES(`mailbox_undelivered`);
+            """.format(", ".join(["(%s, %s, %s, %s, %s)"] * len(deltas))),
+            *[value for key, delta in deltas.items() for value in (gamespace, *key, delta)])
+
+        mailboxes = await db.query(
+            """
+                SELECT `recipient_class`, `recipient`, `message_type`, `mailbox_undelivered`
+                FROM `message_mailbox`
+                WHERE `gamespace_id`=%s AND (`recipient_class`, `recipient`, `message_type`) IN %s;
+            """, gamespace, list(deltas.keys()))
+
+        return [
+            MailboxAdapter(mailbox)
+            for mailbox in mailboxes
+        ]
+
+    async def delivered(self, db, gamespace, messages):
+        """
+        Counts off undelivered messages that have just been delivered or removed (by the drain, or
+            expired, evicted or purged, see MessagesHistoryModel.__messages_removed__), in the caller's transaction
+
+        :param messages: a list of (recipient class, recipient, message type) tuples
+        """
+        for (recipient_class, recipient, quota_type), delta in self.__deltas__(gamespace, messages).items():
+            await db.execute(
+                """
+                    UPDATE `message_mailbox`
+                    SET `mailbox_undelivered`=GREATEST(CAST(`mailbox_undelivered` AS SIGNED) - %s, 0)
+                    WHERE `gamespace_id`=%s AND `recipient_class`=%s AND `recipient`=%s AND `message_type`=%s;
+                """, delta, gamespace, recipient_class, recipient, quota_type)
+
+    def check(self, gamespace, mailboxes):
+        """
+        Starts evicting mailboxes (see stored) that are far enough over their quotas
+        """
+        for mailbox in mailboxes:
+            quota = self.quotas.get(int(gamespace), {}).get((mailbox.recipient_class, mailbox.message_type))
+
+            if quota is None or mailbox.undelivered < quota + self.eviction_batch:
+                continue
+
+            key = (int(gamespace), mailbox.recipient_class, mailbox.recipient, mailbox.message_type)
+            if key in self.evicting:
+                continue
+
+            IOLoop.current().spawn_callback(self.evict, *key, quota)
+
+    def __condition__(self, gamespace, recipient_class, recipient, quota_type):
+        condition = """
+            `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s AND `message_delivered`=0
+        """
+        args = [gamespace, recipient_class, recipient]
+
+        if quota_type:
+            condition += " AND `message_type`=%s"
+            args.append(quota_type)
+        else:
+            typed = self.__typed__(gamespace, recipient_class)
+            if typed:
+                condition += " AND `message_type` NOT IN %s"
+                args.append(typed)
+
+        return condition, args
+
+    async def evict(self, gamespace, recipient_class, recipient, quota_type, quota):
+        """
+        Recounts a mailbox and evicts its oldest undelivered messages down to the quota, returns how many
+            messages have been evicted
+        """
+        key = (gamespace, recipient_class, recipient, quota_type)
+
+        if key in self.evicting:
+            return 0
+
+        self.evicting.add(key)
+
+        try:
+            return await self.__evict__(gamespace, recipient_class, recipient, quota_type, quota)
+        except MessageError as e:
+            logging.error("Failed to evict mailbox {0}/{1}: {2}".format(recipient_class, recipient, e.message))
+            return 0
+        finally:
+            self.evicting.discard(key)
+
+    async def __evict__(self, gamespace, recipient_class, recipient, quota_type, quota):
+        history = self.app.history
+        shard_db = history.shards.gamespace_db(gamespace, write=True)
+        condition, args = self.__condition__(gamespace, recipient_class, recipient, quota_type)
+
+        # other processes could be evicting the same mailbox
+        lock_name = "message_mailbox_" + hashlib.md5("{0}/{1}/{2}/{3}".format(
+            gamespace, recipient_class, recipient, quota_type).encode("utf-8")).hexdigest()
+
+        try:
+            async with shard_db.acquire() as db:
+                locked = await db.get(
+                    """
+                        SELECT GET_LOCK(%s, 0) AS `locked`;
+                    """, lock_name)
+
+                if not locked or not locked["locked"]:
+                    return 0
+
+                try:
+                    count = await db.get(
+                        """
+                            SELECT COUNT(*) AS `count`
+                            FROM `messages`
+                            WHERE {0};
+                        """.format(condition), *args)
+
+                    excess = count["count"] - quota
+                    evicted = 0
+                    last_message_id = 0
+
+                    while evicted < excess:
+                        deleted, last_message_id = await history.delete_messages_after(
+                            shard_db, condition, args, last_message_id,
+                            limit=min(self.eviction_batch, excess - evicted))
+                        evicted += deleted
+                        if not deleted:
+                            break
+
+                    await db.execute(
+                        """
+                            UPDATE `message_mailbox`
+                            SET `mailbox_undelivered`=%s, `mailbox_evicted`=`mailbox_evicted` + %s
+                            WHERE `gamespace_id`=%s AND `recipient_class`=%s AND `recipient`=%s
+                                AND `message_type`=%s;
+                        """, max(count["count"] - evicted, 0), evicted,
+                        gamespace, recipient_class, recipient, quota_type)
+                finally:
+                    await db.get(
+                        """
+                            SELECT RELEASE_LOCK(%s);
+                        """, lock_name)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to evict a mailbox: " + e.args[1])
+
+        if evicted:
+            self.evicted += evicted
+
+            logging.info("Evicted {0} oldest undelivered message(s) of {1}/{2} in gamespace {3}".format(
+                evicted, recipient_class, recipient, gamespace))
+
+            monitoring = getattr(self.app, "monitoring", None)
+            if monitoring is not None:
+                monitoring.add_action("message.evicted", {"evicted": evicted}, gamespace=str(gamespace),
+                                      recipient_class=recipient_class, message_type=quota_type or "*")
+
+        return evicted
+
+    @validate(gamespace="int", limit="int")
+    async def list_mailboxes(self, gamespace, limit=100):
+        """
+        Returns mailboxes of a gamespace that have had messages evicted, most evicted first
+        """
+        try:
+            mailboxes = await self.app.history.shards.gamespace_db(gamespace).query(
+                """
+                    SELECT *
+                    FROM `message_mailbox`
+                    WHERE `gamespace_id`=%s AND `mailbox_evicted`>0
+                    ORDER BY `mailbox_evicted` DESC
+                    LIMIT %s;
+                """, gamespace, limit)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list mailboxes: " + e.args[1])
+
+        return list(map(MailboxAdapter, mailboxes))
+
+    @staticmethod
+    async def drop_mailboxes(db, gamespace, recipient_class, recipient):
+        await db.execute(
+            """
+                DELETE FROM `message_mailbox`
+                WHERE `gamespace_id`=%s AND `recipient_class`=%s AND `recipient`=%s;
+            """, gamespace, recipient_class, recipient)
+
+    @staticmethod
+    async def drop_mailboxes_like(db, gamespace, recipient_class, recipient_like):
+        await db.execute(
+            """
+                DELETE FROM `message_mailbox`
+                WHERE `gamespace_id`=%s AND `recipient_class`=%s AND `recipient` LIKE %s;
+            """, gamespace, recipient_class, recipient_like)
@@ -0,0 +1,171 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.database import DatabaseError
+
+from . import MessageError
+
+import logging
+
+
+class ReadPositions(object):
+    """
+    A write-behind buffer of last read messages.
+
+    Clients scrolling through history mark dozens of messages as read, but only the newest read
+        message per (account, recipient) matters, so positions are merged in memory and flushed
+        into `last_read_message` with a single multi-row statement once per interval.
+
+    Positions not flushed yet are lost if the process dies, which is fine for read marks:
+        a client would simply mark them again.
+    """
+
+    # rows per statement
+    FLUSH_BATCH = 500
+
+    def __init__(self, shards, interval=1, on_written=None):
+        self.shards = shards
+        self.interval = interval
+        # a coroutine function called with the list of rows once they're written
+        self.on_written = on_written
+
+        # (gamespace, account) -> {(recipient_class, recipient): (time, uuid)}
+        self.pending = {}
+
+        self.flush_callback = None
+        self.flushing = False
+
+    def start(self):
+        if self.interval:
+            self.flush_callback = PeriodicCallback(self.__flush__, self.interval * 1000)
+            self.flush_callback.start()
+
+    async def stop(self):
+        if self.flush_callback:
+            self.flush_callback.stop()
+            self.flush_callback = None
+
+        await self.flush()
+
+    def __flush__(self):
+        IOLoop.current().spawn_callback(self.flush)
+
+    @staticmethod
+    def __merge__(positions, recipient_class, recipient, time, message_uuid):
+        key = (recipient_class, recipient)
+        existing = positions.get(key)
+
+        if existing is None or time >= existing[0]:
+            positions[key] = (time, message_uuid)
+
+    def get_pending(self, gamespace, account_id):
+        """
+        Returns positions of an account that are not flushed yet, as a dict of
+            (recipient_class, recipient) -> (time, uuid)
+        """
+        return self.pending.get((str(gamespace), str(account_id)), {})
+
+    async def add(self, gamespace, account_id, positions):
+        """
+        :param positions: a list of (recipient_class, recipient, time, uuid) tuples
+        """
+        if not self.interval:
+            await self.write([
+                (gamespace, account_id, recipient_class, recipient, time, message_uuid)
+                for recipient_class, recipient, time, message_uuid in positions
+            ])
+            return
+
+        account_positions = self.pending.setdefault((str(gamespace), str(account_id)), {})
+
+        for recipient_class, recipient, time, message_uuid in positions:
+            ReadPositions.__merge__(account_positions, recipient_class, recipient, time, message_uuid)
+
+    async def write(self, rows):
+        """
+        Upserts a list of (gamespace, account, recipient_class, recipient, time, uuid) tuples,
+            a position is only moved forward, never back. Positions of every shard are written even if
+            some shard fails, the error is raised afterwards.
+        """
+
+        # shard index -> (database, rows)
+        shards = {}
+        error = None
+
+        for row in rows:
+            try:
+                db = self.shards.gamespace_db(row[0], write=True)
+            except MessageError as e:
+                error = e
+                continue
+            shards.setdefault(self.shards.index(row[0]), (db, []))[1].append(row)
+
+        written = []
+
+        for db, shard_rows in shards.values():
+            try:
+                await self.__write__(db, shard_rows)
+            except MessageError as e:
+                error = e
+            else:
+                written.extend(shard_rows)
+
+        if written and self.on_written:
+            await self.on_written(written)
+
+        if error is not None:
+            raise error
+
+    @staticmethod
+    async def __write__(db, rows):
+        for offset in range(0, len(rows), ReadPositions.FLUSH_BATCH):
+            batch = rows[offset:offset + ReadPositions.FLUSH_BATCH]
+
+            try:
+                await db.execute(
+                    # the uuid goes first, as assignments see values updated by the previous ones
+                    """
+                        INSERT INTO `last_read_message`
+                        (`gamespace_id`, `account_id`, `message_recipient_class`,
+                            `message_recipient`, `last_message_time`, `last_message_uuid`)
+                        VALUES {0}
+                        ON DUPLICATE KEY UPDATE
+                            `last_message_uuid`=IF(
+                                VALUES(`last_message_time`) >= `last_message_time`,
+                                VALUES(`last_message_uuid`),
+                                `last_message_uuid`
+                            ),
+                            `last_message_time`=IF(
+                                VALUES(`last_message_time`) >= `last_message_time`,
+                                VALUES(`last_message_time`),
+                                `last_message_time`
+                            );
+                    """.format(", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch))),
+                    *[value for row in batch for value in row])
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to mark messages as read: " + e.args[1])
+
+    async def flush(self):
+        if self.flushing or not self.pending:
+            return
+
+        self.flushing = True
+
+        pending, self.pending = self.pending, {}
+
+        try:
+            await self.write([
+                (gamespace, account_id, recipient_class, recipient, time, message_uuid)
+                for (gamespace, account_id), positions in pending.items()
+                for (recipient_class, recipient), (time, message_uuid) in positions.items()
+            ])
+        except MessageError as e:
+            logging.error("Failed to flush read positions: " + e.message)
+
+            # put them back, unless newer ones have been added in the meantime
+            for account, positions in pending.items():
+                account_positions = self.pending.setdefault(account, {})
+                for (recipient_class, recipient), (time, message_uuid) in positions.items():
+                    ReadPositions.__merge__(account_positions, recipient_class, recipient, time, message_uuid)
+        finally:
+            self.flushing = False
@@ -0,0 +1,124 @@
+
+from tornado.concurrent import Future
+
+from . cache import LRUCache
+
+import copy
+
+
+class RecentMessages(object):
+    """
+    A per-process ring buffer of the most recent messages of popular recipients (group inboxes, mostly),
+        so the latest page of them could be served without touching the database.
+
+    A buffer is loaded from the database on the first read, then kept up to date by history events
+        (see MessagesHistoryModel.__history_event__), which every process receives over the broadcast
+        exchange. New messages are pushed in, updated ones are replaced with updated copies, and anything else
+        (a message removed, a recipient dropped) simply drops the buffer so it gets loaded again.
+
+    Memory is capped by the number of buffers, the least recently read ones being evicted first.
+    """
+
+    EVENT_NEW = "new"
+    EVENT_UPDATED = "updated"
+    EVENT_INVALIDATE = "invalidate"
+    EVENT_CLEAR = "clear"
+
+    def __init__(self, size=100, max_recipients=1000):
+        self.size = size
+        self.buffers = LRUCache(max_size=max_recipients)
+
+        # buffers being loaded at the moment, so concurrent reads could share the load
+        self.loading = {}
+        # buffers an event has arrived for while they were loading, the loaded data is already stale
+        self.stale = set()
+
+    @staticmethod
+    def key(gamespace, recipient_class, recipient):
+        return str(gamespace), str(recipient_class), str(recipient)
+
+    def fits(self, offset, limit):
+        return self.size > 0 and not offset and 0 < limit <= self.size
+
+    async def get(self, key, loader):
+        """
+        Returns a list of up to `size` most recent messages, newest first
+
+        :param loader: a coroutine function that loads a number of most recent messages from the database
+        """
+
+        messages = self.buffers.get(key)
+        if messages is not None:
+            return messages
+
+        loading = self.loading.get(key)
+        if loading is not None:
+            return await loading
+
+        loading = Future()
+        self.loading[key] = loading
+
+        try:
+            messages = await loader(self.size)
+        except Exception as e:
+            loading.set_exception(e)
+            # nobody may be waiting for that
+            loading.exception()
+            raise
+        finally:
+            self.loading.pop(key, None)
+
+        if key in self.stale:
+            self.stale.discard(key)
+        else:
+            self.buffers.set(key, messages)
+
+        loading.set_result(messages)
+        return messages
+
+    def __changed__(self, key):
+        if key in self.loading:
+            self.stale.add(key)
+
+    def message_added(self, key, message):
+        self.__changed__(key)
+
+        messages = self.buffers.get(key)
+        if messages is None:
+            return
+
+        if any(existing.message_uuid == message.message_uuid for existing in messages):
+            return
+
+        position = 0
+        while position < len(messages) and messages[position].time > message.time:
+            position += 1
+
+        # buffers are shared with readers, so they're never modified in place
+        self.buffers.set(key, (messages[:position] + [message] + messages[position:])[:self.size])
+
+    def message_updated(self, key, message_uuid, payload):
+        self.__changed__(key)
+
+        messages = self.buffers.get(key)
+        if messages is None:
+            return
+
+        updated = []
+
+        for message in messages:
+            if message.message_uuid == message_uuid:
+                # readers may still hold the message, so it's replaced with an updated copy
+                message = copy.copy(message)
+                message.payload = payload
+            updated.append(message)
+
+        self.buffers.set(key, updated)
+
+    def invalidate(self, key):
+        self.__changed__(key)
+        self.buffers.pop(key)
+
+    def clear(self):
+        self.stale.update(self.loading.keys())
+        self.buffers.clear()
@@ -0,0 +1,114 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+import datetime
+import logging
+
+
+class ReplicaRouter(Model):
+    """
+    Routes reads that tolerate a bit of staleness (history pages, group lookups, admin history)
+        to a read replica, so they don't compete with the inserts on the primary.
+
+    The replica lag is measured with a heartbeat: every `check_interval` seconds the current time is written
+        into `message_heartbeat` on the primary, and read back from the replica. The lag measured that way is at
+        most `check_interval` higher than the actual one. Until the lag has been measured, if it exceeds `max_lag`,
+        or if the replica fails to answer, reads go to the primary.
+
+    Anything that should see its own writes passes primary=True.
+    """
+
+    HEARTBEAT_ID = 1
+
+    def __init__(self, db, replica=None, max_lag=5.0, check_interval=1):
+        self.db = db
+        self.replica = replica
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        self.lag = None
+        self.healthy = False
+
+        self.check_callback = None
+
+    def get_setup_tables(self):
+        return ["message_heartbeat"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(ReplicaRouter, self).started(application)
+
+        if self.replica is not None:
+            await self.check()
+            self.check_callback = PeriodicCallback(self.__check__, max(self.check_interval, 1) * 1000)
+            self.check_callback.start()
+
+    async def stopped(self):
+        if self.check_callback:
+            self.check_callback.stop()
+            self.check_callback = None
+
+        await super(ReplicaRouter, self).stopped()
+
+    def __check__(self):
+        IOLoop.current().spawn_callback(self.check)
+
+    def read_db(self, primary=False):
+        """
+        Returns a database to read from: the replica if it's in sync enough, the primary otherwise
+        """
+        if primary or not self.healthy:
+            return self.db
+        return self.replica
+
+    async def check(self):
+        now = datetime.datetime.utcnow()
+
+        try:
+            # every process writes a heartbeat, the latest one wins
+            await self.db.execute(
+                """
+                    INSERT INTO `message_heartbeat`
+                    (`heartbeat_id`, `heartbeat_time`)
+                    VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        `heartbeat_time`=GREATEST(`heartbeat_time`, VALUES(`heartbeat_time`));
+                """, ReplicaRouter.HEARTBEAT_ID, now)
+        except DatabaseError as e:
+            logging.warning("Failed to write a replica heartbeat: " + e.args[1])
+
+        try:
+            heartbeat = await self.replica.get(
+                """
+                    SELECT `heartbeat_time`
+                    FROM `message_heartbeat`
+                    WHERE `heartbeat_id`=%s;
+                """, ReplicaRouter.HEARTBEAT_ID)
+        except DatabaseError as e:
+            self.__set_lag__(None, "failed to read a heartbeat: " + e.args[1])
+            return
+
+        if heartbeat is None:
+            self.__set_lag__(None, "no heartbeat has been replicated yet")
+            return
+
+        self.__set_lag__(max((datetime.datetime.utcnow() - heartbeat["heartbeat_time"]).total_seconds(), 0))
+
+    def __set_lag__(self, lag, reason=None):
+        healthy = lag is not None and lag <= self.max_lag
+
+        if healthy != self.healthy:
+            if healthy:
+                logging.info("Read replica is back in sync, lag {0:.1f}s".format(lag))
+            elif lag is not None:
+                logging.warning("Read replica lags {0:.1f}s behind, reading from the primary".format(lag))
+            else:
+                logging.warning("Read replica is unavailable ({0}), reading from the primary".format(reason))
+
+        self.lag = lag
+        self.healthy = healthy
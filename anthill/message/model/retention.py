@@ -0,0 +1,431 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+from anthill.common.validate import validate
+
+from . import MessageError
+
+import datetime
+import logging
+
+
+class RetentionPolicyAdapter(object):
+    def __init__(self, data):
+        self.gamespace_id = data.get("gamespace_id")
+        self.message_type = str(data.get("message_type") or "")
+        self.days = int(data.get("retention_days", 0))
+
+    def dump(self):
+        return {
+            "message_type": self.message_type,
+            "days": self.days
+        }
+
+
+class MessagesRetentionModel(Model):
+    """
+    Expires old messages according to retention policies.
+
+    A policy is defined per gamespace and optionally per message type (an empty type means
+        every message type of the gamespace), and keeps messages for a number of days,
+        zero meaning forever. Messages not covered by any policy are kept for a default amount of days.
+
+    If partitioning is enabled, `messages` is range-partitioned by `message_time`, future partitions are
+        created in advance and partitions older than every policy are dropped as a whole, which is
+        O(1) no matter how many messages they have. Policies shorter than that are enforced with
+        small chunked deletes, which only have to look into the oldest partitions.
+
+    Policies are stored on the primary, while messages are expired (and partitions maintained)
+        on every shard, see ShardRouter. Gamespaces being moved between shards are left alone.
+    """
+
+    LOCK_NAME = "message_retention"
+
+    PARTITION_MAX = "pmax"
+    PARTITION_PREFIX = "p"
+
+    # TO_DAYS('0001-01-01') is 366, while date(1, 1, 1).toordinal() is 1
+    TO_DAYS_OFFSET = 365
+
+    def __init__(self, db, history, default_days=0, partitioning=False, partition_days=7,
+                 partitions_ahead=4, interval=3600, batch_size=1000, max_batches=100):
+        self.db = db
+        self.history = history
+        self.default_days = default_days
+        self.partitioning = partitioning
+        self.partition_days = max(partition_days, 1)
+        self.partitions_ahead = partitions_ahead
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+
+        self.maintenance_callback = None
+        self.maintaining = False
+
+    def get_setup_tables(self):
+        return ["message_retention"]
+
+    def get_setup_db(self):
+        return self.db
+
+    async def started(self, application):
+        await super(MessagesRetentionModel, self).started(application)
+
+        for shard_db in self.history.shards.all():
+            partitions = await self.list_partitions(shard_db)
+            if not partitions and self.partitioning:
+                await self.partition_messages(shard_db)
+                partitions = True
+
+            if partitions:
+                # even if partitioning has been disabled since, the uuid key stays the partitioned one
+                self.history.uuids_partitioned = True
+
+        if self.interval:
+            self.maintenance_callback = PeriodicCallback(self.__maintenance__, self.interval * 1000)
+            self.maintenance_callback.start()
+            IOLoop.current().spawn_callback(self.maintain)
+
+    async def stopped(self):
+        if self.maintenance_callback:
+            self.maintenance_callback.stop()
+            self.maintenance_callback = None
+
+        await super(MessagesRetentionModel, self).stopped()
+
+    def __maintenance__(self):
+        IOLoop.current().spawn_callback(self.maintain)
+
+    @validate(gamespace="int")
+    async def list_policies(self, gamespace):
+        try:
+            policies = await self.db.query(
+                """
+                    SELECT *
+                    FROM `message_retention`
+                    WHERE `gamespace_id`=%s
+                    ORDER BY `message_type`;
+                """, gamespace)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list retention policies: " + e.args[1])
+
+        return list(map(RetentionPolicyAdapter, policies))
+
+    async def list_all_policies(self):
+        try:
+            policies = await self.db.query(
+                """
+                    SELECT *
+                    FROM `message_retention`;
+                """)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list retention policies: " + e.args[1])
+
+        return list(map(RetentionPolicyAdapter, policies))
+
+    @validate(gamespace="int", message_type="str", days="int")
+    async def set_policy(self, gamespace, message_type, days):
+        if days < 0:
+            raise MessageError(400, "Retention days cannot be negative")
+
+        try:
+            await self.db.execute(
+                """
+                    INSERT INTO `message_retention`
+                    (`gamespace_id`, `message_type`, `retention_days`)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE `retention_days`=VALUES(`retention_days`);
+                """, gamespace, message_type, days)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to set a retention policy: " + e.args[1])
+
+    @validate(gamespace="int", message_type="str")
+    async def delete_policy(self, gamespace, message_type):
+        try:
+            await self.db.execute(
+                """
+                    DELETE FROM `message_retention`
+                    WHERE `gamespace_id`=%s AND `message_type`=%s;
+                """, gamespace, message_type)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to delete a retention policy: " + e.args[1])
+
+    def longest_retention(self, policies):
+        """
+        Returns the longest amount of days any message is kept for, or None if some are kept forever
+        """
+        days = [self.default_days] + [policy.days for policy in policies]
+
+        if not all(days):
+            return None
+
+        return max(days)
+
+    @staticmethod
+    def partition_name(bound):
+        return MessagesRetentionModel.PARTITION_PREFIX + bound.strftime("%Y%m%d")
+
+    def partition_bound(self, date):
+        """
+        Returns the first partition boundary after the date, boundaries are aligned
+            to the partition size so every process comes up with the same ones
+        """
+        ordinal = date.toordinal()
+        return datetime.date.fromordinal((ordinal // self.partition_days + 1) * self.partition_days)
+
+    @staticmethod
+    async def list_partitions(db):
+        """
+        Returns a list of (partition name, upper bound date) of the `messages` table, ordered by the bound,
+            the bound being None for the last partition. The list is empty if the table is not partitioned.
+        """
+        try:
+            partitions = await db.query(
+                """
+                    SELECT `PARTITION_NAME`, `PARTITION_DESCRIPTION`
+                    FROM `information_schema`.`PARTITIONS`
+                    WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s AND `PARTITION_NAME` IS NOT NULL
+                    ORDER BY `PARTITION_ORDINAL_POSITION`;
+                """, "messages")
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list partitions: " + e.args[1])
+
+        result = []
+
+        for partition in partitions:
+            description = partition["PARTITION_DESCRIPTION"]
+            if description is None or description == "MAXVALUE":
+                bound = None
+            else:
+                bound = datetime.date.fromordinal(int(description) - MessagesRetentionModel.TO_DAYS_OFFSET)
+            result.append((partition["PARTITION_NAME"], bound))
+
+        return result
+
+    def __partition_definitions__(self, bounds):
+        definitions = [
+            "PARTITION `{0}` VALUES LESS THAN (TO_DAYS('{1}'))".format(
+                MessagesRetentionModel.partition_name(bound), bound.isoformat())
+            for bound in bounds
+        ]
+        definitions.append("PARTITION `{0}` VALUES LESS THAN MAXVALUE".format(
+            MessagesRetentionModel.PARTITION_MAX))
+        return ", ".join(definitions)
+
+    async def partition_messages(self, db):
+        """
+        Converts `messages` into a table partitioned by `message_time`. The partitioning column has
+            to be a part of every unique key, so the primary key becomes (`message_id`, `message_time`)
+            and the uuid key becomes (`message_uuid`, `message_time`), so the database only refuses the same
+            uuid stored twice with the same time. Duplicates are looked for before messages are stored instead,
+            see MessagesHistoryModel.uuids_partitioned.
+
+        Warning: this rebuilds the whole table, so it is only done if explicitly enabled and
+            should be scheduled for a maintenance window on big installations.
+        """
+
+        today = datetime.datetime.utcnow().date()
+        first = self.partition_bound(today)
+
+        bounds = [
+            first + datetime.timedelta(days=self.partition_days * index)
+            for index in range(0, self.partitions_ahead + 1)
+        ]
+
+        logging.warning("Partitioning `messages` table, that may take a while")
+
+        try:
+            await db.execute(
+                """
+                    ALTER TABLE `messages`
+                        DROP PRIMARY KEY, ADD PRIMARY KEY (`message_id`, `message_time`),
+                        DROP INDEX `message_uuid`, ADD UNIQUE KEY `message_uuid` (`message_uuid`, `message_time`)
+                    PARTITION BY RANGE (TO_DAYS(`message_time`)) ({0});
+                """.format(self.__partition_definitions__(bounds)))
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to partition messages: " + e.args[1])
+
+        logging.warning("Partitioned `messages` table")
+
+    async def create_partitions(self, db, partitions):
+        """
+        Makes sure there are partitions for the next partitions_ahead periods, by splitting
+            the last (and normally empty) partition
+        """
+        bounds = [bound for name, bound in partitions if bound is not None]
+        if not bounds:
+            return
+
+        target = datetime.datetime.utcnow().date() + datetime.timedelta(
+            days=self.partition_days * self.partitions_ahead)
+
+        last = bounds[-1]
+        new_bounds = []
+
+        while last < target:
+            last = last + datetime.timedelta(days=self.partition_days)
+            new_bounds.append(last)
+
+        if not new_bounds:
+            return
+
+        try:
+            await db.execute(
+                """
+                    ALTER TABLE `messages`
+                    REORGANIZE PARTITION `{0}` INTO ({1});
+                """.format(MessagesRetentionModel.PARTITION_MAX, self.__partition_definitions__(new_bounds)))
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to create partitions: " + e.args[1])
+
+        logging.info("Created message partitions: " + ", ".join(
+            MessagesRetentionModel.partition_name(bound) for bound in new_bounds))
+
+    async def drop_partitions(self, db, partitions, cutoff):
+        """
+        Drops every partition that has only messages older than the cutoff date
+        """
+        for name, bound in partitions:
+            if bound is None or bound > cutoff:
+                continue
+
+            await self.history.partition_expiring(db, name, limit=self.batch_size)
+
+            try:
+                await db.execute(
+                    """
+                        ALTER TABLE `messages`
+                        DROP PARTITION `{0}`;
+                    """.format(name))
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to drop a partition: " + e.args[1])
+
+            logging.info("Dropped expired message partition: " + name)
+
+    async def expire(self, condition, args, days, gamespace=None):
+        """
+        Expires messages matching the condition on the shard of a gamespace, or on every shard
+        """
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+        tables = ["messages", "messages_archive"] if self.history.archive_days else ["messages"]
+        shards = self.history.shards
+
+        if gamespace is not None:
+            if gamespace in shards.list_moving():
+                return
+            targets = [shards.gamespace_db(gamespace)]
+        else:
+            moving = shards.list_moving()
+            if moving:
+                condition, args = condition + " AND `gamespace_id` NOT IN %s", list(args) + [moving]
+            targets = shards.all()
+
+        for shard_db in targets:
+            for table in tables:
+                for batch in range(0, self.max_batches):
+                    deleted = await self.history.expire_messages(
+                        shard_db, condition, args, before, limit=self.batch_size, table=table)
+                    if deleted < self.batch_size:
+                        break
+
+    async def expire_policies(self, policies):
+        """
+        Enforces every policy with chunked deletes. A more specific policy always wins:
+            (gamespace, type), then (gamespace, any type), then the default one.
+        """
+
+        typed = [policy for policy in policies if policy.message_type]
+        gamespaces = [policy for policy in policies if not policy.message_type]
+
+        for policy in typed:
+            if policy.days:
+                await self.expire(
+                    "`gamespace_id`=%s AND `message_type`=%s",
+                    (policy.gamespace_id, policy.message_type), policy.days, gamespace=policy.gamespace_id)
+
+        for policy in gamespaces:
+            if not policy.days:
+                continue
+
+            types = [other.message_type for other in typed if other.gamespace_id == policy.gamespace_id]
+
+            if types:
+                await self.expire(
+                    "`gamespace_id`=%s AND `message_type` NOT IN %s",
+                    (policy.gamespace_id, types), policy.days, gamespace=policy.gamespace_id)
+            else:
+                await self.expire(
+                    "`gamespace_id`=%s",
+                    (policy.gamespace_id,), policy.days, gamespace=policy.gamespace_id)
+
+        if not self.default_days:
+            return
+
+        conditions = ["1"]
+        args = []
+
+        if gamespaces:
+            conditions.append("`gamespace_id` NOT IN %s")
+            args.append([policy.gamespace_id for policy in gamespaces])
+
+        if typed:
+            conditions.append("(`gamespace_id`, `message_type`) NOT IN %s")
+            args.append([(policy.gamespace_id, policy.message_type) for policy in typed])
+
+        await self.expire(" AND ".join(conditions), args, self.default_days)
+
+    async def maintain(self):
+        if self.maintaining:
+            return
+
+        self.maintaining = True
+
+        try:
+            policies = await self.list_all_policies()
+            longest = self.longest_retention(policies)
+
+            if longest is None:
+                self.history.retention_cutoff = None
+            else:
+                self.history.retention_cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=longest)
+
+            async with self.db.acquire() as db:
+                # every process keeps the cutoff up to date, but only one at a time actually expires messages
+                locked = await db.get(
+                    """
+                        SELECT GET_LOCK(%s, 0) AS `locked`;
+                    """, MessagesRetentionModel.LOCK_NAME)
+
+                if not locked or not locked["locked"]:
+                    return
+
+                try:
+                    if self.partitioning:
+                        for shard_db in self.history.shards.all():
+                            partitions = await self.list_partitions(shard_db)
+
+                            if partitions:
+                                await self.create_partitions(shard_db, partitions)
+
+                                if longest is not None:
+                                    await self.drop_partitions(
+                                        shard_db, partitions,
+                                        datetime.datetime.utcnow().date() - datetime.timedelta(days=longest))
+
+                    await self.expire_policies(policies)
+                    await self.history.archive_messages(limit=self.batch_size, max_batches=self.max_batches)
+                finally:
+                    await db.get(
+                        """
+                            SELECT RELEASE_LOCK(%s);
+                        """, MessagesRetentionModel.LOCK_NAME)
+
+        except MessageError as e:
+            logging.error("Failed to maintain message retention: " + e.message)
+        except DatabaseError as e:
+            logging.error("Failed to maintain message retention: " + e.args[1])
+        finally:
+            self.maintaining = False
@@ -0,0 +1,654 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.gen import sleep
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+from . import MessageError
+
+import logging
+
+
+class ShardAdapter(object):
+    def __init__(self, data):
+        self.gamespace = data.get("gamespace_id")
+        self.shard = data.get("shard_id")
+        self.state = data.get("shard_state")
+        self.target = data.get("shard_target")
+
+
+class ShardRouter(Model):
+    """
+    Spreads the message store across a number of MySQL databases (shards), a gamespace at a time.
+
+    A gamespace lives on a single shard with everything it has (messages, inboxes, counters, summaries,
+        groups), so every query and every transaction stays within one database. Gamespaces are on the first
+        shard (the primary database) unless the directory (`message_shards` on the primary) says otherwise,
+        and are moved between shards with move jobs, see move. Configuration (retention policies) and
+        background jobs are kept on the primary.
+
+    Sharding is by gamespace only, so a single gamespace is still bound by write capacity of one database.
+        Spreading recipients of a gamespace across shards would split account inboxes and groups from the
+        messages they refer to, needing scatter-gather reads and cross-shard transactions, and is left out.
+
+    Every process keeps the directory in memory, reloading it once per `refresh_interval`, and right after
+        a move has changed it (see EVENT_SHARDS). While a gamespace is being moved, it's still read from
+        the shard it's being moved from, but writes are refused with 503. As a process could be late to see
+        that, the shard itself refuses writes to a gamespace being moved too, see __fence__.
+
+    To keep ids unique across shards (so a gamespace could be moved with its ids), auto-increment columns
+        of the shard N start at N * id_step.
+    """
+
+    STATE_ACTIVE = "active"
+    STATE_MOVING = "moving"
+
+    EVENT_SHARDS = "shards"
+    JOB_MOVE = "shard_move"
+
+    FENCES_TABLE = "message_shard_fences"
+    FENCES_LOCK = "message_shard_fences"
+
+    # a session variable that lets a move write to a fenced gamespace
+    UNFENCED = "@message_shard_unfenced"
+
+    # while a shard is fenced, every write to a table of a gamespace checks the gamespace is not fenced off
+    #   with a locking read, and holds a shared lock on the sentinel row (gamespace 0) until it commits
+    FENCE_TRIGGER = """
+        CREATE TRIGGER `{0}_fence_{1}` BEFORE {2} ON `{0}`
+        FOR EACH ROW
+        BEGIN
+            DECLARE fenced INT DEFAULT 0;
+            IF {4} IS NULL THEN
+                SELECT IFNULL(SUM(`gamespace_id`<>0), 0) INTO fenced
+                FROM `message_shard_fences`
+                WHERE `gamespace_id` IN (0, {3}.`gamespace_id`)
+                LOCK IN SHARE MODE;
+                IF fenced THEN
+                    SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT='Gamespace is being moved to another shard';
+                END IF;
+            END IF;
+        END
+    """
+
+    # tables a gamespace has on its shard, in the order they're copied in (referenced tables first),
+    #   with a column they're copied in order of, or a list of columns to order by if there's no single one
+    TABLES = [
+        ("groups", "group_id"),
+        ("group_participants", "participation_id"),
+        ("group_clusters", "cluster_id"),
+        ("group_cluster_accounts", ["account_id", "cluster_id", "cluster_data"]),
+        ("messages", "message_id"),
+        ("messages_archive", "message_id"),
+        ("account_inbox", ["account_id", "message_id"]),
+        ("last_read_message", ["account_id", "message_recipient_class", "message_recipient"]),
+        ("message_counters", ["counter_kind", "counter_class", "counter_key"]),
+        ("message_unread", ["account_id", "recipient_class", "recipient"]),
+        ("conversation_summary", ["account_id", "recipient_class", "recipient"]),
+        ("message_mailbox", ["recipient_class", "recipient", "message_type"]),
+        ("message_outbox", "outbox_id"),
+    ]
+
+    def __init__(self, db, app, shards=None, refresh_interval=10, id_step=268435456):
+        self.db = db
+        self.app = app
+        self.shards = [db] + list(shards or [])
+        self.refresh_interval = max(refresh_interval, 1)
+        self.id_step = id_step
+
+        # models that keep their tables on every shard
+        self.models = []
+
+        # gamespace -> ShardAdapter, only for gamespaces that are not on the primary
+        self.directory = {}
+
+        self.refresh_callback = None
+
+    def get_setup_tables(self):
+        return ["message_shards", ShardRouter.FENCES_TABLE]
+
+    def get_setup_db(self):
+        return self.db
+
+    def add_models(self, models):
+        self.models.extend(models)
+
+    async def started(self, application):
+        await super(ShardRouter, self).started(application)
+
+        for index, db in enumerate(self.shards):
+            if index:
+                await self.__setup_shard__(application, index, db)
+
+        await self.reload()
+
+        self.refresh_callback = PeriodicCallback(self.__refresh__, self.refresh_interval * 1000)
+        self.refresh_callback.start()
+
+    async def stopped(self):
+        if self.refresh_callback:
+            self.refresh_callback.stop()
+            self.refresh_callback = None
+
+        await super(ShardRouter, self).stopped()
+
+    async def __setup_shard__(self, application, index, db):
+        """
+        Creates tables of every sharded model on a shard that does not have them yet. There's nothing
+            to fill up on a new shard, so setup_table_ hooks are not called.
+        """
+        tables = [ShardRouter.FENCES_TABLE]
+        for model in self.models:
+            tables.extend(model.get_setup_tables())
+
+        for table_name in tables:
+            try:
+                existing = await db.get(
+                    """
+                        SHOW TABLES LIKE %s;
+                    """, table_name)
+
+                if existing and table_name in existing.values():
+                    continue
+
+                with open(application.module_path("sql/{0}.sql".format(table_name))) as f:
+                    await db.execute(f.read())
+
+                has_id = await db.get(
+                    """
+                        SELECT `AUTO_INCREMENT`
+                        FROM `information_schema`.`TABLES`
+                        WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s;
+                    """, table_name)
+
+                if has_id and has_id["AUTO_INCREMENT"] is not None:
+                    await db.execute(
+                        """
+                            ALTER TABLE `{0}` AUTO_INCREMENT={1};
+                        """.format(table_name, index * self.id_step + 1))
+            except DatabaseError as e:
+                logging.error("Failed to create table '{0}' on shard {1}: {2}".format(
+                    table_name, index, e.args[1]))
+            else:
+                logging.warning("Created table '{0}' on shard {1}".format(table_name, index))
+
+    @staticmethod
+    async def __install_fences__(db):
+        """
+        Creates triggers on every table a gamespace has, that refuse writes to gamespaces fenced off
+            by a move, no matter what a process thinks of the directory
+        """
+        await db.execute(
+            """
+                INSERT IGNORE INTO `message_shard_fences`
+                (`gamespace_id`)
+                VALUES (0);
+            """)
+
+        triggers = await ShardRouter.__triggers__(db)
+
+        for table, key in ShardRouter.TABLES:
+            for event, row in [("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")]:
+                if "{0}_fence_{1}".format(table, event.lower()) in triggers:
+                    continue
+
+                await db.execute(ShardRouter.FENCE_TRIGGER.format(
+                    table, event.lower(), event, row, ShardRouter.UNFENCED))
+
+    @staticmethod
+    async def __remove_fences__(db):
+        """
+        Drops the triggers once no gamespace is fenced off anymore, so writes don't pay for them
+        """
+        fenced = await db.get(
+            """
+                SELECT COUNT(*) AS `count`
+                FROM `message_shard_fences`
+                WHERE `gamespace_id`<>0;
+            """)
+
+        if fenced["count"]:
+            return
+
+        triggers = await ShardRouter.__triggers__(db)
+
+        for table, key in ShardRouter.TABLES:
+            for event in ["insert", "update", "delete"]:
+                name = "{0}_fence_{1}".format(table, event)
+                if name in triggers:
+                    await db.execute(
+                        """
+                            DROP TRIGGER IF EXISTS `{0}`;
+                        """.format(name))
+
+    @staticmethod
+    async def __triggers__(db):
+        triggers = await db.query(
+            """
+                SELECT `TRIGGER_NAME`
+                FROM `information_schema`.`TRIGGERS`
+                WHERE `TRIGGER_SCHEMA`=DATABASE();
+            """)
+
+        return set(trigger["TRIGGER_NAME"] for trigger in triggers)
+
+    @staticmethod
+    async def __lock_fences__(db, index):
+        # shards could be databases of the same server, so every shard has a lock of its own
+        locked = await db.get(
+            """
+                SELECT GET_LOCK(%s, %s) AS `locked`;
+            """, "{0}_{1}".format(ShardRouter.FENCES_LOCK, index), 60)
+
+        if not locked or not locked["locked"]:
+            raise MessageError(409, "Fences of shard {0} are being changed by someone else".format(index))
+
+    @staticmethod
+    async def __unlock_fences__(db, index):
+        await db.get(
+            """
+                SELECT RELEASE_LOCK(%s);
+            """, "{0}_{1}".format(ShardRouter.FENCES_LOCK, index))
+
+    async def __fence__(self, index, gamespace, target):
+        """
+        Makes a shard refuse writes to a gamespace. Fence triggers are only there while a gamespace of a shard
+            is being moved, and are created first: that waits for writes in flight to every table. Writes
+            then hold a shared lock on the sentinel row, so locking it waits for the rest of them to complete,
+            and writes that come after see the fence.
+        """
+        try:
+            async with self.shards[index].acquire(auto_commit=False) as db:
+                await ShardRouter.__lock_fences__(db, index)
+                try:
+                    await ShardRouter.__install_fences__(db)
+                    try:
+                        await db.get(
+                            """
+                                SELECT `gamespace_id`
+                                FROM `message_shard_fences`
+                                WHERE `gamespace_id`=0
+                                FOR UPDATE;
+                            """)
+                        await db.execute(
+                            """
+                                INSERT INTO `message_shard_fences`
+                                (`gamespace_id`, `fence_target`)
+                                VALUES (%s, %s)
+                                ON DUPLICATE KEY UPDATE `fence_target`=VALUES(`fence_target`);
+                            """, gamespace, target)
+                    finally:
+                        await db.commit()
+                finally:
+                    await ShardRouter.__unlock_fences__(db, index)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to fence a gamespace off: " + e.args[1])
+
+    async def __unfence__(self, index, gamespace):
+        try:
+            async with self.shards[index].acquire() as db:
+                await ShardRouter.__lock_fences__(db, index)
+                try:
+                    await db.execute(
+                        """
+                            DELETE FROM `message_shard_fences`
+                            WHERE `gamespace_id`=%s;
+                        """, gamespace)
+                    await ShardRouter.__remove_fences__(db)
+                finally:
+                    await ShardRouter.__unlock_fences__(db, index)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to lift a fence: " + e.args[1])
+
+    @staticmethod
+    async def __unfenced__(db, unfenced):
+        """
+        Lets a connection write to fenced gamespaces (or not anymore), connections are pooled so it's to be undone
+        """
+        await db.execute(
+            """
+                SET {0}=%s;
+            """.format(ShardRouter.UNFENCED), 1 if unfenced else None)
+
+    def __refresh__(self):
+        IOLoop.current().spawn_callback(self.reload)
+
+    async def reload(self):
+        try:
+            shards = await self.db.query(
+                """
+                    SELECT *
+                    FROM `message_shards`;
+                """)
+        except DatabaseError as e:
+            logging.error("Failed to load shard directory: " + e.args[1])
+            return
+
+        self.directory = {
+            shard["gamespace_id"]: ShardAdapter(shard)
+            for shard in shards
+        }
+
+    def event_received(self, event):
+        """
+        A broadcast listener, see MessagesQueueModel.add_broadcast_listener
+        """
+        if event.get("event") == ShardRouter.EVENT_SHARDS:
+            IOLoop.current().spawn_callback(self.reload)
+
+    def index(self, gamespace):
+        shard = self.directory.get(int(gamespace))
+        return shard.shard if shard is not None else 0
+
+    def gamespace_db(self, gamespace, write=False):
+        """
+        Returns a database a gamespace is stored on
+
+        :param write: if the caller is going to change anything, which is refused while the gamespace is being moved
+        """
+        shard = self.directory.get(int(gamespace))
+
+        if shard is None:
+            return self.db
+
+        if write and shard.state == ShardRouter.STATE_MOVING:
+            raise MessageError(503, "Gamespace is being moved to another shard, try again later")
+
+        if shard.shard >= len(self.shards):
+            raise MessageError(500, "Gamespace is stored on shard {0} which is not configured".format(shard.shard))
+
+        return self.shards[shard.shard]
+
+    def all(self):
+        return list(self.shards)
+
+    def owns(self, index, gamespace):
+        """
+        Returns True if a gamespace is stored on a shard and could be written to there
+        """
+        shard = self.directory.get(int(gamespace))
+        if shard is None:
+            return index == 0
+        return shard.shard == index and shard.state == ShardRouter.STATE_ACTIVE
+
+    def list_moving(self):
+        return [
+            gamespace
+            for gamespace, shard in self.directory.items()
+            if shard.state == ShardRouter.STATE_MOVING
+        ]
+
+    def list_moved(self):
+        return sorted(self.directory.values(), key=lambda shard: shard.gamespace)
+
+    async def count_messages(self):
+        """
+        Returns a list of (shard index, number of messages), estimated
+        """
+        result = []
+
+        for index, db in enumerate(self.shards):
+            try:
+                status = await db.get(
+                    """
+                        SELECT `TABLE_ROWS` AS `count`
+                        FROM `information_schema`.`TABLES`
+                        WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s;
+                    """, "messages")
+            except DatabaseError as e:
+                raise MessageError(500, "Failed to count messages on shard {0}: {1}".format(index, e.args[1]))
+
+            result.append((index, status["count"] if status else 0))
+
+        return result
+
+    async def move(self, gamespace, target):
+        """
+        Starts moving a gamespace onto another shard with a background job, see move_stages
+        """
+        source = self.index(gamespace)
+
+        if target < 0 or target >= len(self.shards):
+            raise MessageError(400, "No such shard")
+
+        if target == source:
+            raise MessageError(409, "Gamespace is already there")
+
+        shard = self.directory.get(int(gamespace))
+        if shard is not None and shard.state == ShardRouter.STATE_MOVING:
+            raise MessageError(409, "Gamespace is being moved already")
+
+        return await self.app.jobs.add(gamespace, ShardRouter.JOB_MOVE, {
+            "source": source,
+            "target": target
+        })
+
+    async def __set_directory__(self, gamespace, shard, state, target=None, wait=True):
+        try:
+            if shard == 0 and state == ShardRouter.STATE_ACTIVE:
+                await self.db.execute(
+                    """
+                        DELETE FROM `message_shards`
+                        WHERE `gamespace_id`=%s;
+                    """, gamespace)
+            else:
+                await self.db.execute(
+                    """
+                        INSERT INTO `message_shards`
+                        (`gamespace_id`, `shard_id`, `shard_state`, `shard_target`)
+                        VALUES (%s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE `shard_id`=VALUES(`shard_id`), `shard_state`=VALUES(`shard_state`),
+                            `shard_target`=VALUES(`shard_target`);
+                    """, gamespace, shard, state, target)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to update shard directory: " + e.args[1])
+
+        await self.reload()
+        self.app.message_queue.broadcast({"event": ShardRouter.EVENT_SHARDS})
+
+        if wait:
+            # lets every process follow the change before the data is gone, writes are guarded by fences anyway
+            await sleep(self.refresh_interval + 1)
+
+    async def __check_moving__(self, gamespace, source, target):
+        try:
+            shard = await self.db.get(
+                """
+                    SELECT *
+                    FROM `message_shards`
+                    WHERE `gamespace_id`=%s;
+                """, gamespace)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to check shard directory: " + e.args[1])
+
+        if shard is None or shard["shard_state"] != ShardRouter.STATE_MOVING or \
+                shard["shard_id"] != source or shard["shard_target"] != target:
+            raise MessageError(409, "The move has been aborted")
+
+    async def abort_move(self, gamespace):
+        """
+        Lets a gamespace be written to again on the shard it was being moved from, after a move has failed
+        """
+        shard = self.directory.get(int(gamespace))
+
+        if shard is None or shard.state != ShardRouter.STATE_MOVING:
+            raise MessageError(409, "Gamespace is not being moved")
+
+        if shard.shard < len(self.shards):
+            await self.__unfence__(shard.shard, gamespace)
+
+        await self.__set_directory__(gamespace, shard.shard, ShardRouter.STATE_ACTIVE)
+
+    def move_stages(self, gamespace, args):
+        """
+        Stages of a move job: writes to the gamespace are stopped, leftovers of a previous attempt are deleted
+            from the target shard, every table is copied over in chunks and the copy is verified, then
+            the gamespace is switched to the target shard and deleted from the source one. Reads are served
+            from the source shard until the switch.
+
+        Writes are refused by processes as soon as they see the directory change, and by the source shard
+            itself once it's fenced off (see __fence__), so nothing is written there after the copy has started,
+            even by a process that has missed the change. The fence is lifted once the gamespace is deleted
+            from the source shard, by then every process has followed the switch.
+        """
+        source = args["source"]
+        target = args["target"]
+
+        # shards could have been configured differently since the job has been added
+        configured = source < len(self.shards) and target < len(self.shards)
+        source_db = self.shards[source] if configured else None
+        target_db = self.shards[target] if configured else None
+
+        async def freeze(checkpoint, limit):
+            if not configured:
+                raise MessageError(500, "Shard is not configured")
+            current = self.directory.get(int(gamespace))
+            if current is None or current.state != ShardRouter.STATE_MOVING:
+                if self.index(gamespace) != source:
+                    raise MessageError(409, "Gamespace has been moved since")
+            await self.__set_directory__(gamespace, source, ShardRouter.STATE_MOVING, target, wait=False)
+            await self.__fence__(source, gamespace, target)
+            return 0, 0
+
+        def delete(shard_db, table):
+            async def stage(checkpoint, limit):
+                try:
+                    async with shard_db.acquire() as db:
+                        await ShardRouter.__unfenced__(db, True)
+                        try:
+                            deleted = await db.execute(
+                                """
+                                    DELETE FROM `{0}`
+                                    WHERE `gamespace_id`=%s
+                                    LIMIT %s;
+                                """.format(table), gamespace, limit)
+                        finally:
+                            await ShardRouter.__unfenced__(db, False)
+                except DatabaseError as e:
+                    raise MessageError(500, "Failed to delete from {0}: {1}".format(table, e.args[1]))
+                return deleted, 0
+            return stage
+
+        def copy(table, key):
+            async def stage(checkpoint, limit):
+                await self.__check_moving__(gamespace, source, target)
+                return await self.__copy__(source_db, target_db, gamespace, table, key, checkpoint, limit)
+            return stage
+
+        async def verify(checkpoint, limit):
+            await self.__check_moving__(gamespace, source, target)
+            for table, key in ShardRouter.TABLES:
+                copied = await ShardRouter.__count__(target_db, gamespace, table)
+                expected = await ShardRouter.__count__(source_db, gamespace, table)
+                if copied != expected:
+                    raise MessageError(500, "Copy of {0} is incomplete: {1} rows out of {2}".format(
+                        table, copied, expected))
+            return 0, 0
+
+        async def switch(checkpoint, limit):
+            await self.__check_moving__(gamespace, source, target)
+            await self.__set_directory__(gamespace, target, ShardRouter.STATE_ACTIVE)
+            return 0, 0
+
+        async def release(checkpoint, limit):
+            if not configured:
+                raise MessageError(500, "Shard is not configured")
+            await self.__unfence__(source, gamespace)
+            return 0, 0
+
+        stages = [freeze]
+        stages.extend(delete(target_db, table) for table, key in reversed(ShardRouter.TABLES))
+        stages.extend(copy(table, key) for table, key in ShardRouter.TABLES)
+        stages.append(verify)
+        stages.append(switch)
+        stages.extend(delete(source_db, table) for table, key in reversed(ShardRouter.TABLES))
+        stages.append(release)
+        return stages
+
+    @staticmethod
+    async def __count__(shard_db, gamespace, table):
+        try:
+            counted = await shard_db.get(
+                """
+                    SELECT COUNT(*) AS `count`
+                    FROM `{0}`
+                    WHERE `gamespace_id`=%s;
+                """.format(table), gamespace)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to count {0}: {1}".format(table, e.args[1]))
+
+        return counted["count"]
+
+    @staticmethod
+    async def __copy__(source_db, target_db, gamespace, table, key, checkpoint, limit):
+        """
+        Copies a chunk of rows of a gamespace, returns (rows copied, checkpoint). Tables with an id are copied
+            in order of it, the checkpoint being the last id, others by offset (nothing is written to the
+            gamespace meanwhile, so offsets are stable).
+        """
+        try:
+            if isinstance(key, str):
+                rows = await source_db.query(
+                    """
+                        SELECT *
+                        FROM `{0}`
+                        WHERE `gamespace_id`=%s AND `{1}`>%s
+                        ORDER BY `{1}` ASC
+                        LIMIT %s;
+                    """.format(table, key), gamespace, checkpoint, limit)
+            else:
+                rows = await source_db.query(
+                    """
+                        SELECT *
+                        FROM `{0}`
+                        WHERE `gamespace_id`=%s
+                        ORDER BY {1}
+                        LIMIT %s, %s;
+                    """.format(table, ", ".join("`{0}`".format(column) for column in key)),
+                    gamespace, checkpoint, limit)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to read {0}: {1}".format(table, e.args[1]))
+
+        if not rows:
+            return 0, checkpoint
+
+        columns = list(rows[0].keys())
+
+        try:
+            async with target_db.acquire(auto_commit=False) as db:
+                await ShardRouter.__unfenced__(db, True)
+                try:
+                    if isinstance(key, str):
+                        # a chunk copied before an interruption is copied again, while ids of other
+                        #   gamespaces are never overwritten: a collision fails the move instead
+                        await db.execute(
+                            """
+                                DELETE FROM `{0}`
+                                WHERE `gamespace_id`=%s AND `{1}` IN %s;
+                            """.format(table, key), gamespace, [row[key] for row in rows])
+
+                    await db.execute(
+                        """
+                            INSERT {0} INTO `{1}`
+                            ({2})
+                            VALUES {3};
+                        """.format(
+                            "" if isinstance(key, str) else "IGNORE", table,
+                            ", ".join("`{0}`".format(column) for column in columns),
+                            ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(rows))),
+                        *[row[column] for row in rows for column in columns])
+                except DatabaseError:
+                    await db.rollback()
+                    raise
+                else:
+                    await db.commit()
+                finally:
+                    await ShardRouter.__unfenced__(db, False)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to copy {0}: {1}".format(table, e.args[1]))
+
+        if isinstance(key, str):
+            return len(rows), rows[-1][key]
+
+        return len(rows), checkpoint + len(rows)
@@ -0,0 +1,303 @@
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.gen import Future
+
+from . import MessageError, MessageFlags, CLASS_USER
+from . counters import conversation_key
+
+import datetime
+import logging
+import fcntl
+import ujson
+import os
+import re
+
+
+class MessageSpool(object):
+    """
+    A local write-ahead spool for messages that could not be stored because the database is degraded,
+        so the incoming queue keeps being consumed (live delivery does not need the database) instead
+        of backing up on the broker.
+
+    The spool is a directory of append-only segments, one NDJSON line per message. An append is only
+        acknowledged once it's on disk, but appends that come in within `sync_delay` share a single fsync.
+        A segment is closed once it grows beyond `segment_size`.
+
+    A replayer drains the spool into the history in id order, `batch_size` messages at a time with
+        multi-row inserts (see MessagesHistoryModel.add_messages_bulk), and deletes every segment
+        it has drained. Messages keep their uuids, so replaying a segment again after a crash is harmless.
+        If the database is still failing, the replayer stops and tries again in `replay_interval` seconds.
+
+    While anything is left in the spool, new messages are spooled too, so they're stored in the order
+        they have come in. Every process needs a spool directory of its own, it's locked while in use.
+    """
+
+    SEGMENT_PATTERN = re.compile(r"^spool-(\d+)\.log$")
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, history, path=None, segment_size=67108864, sync_delay=0.01, replay_interval=1,
+                 batch_size=500):
+        self.history = history
+        self.path = path
+        self.segment_size = max(segment_size, 1)
+        self.sync_delay = sync_delay
+        self.replay_interval = max(replay_interval, 1)
+        self.batch_size = max(batch_size, 1)
+
+        self.lock = None
+        # sequence numbers of segments on disk, oldest first, the last one may be open for appends
+        self.segments = []
+
+        self.file = None
+        self.size = 0
+        self.synced = 0
+        # a future every append waits for, resolved by the next fsync
+        self.sync_future = None
+        self.syncing = False
+
+        # the position the replayer has reached in the oldest segment
+        self.replay_offset = 0
+        self.replay_callback = None
+        self.replaying = False
+
+    @property
+    def enabled(self):
+        return self.lock is not None
+
+    def pending(self):
+        """
+        Returns True if there are spooled messages not replayed yet
+        """
+        return bool(self.segments)
+
+    def __segment_path__(self, seq):
+        return os.path.join(self.path, "spool-{0:012d}.log".format(seq))
+
+    def start(self):
+        if not self.path:
+            return
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            self.lock = open(os.path.join(self.path, "lock"), "w")
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            logging.error("Message spool at '{0}' is disabled: {1}".format(self.path, str(e)))
+            if self.lock is not None:
+                self.lock.close()
+                self.lock = None
+            return
+
+        for file_name in os.listdir(self.path):
+            match = MessageSpool.SEGMENT_PATTERN.match(file_name)
+            if match:
+                self.segments.append(int(match.group(1)))
+
+        self.segments.sort()
+
+        if self.segments:
+            logging.warning("Message spool has {0} segment(s) left to replay".format(len(self.segments)))
+
+        self.replay_callback = PeriodicCallback(self.__replay__, self.replay_interval * 1000)
+        self.replay_callback.start()
+
+    async def stop(self):
+        if self.replay_callback:
+            self.replay_callback.stop()
+            self.replay_callback = None
+
+        if self.sync_future is not None:
+            await self.sync_future
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+    def __replay__(self):
+        IOLoop.current().spawn_callback(self.replay)
+
+    @staticmethod
+    def record(gamespace, sender, message_uuid, recipient_class, recipient, time, message_type, payload,
+               flags, delivered, ttl=0):
+        return {
+            "gamespace": gamespace,
+            "uuid": message_uuid,
+            "sender": sender,
+            "recipient_class": recipient_class,
+            "recipient": recipient,
+            "time": time.strftime(MessageSpool.TIME_FORMAT),
+            "type": message_type,
+            "payload": payload,
+            "flags": flags.as_list(),
+            "delivered": bool(delivered),
+            "ttl": ttl
+        }
+
+    async def append(self, record):
+        """
+        Writes a record (see record) into the spool, returns once it's on disk
+        """
+        if not self.enabled:
+            raise MessageError(503, "Message spool is disabled")
+
+        try:
+            if self.file is None:
+                seq = self.segments[-1] + 1 if self.segments else 1
+                self.file = open(self.__segment_path__(seq), "ab")
+                self.segments.append(seq)
+                self.size = self.synced = 0
+
+            line = ujson.dumps(record).encode("utf-8") + b"\n"
+            self.file.write(line)
+            self.size += len(line)
+        except OSError as e:
+            raise MessageError(500, "Failed to spool a message: " + str(e))
+
+        if self.sync_future is None:
+            self.sync_future = Future()
+            IOLoop.current().call_later(self.sync_delay, self.__sync__)
+
+        await self.sync_future
+
+    def __sync__(self):
+        IOLoop.current().spawn_callback(self.sync)
+
+    async def sync(self):
+        if self.syncing:
+            # one fsync at a time, appends that came in meanwhile wait for the next one
+            IOLoop.current().call_later(self.sync_delay, self.__sync__)
+            return
+
+        future, self.sync_future = self.sync_future, None
+        self.syncing = True
+
+        try:
+            self.file.flush()
+            size = self.size
+            await IOLoop.current().run_in_executor(None, os.fsync, self.file.fileno())
+            self.synced = size
+
+            # the segment is only closed once nothing waits for it to be synced
+            if self.size >= self.segment_size and self.sync_future is None:
+                self.file.close()
+                self.file = None
+        except OSError as e:
+            future.set_exception(MessageError(500, "Failed to spool a message: " + str(e)))
+        else:
+            future.set_result(None)
+        finally:
+            self.syncing = False
+
+    @staticmethod
+    def __row__(record):
+        recipient_class = str(record["recipient_class"])
+        recipient = str(record["recipient"])
+        sender = int(record["sender"])
+        time = datetime.datetime.strptime(record["time"], MessageSpool.TIME_FORMAT)
+        ttl = int(record.get("ttl") or 0)
+
+        return {
+            "message_uuid": str(record["uuid"]),
+            "message_sender": sender,
+            "message_recipient_class": recipient_class,
+            "message_recipient": recipient,
+            "message_time": time,
+            "message_type": str(record["type"]),
+            "message_payload": ujson.dumps(record["payload"]),
+            "message_delivered": int(bool(record["delivered"])),
+            "message_flags": MessageFlags(record["flags"]).dump(),
+            "message_conversation": conversation_key(
+                sender, recipient) if recipient_class == CLASS_USER else None,
+            "message_expires": time + datetime.timedelta(seconds=ttl) if ttl > 0 else None
+        }
+
+    def __read_batch__(self, seq, offset, end):
+        """
+        Reads up to batch_size complete lines of a segment past the offset and up to the end,
+            returns a (list of records, offset after them) tuple. Corrupted lines are skipped.
+        """
+        records = []
+
+        with open(self.__segment_path__(seq), "rb") as f:
+            f.seek(offset)
+
+            while len(records) < self.batch_size and offset < end:
+                line = f.readline(end - offset)
+                if not line.endswith(b"\n"):
+                    # a line torn by a crash, or not synced yet
+                    break
+
+                offset += len(line)
+
+                try:
+                    records.append(ujson.loads(line))
+                except ValueError:
+                    logging.error("Skipping a corrupted spool line: " + line.decode("utf-8", "replace")[:256])
+
+        return records, offset
+
+    async def replay(self):
+        if self.replaying or not self.enabled:
+            return
+
+        self.replaying = True
+
+        try:
+            while self.segments:
+                seq = self.segments[0]
+                active = self.file is not None and seq == self.segments[-1]
+
+                try:
+                    end = self.synced if active else os.path.getsize(self.__segment_path__(seq))
+                    records, offset = self.__read_batch__(seq, self.replay_offset, end)
+                except OSError as e:
+                    logging.error("Failed to read message spool: " + str(e))
+                    return
+
+                # a batch is stored gamespace by gamespace, every one keeps its order
+                by_gamespace = {}
+
+                for record in records:
+                    try:
+                        by_gamespace.setdefault(int(record["gamespace"]), []).append(MessageSpool.__row__(record))
+                    except (KeyError, ValueError, TypeError):
+                        logging.error("Skipping a corrupted spool record: " + str(record)[:256])
+
+                try:
+                    for gamespace, rows in by_gamespace.items():
+                        await self.history.add_messages_bulk(gamespace, rows)
+                except MessageError as e:
+                    logging.warning("Failed to replay message spool, will retry: " + e.message)
+                    return
+
+                progress = offset > self.replay_offset
+                self.replay_offset = offset
+
+                if offset < end:
+                    if progress:
+                        continue
+                    if active:
+                        return
+                    logging.warning("Dropping a torn line at the end of spool segment {0}".format(seq))
+                elif active:
+                    if self.syncing or self.sync_future is not None or self.size != self.synced:
+                        return
+                    self.file.close()
+                    self.file = None
+
+                try:
+                    os.remove(self.__segment_path__(seq))
+                except OSError as e:
+                    logging.error("Failed to remove a replayed spool segment: " + str(e))
+                    return
+
+                self.segments.pop(0)
+                self.replay_offset = 0
+
+                logging.info("Replayed message spool segment {0}".format(seq))
+        finally:
+            self.replaying = False
@@ -0,0 +1,275 @@
+
+from anthill.common.database import DatabaseError
+
+from . import MessageError, CLASS_USER
+from . counters import conversation_key
+
+import ujson
+
+
+class ConversationSummaryAdapter(object):
+    def __init__(self, data):
+        self.recipient_class = data.get("recipient_class")
+        self.recipient = data.get("recipient")
+        self.message_uuid = data.get("last_message_uuid")
+        self.sender = str(data.get("last_message_sender"))
+        self.time = data.get("last_message_time")
+        self.message_type = data.get("last_message_type")
+        self.preview = data.get("last_message_preview")
+        if isinstance(self.preview, str):
+            self.preview = ujson.loads(self.preview)
+
+    def dump(self):
+        return {
+            "reply_to": {
+                "recipient_class": self.recipient_class,
+                "recipient": self.recipient
+            },
+            "last_message": {
+                "uuid": self.message_uuid,
+                "sender": self.sender,
+                "time": str(self.time),
+                "type": self.message_type,
+                "payload": self.preview
+            }
+        }
+
+
+class ConversationSummaries(object):
+    """
+    Keeps the last message of every conversation an account has, so a list of conversations
+        could be served with a single indexed read instead of scanning the account's history.
+
+    A conversation is identified the way a client would reply into it: the other account for direct
+        messages, or the group recipient. Summaries follow `account_inbox`, so a message is summarized
+        for exactly the accounts that would see it in their inbox.
+
+    Payloads are only kept if they're small enough, a client is expected to fetch bigger ones by uuid.
+    """
+
+    # a page of conversations of an account, with extra conditions formatted in
+    LIST_QUERY = """
+        SELECT *
+        FROM `conversation_summary`
+        WHERE `gamespace_id`=%s AND `account_id`=%s{0}
+        ORDER BY `last_message_time` DESC
+        LIMIT %s, %s;
+    """
+
+    COLUMNS = """
+        (`gamespace_id`, `account_id`, `recipient_class`, `recipient`, `last_message_id`, `last_message_uuid`,
+            `last_message_sender`, `last_message_time`, `last_message_type`, `last_message_preview`)
+    """
+
+    # a message only replaces the one summarized if it's newer, the time goes last
+    #   as assignments see values updated by the previous ones
+    UPSERT = """
+        ON DUPLICATE KEY UPDATE
+            `last_message_id`=IF(
+                VALUES(`last_message_time`) >= `last_message_time`, VALUES(`last_message_id`), `last_message_id`),
+            `last_message_uuid`=IF(
+                VALUES(`last_message_time`) >= `last_message_time`, VALUES(`last_message_uuid`), `last_message_uuid`),
+            `last_message_sender`=IF(
+                VALUES(`last_message_time`) >= `last_message_time`, VALUES(`last_message_sender`),
+                `last_message_sender`),
+            `last_message_type`=IF(
+                VALUES(`last_message_time`) >= `last_message_time`, VALUES(`last_message_type`), `last_message_type`),
+            `last_message_preview`=IF(
+                VALUES(`last_message_time`) >= `last_message_time`, VALUES(`last_message_preview`),
+                `last_message_preview`),
+            `last_message_time`=IF(
+                VALUES(`last_message_time`) >= `last_message_time`, VALUES(`last_message_time`), `last_message_time`)
+    """
+
+    def __init__(self, shards, preview_size=1024):
+        self.shards = shards
+        self.preview_size = preview_size
+
+    def __select_inbox__(self, condition):
+        """
+        Selects summary rows for inbox entries (`i`) of messages (`m`) matching the condition,
+            the conversation of a direct message being the other account
+        """
+        return """
+            SELECT `i`.`gamespace_id`, `i`.`account_id`, `m`.`message_recipient_class`,
+                IF(`m`.`message_recipient_class`=%s AND `m`.`message_recipient`=CAST(`i`.`account_id` AS CHAR),
+                    CAST(`m`.`message_sender` AS CHAR), `m`.`message_recipient`),
+                `m`.`message_id`, `m`.`message_uuid`, `m`.`message_sender`, `m`.`message_time`, `m`.`message_type`,
+                IF(`m`.`message_payload_packed` IS NULL AND LENGTH(`m`.`message_payload`)<=%s,
+                    `m`.`message_payload`, NULL)
+            FROM `account_inbox` AS `i`
+                INNER JOIN `messages` AS `m` ON `m`.`message_id`=`i`.`message_id`
+            WHERE {0}
+        """.format(condition)
+
+    async def message_added(self, db, gamespace, message_id):
+        """
+        Summarizes a message for every account it has been put into inbox of
+        """
+        await db.execute(
+            """
+                INSERT INTO `conversation_summary` {0}
+                {1}
+                {2};
+            """.format(
+                ConversationSummaries.COLUMNS,
+                self.__select_inbox__("`i`.`gamespace_id`=%s AND `i`.`message_id`=%s"),
+                ConversationSummaries.UPSERT),
+            CLASS_USER, self.preview_size, gamespace, message_id)
+
+    async def summarize(self, db, after, last):
+        """
+        Summarizes messages with ids in (after, last] for every account that has them in its inbox,
+            only meant to fill up summaries of an existing history, see MessagesHistoryModel.backfill_summaries_stages
+        """
+        await db.execute(
+            """
+                INSERT INTO `conversation_summary` {0}
+                {1}
+                ORDER BY `m`.`message_id`
+                {2};
+            """.format(
+                ConversationSummaries.COLUMNS,
+                self.__select_inbox__("`i`.`message_id`>%s AND `i`.`message_id`<=%s"),
+                ConversationSummaries.UPSERT),
+            CLASS_USER, self.preview_size, after, last)
+
+    async def recipient_joined(self, db, gamespace, account_id, recipient_class, recipient):
+        await db.execute(
+            """
+                INSERT INTO `conversation_summary` {0}
+                SELECT `gamespace_id`, %s, `message_recipient_class`, `message_recipient`,
+                    `message_id`, `message_uuid`, `message_sender`, `message_time`, `message_type`,
+                    IF(`message_payload_packed` IS NULL AND LENGTH(`message_payload`)<=%s, `message_payload`, NULL)
+                FROM `messages`
+                WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                ORDER BY `message_time` DESC
+                LIMIT 1
+                {1};
+            """.format(ConversationSummaries.COLUMNS, ConversationSummaries.UPSERT),
+            account_id, self.preview_size, gamespace, recipient_class, recipient)
+
+    async def recipient_left(self, db, gamespace, account_id, recipient_class, recipient):
+        await db.execute(
+            """
+                DELETE FROM `conversation_summary`
+                WHERE `gamespace_id`=%s AND `account_id`=%s AND `recipient_class`=%s AND `recipient`=%s;
+            """, gamespace, account_id, recipient_class, recipient)
+
+    async def recipient_removed(self, db, gamespace, recipient_class, recipient):
+        await db.execute(
+            """
+                DELETE FROM `conversation_summary`
+                WHERE `gamespace_id`=%s AND `recipient_class`=%s AND `recipient`=%s;
+            """, gamespace, recipient_class, recipient)
+
+    async def recipient_removed_like(self, db, gamespace, recipient_class, recipient_like):
+        await db.execute(
+            """
+                DELETE FROM `conversation_summary`
+                WHERE `gamespace_id`=%s AND `recipient_class`=%s AND `recipient` LIKE %s;
+            """, gamespace, recipient_class, recipient_like)
+
+    async def message_updated(self, db, gamespace, message_id, payload):
+        payload = ujson.dumps(payload)
+
+        await db.execute(
+            """
+                UPDATE `conversation_summary`
+                SET `last_message_preview`=%s
+                WHERE `gamespace_id`=%s AND `last_message_id`=%s;
+            """, payload if len(payload) <= self.preview_size else None, gamespace, message_id)
+
+    async def messages_removed(self, db, gamespace, messages):
+        """
+        Replaces summaries of messages being removed with previous messages of their conversations,
+            or drops them if there are none left. May be called either before or after messages are deleted.
+
+        :param messages: a list of dicts with `message_id`, `message_sender`, `message_recipient_class`
+            and `message_recipient` keys
+        """
+
+        if not messages:
+            return
+
+        removed_ids = [message["message_id"] for message in messages]
+
+        summarized = await db.query(
+            """
+                SELECT DISTINCT `last_message_id`
+                FROM `conversation_summary`
+                WHERE `gamespace_id`=%s AND `last_message_id` IN %s;
+            """, gamespace, removed_ids)
+
+        summarized = set(summary["last_message_id"] for summary in summarized)
+
+        for message in messages:
+            if message["message_id"] not in summarized:
+                continue
+
+            recipient_class = message["message_recipient_class"]
+            recipient = message["message_recipient"]
+
+            if recipient_class == CLASS_USER:
+                previous = await db.get(
+                    """
+                        SELECT *
+                        FROM `messages`
+                        WHERE `gamespace_id`=%s AND `message_conversation`=%s AND `message_id` NOT IN %s
+                        ORDER BY `message_id` DESC
+                        LIMIT 1;
+                    """, gamespace, conversation_key(message["message_sender"], recipient), removed_ids)
+            else:
+                previous = await db.get(
+                    """
+                        SELECT *
+                        FROM `messages`
+                        WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                            AND `message_id` NOT IN %s
+                        ORDER BY `message_time` DESC
+                        LIMIT 1;
+                    """, gamespace, recipient_class, recipient, removed_ids)
+
+            if previous is None:
+                await db.execute(
+                    """
+                        DELETE FROM `conversation_summary`
+                        WHERE `gamespace_id`=%s AND `last_message_id`=%s;
+                    """, gamespace, message["message_id"])
+                continue
+
+            # compressed payloads are too large for a preview anyway
+            payload = previous["message_payload"] if previous.get("message_payload_packed") is None else None
+            if payload is not None and not isinstance(payload, str):
+                payload = ujson.dumps(payload)
+
+            await db.execute(
+                """
+                    UPDATE `conversation_summary`
+                    SET `last_message_id`=%s, `last_message_uuid`=%s, `last_message_sender`=%s,
+                        `last_message_time`=%s, `last_message_type`=%s, `last_message_preview`=%s
+                    WHERE `gamespace_id`=%s AND `last_message_id`=%s;
+                """, previous["message_id"], previous["message_uuid"], previous["message_sender"],
+                previous["message_time"], previous["message_type"],
+                payload if payload is not None and len(payload) <= self.preview_size else None,
+                gamespace, message["message_id"])
+
+    async def list(self, gamespace, account_id, offset=0, limit=100, time_after=None):
+        """
+        Returns a list of conversations of an account, most recent first
+        """
+
+        conditions = ""
+        args = [gamespace, account_id]
+
+        if time_after is not None:
+            conditions += " AND `last_message_time`>%s"
+            args.append(time_after)
+
+        try:
+            summaries = await self.shards.gamespace_db(gamespace).query(
+                ConversationSummaries.LIST_QUERY.format(conditions), *args, offset, limit)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list conversations: " + e.args[1])
+
+        return list(map(ConversationSummaryAdapter, summaries))
@@ -0,0 +1,193 @@
+
+from anthill.common.database import DatabaseError
+
+from . import MessageError, CLASS_USER
+
+
+class UnreadCounterAdapter(object):
+    def __init__(self, data):
+        self.recipient_class = data.get("recipient_class")
+        self.recipient = data.get("recipient")
+        self.count = max(int(data.get("unread_count", 0)), 0)
+
+    def dump(self):
+        return {
+            "recipient_class": self.recipient_class,
+            "recipient": self.recipient,
+            "count": self.count
+        }
+
+
+class UnreadCounters(object):
+    """
+    Maintains a number of unread messages per (account, recipient_class, recipient), recipient being
+        the same one `last_read_message` is keyed with: the account itself for direct messages,
+        or a group recipient.
+
+    A counter is incremented for every message stored for an account (except for the ones it has sent),
+        and is set once the account's read position moves, by counting messages past that position
+        only, which is cheap as those are usually few. Removed messages are not subtracted, the counter
+        catches up the next time the conversation is read, or on recount.
+
+    Counters are pushed to an online account once they're set (see MessagesHistoryModel.__unread_changed__),
+        increments are not, as the account receives the new message itself.
+    """
+
+    LIST_QUERY = """
+        SELECT `recipient_class`, `recipient`, `unread_count`
+        FROM `message_unread`
+        WHERE `gamespace_id`=%s AND `account_id`=%s AND `unread_count`>0;
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    async def added(self, db, gamespace, accounts, recipient_class, recipient):
+        if not accounts:
+            return
+
+        await db.execute(
+            """
+                INSERT INTO `message_unread`
+                (`gamespace_id`, `account_id`, `recipient_class`, `recipient`, `unread_count`)
+                VALUES {0}
+                ON DUPLICATE KEY UPDATE `unread_count`=`unread_count` + VALUES(`unread_count`);
+            """.format(", ".join(["(%s, %s, %s, %s, 1)"] * len(accounts))),
+            *[value for account in accounts for value in (gamespace, account, recipient_class, recipient)])
+
+    async def group_added(self, db, recipient_class, recipient, condition, *args):
+        """
+        Increments counters of every group participant matching the condition,
+            see MessagesHistoryModel.__inbox_fan_out__
+        """
+        await db.execute(
+            """
+                INSERT INTO `message_unread`
+                (`gamespace_id`, `account_id`, `recipient_class`, `recipient`, `unread_count`)
+                SELECT `p`.`gamespace_id`, `p`.`participation_account`, %s, %s, 1
+                FROM `groups` AS `g`
+                    INNER JOIN `group_participants` AS `p`
+                    ON `p`.`gamespace_id`=`g`.`gamespace_id` AND `p`.`group_id`=`g`.`group_id`
+                WHERE {0}
+                ON DUPLICATE KEY UPDATE `unread_count`=`unread_count` + VALUES(`unread_count`);
+            """.format(condition), recipient_class, recipient, *args)
+
+    async def read(self, gamespace, account_id, recipient_class, recipient):
+        """
+        Sets the counter to the number of messages past the account's read position
+        """
+        try:
+            await self.shards.gamespace_db(gamespace, write=True).execute(
+                """
+                    INSERT INTO `message_unread`
+                    (`gamespace_id`, `account_id`, `recipient_class`, `recipient`, `unread_count`)
+                    SELECT %s, %s, %s, %s, COUNT(*)
+                    FROM `messages`
+                    WHERE `gamespace_id`=%s AND `message_recipient_class`=%s AND `message_recipient`=%s
+                        AND `message_sender`<>%s AND `message_time`>(
+                            SELECT `last_message_time`
+                            FROM `last_read_message`
+                            WHERE `gamespace_id`=%s AND `account_id`=%s AND `message_recipient_class`=%s
+                                AND `message_recipient`=%s)
+                    ON DUPLICATE KEY UPDATE `unread_count`=VALUES(`unread_count`);
+                """, gamespace, account_id, recipient_class, recipient,
+                gamespace, recipient_class, recipient, account_id,
+                gamespace, account_id, recipient_class, recipient)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to update unread counter: " + e.args[1])
+
+    async def drop(self, db, gamespace, account_id, recipient_class, recipient):
+        await db.execute(
+            """
+                DELETE FROM `message_unread`
+                WHERE `gamespace_id`=%s AND `account_id`=%s AND `recipient_class`=%s AND `recipient`=%s;
+            """, gamespace, account_id, recipient_class, recipient)
+
+    async def recount(self, db, gamespace=None, account_id=None):
+        """
+        Recalculates counters from account inboxes and read positions, of a single account,
+            or of everyone if no account is given. Only meant to repair counters.
+        """
+
+        conditions = ["`m`.`message_sender`<>`i`.`account_id`"]
+        args = []
+
+        if account_id is not None:
+            conditions.append("`i`.`gamespace_id`=%s AND `i`.`account_id`=%s")
+            args.extend([gamespace, account_id])
+
+            await db.execute(
+                """
+                    UPDATE `message_unread`
+                    SET `unread_count`=0
+                    WHERE `gamespace_id`=%s AND `account_id`=%s;
+                """, gamespace, account_id)
+        else:
+            await db.execute(
+                """
+                    UPDATE `message_unread`
+                    SET `unread_count`=0;
+                """)
+
+        await db.execute(
+            """
+                INSERT INTO `message_unread`
+                (`gamespace_id`, `account_id`, `recipient_class`, `recipient`, `unread_count`)
+                {0}
+                ON DUPLICATE KEY UPDATE `unread_count`=VALUES(`unread_count`);
+            """.format(UnreadCounters.__select_unread__(" AND ".join(conditions))), *args)
+
+    async def count_range(self, db, after, last):
+        """
+        Adds unread messages with ids in (after, last] to counters, only meant to fill up counters
+            of an existing history, see MessagesHistoryModel.backfill_unread_stages
+        """
+        await db.execute(
+            """
+                INSERT INTO `message_unread`
+                (`gamespace_id`, `account_id`, `recipient_class`, `recipient`, `unread_count`)
+                {0}
+                ON DUPLICATE KEY UPDATE `unread_count`=`unread_count` + VALUES(`unread_count`);
+            """.format(UnreadCounters.__select_unread__(
+                "`m`.`message_sender`<>`i`.`account_id` AND `i`.`message_id`>%s AND `i`.`message_id`<=%s")),
+            after, last)
+
+    @staticmethod
+    def __select_unread__(condition):
+        """
+        Counts unread messages of inbox entries (`i`) of messages (`m`) matching the condition,
+            per account and recipient
+        """
+        return """
+            SELECT `i`.`gamespace_id`, `i`.`account_id`, `m`.`message_recipient_class`,
+                `m`.`message_recipient`, COUNT(*)
+            FROM `account_inbox` AS `i`
+                INNER JOIN `messages` AS `m` ON `m`.`message_id`=`i`.`message_id`
+                LEFT JOIN `last_read_message` AS `r`
+                ON `r`.`gamespace_id`=`i`.`gamespace_id` AND `r`.`account_id`=`i`.`account_id`
+                    AND `r`.`message_recipient_class`=`m`.`message_recipient_class`
+                    AND `r`.`message_recipient`=`m`.`message_recipient`
+            WHERE {0} AND (`r`.`last_message_time` IS NULL OR `m`.`message_time`>`r`.`last_message_time`)
+            GROUP BY `i`.`gamespace_id`, `i`.`account_id`, `m`.`message_recipient_class`, `m`.`message_recipient`
+        """.format(condition)
+
+    async def list(self, gamespace, account_id):
+        """
+        Returns a list of non-zero counters of an account
+        """
+        try:
+            counters = await self.shards.gamespace_db(gamespace).query(
+                UnreadCounters.LIST_QUERY, gamespace, account_id)
+        except DatabaseError as e:
+            raise MessageError(500, "Failed to list unread counters: " + e.args[1])
+
+        return list(map(UnreadCounterAdapter, counters))
+
+    @staticmethod
+    def recipients(sender, recipient_class, recipient):
+        """
+        Returns accounts a direct message counts as unread for
+        """
+        if recipient_class == CLASS_USER and recipient.isdigit() and recipient != str(sender):
+            return [recipient]
+        return []
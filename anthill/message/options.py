@@ -40,6 +40,50 @@ define("db_name",
        type=str,
        help="MySQL database name")
 
+define("db_check_query_plans",
+       default=False,
+       type=bool,
+       help="Check that hot queries use indexes upon startup, and warn about the ones that do not")
+
+define("db_strict_query_plans",
+       default=False,
+       type=bool,
+       help="Refuse to start if some hot query does not use an index, implies db_check_query_plans. "
+            "Meant for a staging environment with a populated database, to catch schema regressions.")
+
+define("db_replica_host",
+       default="",
+       type=str,
+       help="MySQL read replica location, reads that tolerate a bit of staleness go there. "
+            "Same database name and credentials as the primary. Empty to read everything from the primary.")
+
+define("db_replica_max_lag",
+       default=5.0,
+       type=float,
+       help="If the replica lags behind the primary more than that many seconds, reads go to the primary")
+
+define("db_replica_check_interval",
+       default=1,
+       type=int,
+       help="How often (in seconds) the replica lag is measured")
+
+define("db_shards",
+       default="",
+       type=str,
+       help="Comma-separated locations of extra MySQL shards, gamespaces could be moved onto. "
+            "Same database name and credentials as the primary, which is always the first shard. "
+            "Shards can be added, but never removed or reordered.")
+
+define("db_shards_refresh_interval",
+       default=10,
+       type=int,
+       help="How often (in seconds) the shard directory is reloaded")
+
+define("db_shards_id_step",
+       default=268435456,
+       type=int,
+       help="Ids of every next shard start that far from the previous one, so ids stay unique across shards")
+
 # Messaging
 
 define("message_broker",
@@ -60,12 +104,36 @@ define("group_cluster_size",
        group="groups",
        help="Cluster size to group users groups around")
 
+define("group_cache_size",
+       default=10000,
+       type=int,
+       group="groups",
+       help="How many groups (and as many accounts' group participations) are kept in memory, 0 to disable")
+
+define("group_cache_ttl",
+       default=60,
+       type=int,
+       group="groups",
+       help="For how long (in seconds) a group or a group participation is kept in memory")
+
+define("group_bulk_max_accounts",
+       default=1000,
+       type=int,
+       group="groups",
+       help="How many accounts could join or leave a group with a single bulk request")
+
 define("message_incoming_queue_name",
        default="message.incoming.queue",
        help="RabbitMQ incoming queue name.",
        group="message",
        type=str)
 
+define("message_broadcast_exchange_name",
+       default="message.broadcast",
+       help="RabbitMQ exchange every process listens on for cache updates made by other processes.",
+       group="message",
+       type=str)
+
 define("message_prefetch_count",
        default=32,
        type=int,
@@ -77,3 +145,214 @@ define("outgoing_message_workers",
        type=int,
        group="message",
        help="How much workers process the outgoing messages")
+
+define("message_count_mode",
+       default="exact",
+       type=str,
+       group="message",
+       help="How total counts of message lists are calculated: 'exact' (from maintained counters where "
+            "there are ones, counted otherwise), 'approximate' (from query plans) or 'none' (counts are omitted)")
+
+define("message_count_cache_ttl",
+       default=5,
+       type=int,
+       group="message",
+       help="For how many seconds calculated message counts are cached")
+
+define("message_inbox_backfill_limit",
+       default=1000,
+       type=int,
+       group="message",
+       help="How many recent group messages are put into account's inbox once it joins a group")
+
+
+define("message_retention_days",
+       default=0,
+       type=int,
+       group="retention",
+       help="For how many days messages are kept unless a retention policy says otherwise, 0 means forever")
+
+define("message_retention_interval",
+       default=3600,
+       type=int,
+       group="retention",
+       help="How often (in seconds) expired messages are cleaned up, 0 to disable")
+
+define("message_retention_batch_size",
+       default=1000,
+       type=int,
+       group="retention",
+       help="How many expired messages are deleted in a single transaction")
+
+define("messages_partitioning",
+       default=False,
+       type=bool,
+       group="retention",
+       help="Partition messages by time, so expired messages could be dropped a partition at a time. "
+            "Enabling it on an existing installation rebuilds the messages table once.")
+
+define("messages_partition_days",
+       default=7,
+       type=int,
+       group="retention",
+       help="How many days of messages a single partition holds")
+
+define("messages_partitions_ahead",
+       default=4,
+       type=int,
+       group="retention",
+       help="How many partitions are created in advance")
+
+define("message_archive_days",
+       default=0,
+       type=int,
+       group="retention",
+       help="Delivered messages older than that many days are moved into a compressed archive table, "
+            "0 to keep every message in the main table")
+
+define("message_recent_size",
+       default=100,
+       type=int,
+       group="message",
+       help="How many most recent messages of a group inbox are kept in memory, 0 to disable")
+
+define("message_recent_groups",
+       default=1000,
+       type=int,
+       group="message",
+       help="How many group inboxes are kept in memory at most, least recently read ones are evicted")
+
+define("message_lookup_cache_size",
+       default=10000,
+       type=int,
+       group="message",
+       help="How many messages are kept in memory for lookups by uuid, 0 to disable")
+
+define("message_lookup_cache_ttl",
+       default=60,
+       type=int,
+       group="message",
+       help="For how long (in seconds) a message looked up by uuid is kept in memory")
+
+define("message_drain_chunk_size",
+       default=100,
+       type=int,
+       group="message",
+       help="How many undelivered messages are sent to a connecting account at once")
+
+define("message_read_flush_interval",
+       default=1,
+       type=int,
+       group="message",
+       help="How often (in seconds) messages marked as read are written into the database, "
+            "0 to write them immediately")
+
+define("message_conversation_preview_size",
+       default=1024,
+       type=int,
+       group="message",
+       help="Payloads of last messages up to that many bytes are kept in the conversation list, "
+            "bigger ones are to be fetched separately")
+
+define("message_outbox_interval",
+       default=1,
+       type=int,
+       group="message",
+       help="How often (in seconds) notifications not published right away are retried")
+
+define("message_outbox_batch_size",
+       default=100,
+       type=int,
+       group="message",
+       help="How many update/delete notifications are published to the broker at once")
+
+define("message_export_path",
+       default="",
+       type=str,
+       group="message",
+       help="A directory message history exports are written into, the system temporary directory if empty")
+
+define("message_jobs_interval",
+       default=5,
+       type=int,
+       group="message",
+       help="How often (in seconds) pending background jobs (deleted accounts, deleted groups) are picked up")
+
+define("message_jobs_chunk_size",
+       default=1000,
+       type=int,
+       group="message",
+       help="How many rows a background job deletes per transaction")
+
+define("message_jobs_throttle",
+       default=0.1,
+       type=float,
+       group="message",
+       help="A pause (in seconds) a background job makes between chunks, to leave room for other queries")
+
+define("message_spool_path",
+       default="",
+       type=str,
+       group="message",
+       help="A local directory messages are spooled into while the database fails to store them, "
+            "and replayed from once it's back. Every process needs a directory of its own. Empty to disable.")
+
+define("message_spool_segment_size",
+       default=67108864,
+       type=int,
+       group="message",
+       help="A spool segment is closed once it grows beyond that many bytes")
+
+define("message_spool_sync_delay",
+       default=0.01,
+       type=float,
+       group="message",
+       help="Messages spooled within that many seconds share a single fsync")
+
+define("message_spool_replay_interval",
+       default=1,
+       type=int,
+       group="message",
+       help="How often (in seconds) the spool is replayed into the database")
+
+define("message_spool_batch_size",
+       default=500,
+       type=int,
+       group="message",
+       help="How many spooled messages are stored at once")
+
+define("message_quota_eviction_batch",
+       default=100,
+       type=int,
+       group="message",
+       help="Undelivered messages are evicted once a mailbox is that many messages over its quota")
+
+define("message_quota_refresh_interval",
+       default=60,
+       type=int,
+       group="message",
+       help="How often (in seconds) mailbox quotas are reloaded, in case a change event is lost")
+
+define("message_expiry_interval",
+       default=5,
+       type=int,
+       group="message",
+       help="How often (in seconds) messages past their time to live are swept, 0 to disable")
+
+define("message_expiry_batch_size",
+       default=500,
+       type=int,
+       group="message",
+       help="How many expired messages are swept at once")
+
+define("message_payload_compress_threshold",
+       default=0,
+       type=int,
+       group="message",
+       help="Payloads of at least that many bytes are stored compressed, 0 to store every payload as it is")
+
+define("message_payload_compress_level",
+       default=6,
+       type=int,
+       group="message",
+       help="zlib compression level of compressed payloads")
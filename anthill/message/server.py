@@ -6,6 +6,13 @@ from . model.history import MessagesHistoryModel
 from . model.group import GroupsModel
 from . model.online import OnlineModel
 from . model.queue import MessagesQueueModel
+from . model.migration import MigrationsModel
+from . model.retention import MessagesRetentionModel
+from . model.export import MessagesExport
+from . model.jobs import MessageJobsModel
+from . model.replica import ReplicaRouter
+from . model.quota import MailboxQuotasModel
+from . model.shards import ShardRouter
 from . import handler as h
 from . import admin
 from . import options as _opts
@@ -22,10 +29,71 @@ class MessagesServer(server.Server):
             user=options.db_username,
             password=options.db_password)
 
+        replica_db = database.Database(
+            host=options.db_replica_host,
+            database=options.db_name,
+            user=options.db_username,
+            password=options.db_password) if options.db_replica_host else None
+
+        shards = [
+            database.Database(
+                host=host.strip(),
+                database=options.db_name,
+                user=options.db_username,
+                password=options.db_password)
+            for host in options.db_shards.split(",")
+            if host.strip()
+        ]
+
+        self.shards = ShardRouter(
+            self.db, self, shards,
+            refresh_interval=options.db_shards_refresh_interval,
+            id_step=options.db_shards_id_step)
+        self.replica = ReplicaRouter(
+            self.db, replica_db,
+            max_lag=options.db_replica_max_lag,
+            check_interval=options.db_replica_check_interval)
         self.history = MessagesHistoryModel(self.db, self)
         self.groups = GroupsModel(self.db, self)
+        self.jobs = MessageJobsModel(
+            self.db,
+            interval=options.message_jobs_interval,
+            chunk_size=options.message_jobs_chunk_size,
+            throttle=options.message_jobs_throttle)
+        self.jobs.register(MessagesHistoryModel.JOB_ACCOUNTS_DELETED, self.history.accounts_deleted_stages)
+        self.jobs.register(MessagesHistoryModel.JOB_GROUP_PURGED, self.history.group_purged_stages)
+        self.jobs.register(ShardRouter.JOB_MOVE, self.shards.move_stages)
+        self.jobs.register(MessagesHistoryModel.JOB_RECOMPRESS, self.history.recompress_stages)
+        self.jobs.register(MessagesHistoryModel.JOB_BACKFILL_SUMMARIES, self.history.backfill_summaries_stages)
+        self.jobs.register(MessagesHistoryModel.JOB_BACKFILL_COUNTERS, self.history.backfill_counters_stages)
+        self.jobs.register(MessagesHistoryModel.JOB_BACKFILL_INBOX, self.history.backfill_inbox_stages)
+        self.jobs.register(MessagesHistoryModel.JOB_BACKFILL_UNREAD, self.history.backfill_unread_stages)
+        self.jobs.register(
+            MessagesHistoryModel.JOB_BACKFILL_CONVERSATIONS, self.history.backfill_conversations_stages)
+        self.shards.add_models([self.history, self.groups])
+        self.migrations = MigrationsModel(
+            self.db, [self.history, self.groups], shards=self.shards,
+            check_query_plans=options.db_check_query_plans or options.db_strict_query_plans,
+            strict_query_plans=options.db_strict_query_plans)
+        self.retention = MessagesRetentionModel(
+            self.db, self.history,
+            default_days=options.message_retention_days,
+            partitioning=options.messages_partitioning,
+            partition_days=options.messages_partition_days,
+            partitions_ahead=options.messages_partitions_ahead,
+            interval=options.message_retention_interval,
+            batch_size=options.message_retention_batch_size)
+        self.quotas = MailboxQuotasModel(
+            self.db, self,
+            eviction_batch=options.message_quota_eviction_batch,
+            refresh_interval=options.message_quota_refresh_interval)
+        self.exports = MessagesExport(self.history, path=options.message_export_path)
         self.online = OnlineModel(self.groups, self.history)
         self.message_queue = MessagesQueueModel(self.history)
+        self.message_queue.add_broadcast_listener(self.history.history_event_received)
+        self.message_queue.add_broadcast_listener(self.shards.event_received)
+        self.message_queue.add_broadcast_listener(self.quotas.event_received)
+        self.message_queue.add_broadcast_listener(self.groups.event_received)
 
     def get_metadata(self):
         return {
@@ -48,11 +116,23 @@ class MessagesServer(server.Server):
             "user": admin.UserController,
             "messages": admin.MessagesController,
             "history": admin.MessagesHistoryController,
-            "user_messages": admin.UserMessagesController
+            "user_messages": admin.UserMessagesController,
+            "retention": admin.RetentionController,
+            "quotas": admin.QuotasController,
+            "history_export": admin.HistoryExportController,
+            "jobs": admin.JobsController,
+            "shards": admin.ShardsController,
+            "compression": admin.CompressionController
         }
 
     def get_models(self):
-        return [self.groups, self.history, self.online, self.message_queue]
+        # jobs are set up before models that add them on setup, but only run once everything has started
+        return [self.shards, self.replica, self.jobs, self.groups, self.history, self.migrations, self.retention,
+                self.quotas, self.online, self.message_queue]
+
+    async def started(self):
+        await super(MessagesServer, self).started()
+        self.jobs.start()
 
     def get_internal_handler(self):
         return h.InternalHandler(self)
@@ -69,6 +149,9 @@ class MessagesServer(server.Server):
             (r"/send/(\w+)/(\w+)", h.SendMessageHandler),
             (r"/send", h.SendMessagesHandler),
             (r"/messages", h.ReadMessagesHandler),
+            (r"/messages/read", h.MarkMessagesAsReadHandler),
+            (r"/unread", h.UnreadMessagesHandler),
+            (r"/conversations", h.ConversationsHandler),
             (r"/messages/with/(.*)", h.ReadMessagesRecipientHandler),
             (r"/message/(.*)", h.MessageHandler),
             (r"/listen", h.ConversationEndpointHandler)
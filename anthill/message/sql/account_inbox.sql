@@ -0,0 +1,8 @@
+CREATE TABLE `account_inbox` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `account_id` int(11) unsigned NOT NULL,
+  `message_id` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`gamespace_id`,`account_id`,`message_id`),
+  KEY `message_id` (`message_id`),
+  KEY `account_id` (`account_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
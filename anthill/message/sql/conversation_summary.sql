@@ -0,0 +1,17 @@
+CREATE TABLE `conversation_summary` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `account_id` int(11) unsigned NOT NULL,
+  `recipient_class` varchar(64) NOT NULL,
+  `recipient` varchar(255) NOT NULL DEFAULT '',
+  `last_message_id` int(11) unsigned NOT NULL,
+  `last_message_uuid` varchar(40) DEFAULT NULL,
+  `last_message_sender` int(11) NOT NULL,
+  `last_message_time` datetime NOT NULL,
+  `last_message_type` varchar(64) NOT NULL,
+  `last_message_preview` json DEFAULT NULL,
+  PRIMARY KEY (`gamespace_id`,`account_id`,`recipient_class`,`recipient`),
+  KEY `recent` (`gamespace_id`,`account_id`,`last_message_time`),
+  KEY `last_message` (`gamespace_id`,`last_message_id`),
+  KEY `recipient` (`gamespace_id`,`recipient_class`,`recipient`),
+  KEY `account_id` (`account_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -10,6 +10,7 @@ CREATE TABLE `group_participants` (
   PRIMARY KEY (`participation_id`),
   UNIQUE KEY `gamespace_id` (`gamespace_id`,`group_id`,`participation_account`),
   KEY `participation_account` (`participation_account`),
+  KEY `account` (`gamespace_id`,`participation_account`),
   KEY `group_id` (`group_id`),
   CONSTRAINT `group_participants_ibfk_1` FOREIGN KEY (`group_id`) REFERENCES `groups` (`group_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
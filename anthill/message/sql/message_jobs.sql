@@ -0,0 +1,17 @@
+CREATE TABLE `message_jobs` (
+  `job_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `job_kind` varchar(64) NOT NULL,
+  `job_args` json NOT NULL,
+  `job_status` enum('pending','running','done','failed') NOT NULL DEFAULT 'pending',
+  `job_stage` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_stages` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_checkpoint` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `job_progress` bigint(20) unsigned NOT NULL DEFAULT '0',
+  `job_error` varchar(1024) DEFAULT NULL,
+  `job_created` datetime NOT NULL,
+  `job_updated` datetime NOT NULL,
+  PRIMARY KEY (`job_id`),
+  KEY `status` (`job_status`,`job_id`),
+  KEY `gamespace` (`gamespace_id`,`job_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,9 @@
+CREATE TABLE `message_mailbox` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `recipient_class` varchar(64) NOT NULL,
+  `recipient` varchar(255) NOT NULL,
+  `message_type` varchar(64) NOT NULL DEFAULT '',
+  `mailbox_undelivered` int(11) unsigned NOT NULL DEFAULT '0',
+  `mailbox_evicted` bigint(20) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`,`recipient_class`,`recipient`,`message_type`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
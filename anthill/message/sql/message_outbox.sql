@@ -0,0 +1,6 @@
+CREATE TABLE `message_outbox` (
+  `outbox_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `outbox_message` json NOT NULL,
+  PRIMARY KEY (`outbox_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
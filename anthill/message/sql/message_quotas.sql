@@ -0,0 +1,7 @@
+CREATE TABLE `message_quotas` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `recipient_class` varchar(64) NOT NULL,
+  `message_type` varchar(64) NOT NULL DEFAULT '',
+  `quota_messages` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`gamespace_id`,`recipient_class`,`message_type`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,6 @@
+CREATE TABLE `message_retention` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `message_type` varchar(64) NOT NULL DEFAULT '',
+  `retention_days` int(11) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`,`message_type`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,5 @@
+CREATE TABLE `message_shard_fences` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `fence_target` int(11) unsigned DEFAULT NULL,
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
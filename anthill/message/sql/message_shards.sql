@@ -0,0 +1,7 @@
+CREATE TABLE `message_shards` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `shard_id` int(11) unsigned NOT NULL,
+  `shard_state` enum('active','moving') NOT NULL DEFAULT 'active',
+  `shard_target` int(11) unsigned DEFAULT NULL,
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,9 @@
+CREATE TABLE `message_unread` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `account_id` int(11) unsigned NOT NULL,
+  `recipient_class` varchar(64) NOT NULL DEFAULT '',
+  `recipient` varchar(255) NOT NULL DEFAULT '',
+  `unread_count` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`,`account_id`,`recipient_class`,`recipient`),
+  KEY `account_id` (`account_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -8,10 +8,19 @@ CREATE TABLE `messages` (
   `message_time` datetime NOT NULL,
   `message_type` varchar(64) NOT NULL,
   `message_payload` json NOT NULL,
+  `message_payload_packed` mediumblob DEFAULT NULL,
   `message_delivered` tinyint(1) NOT NULL DEFAULT '0',
   `message_flags` set('REMOVE_DELIVERED','EDITABLE','DELETABLE','SERVER') DEFAULT NULL,
+  `message_conversation` varchar(24) DEFAULT NULL,
+  `message_expires` datetime DEFAULT NULL,
   PRIMARY KEY (`message_id`),
   UNIQUE KEY `message_uuid` (`message_uuid`),
   KEY `message_recipient` (`message_recipient`),
-  KEY `message_sender` (`message_sender`)
+  KEY `message_sender` (`message_sender`),
+  KEY `recipient_delivered` (`gamespace_id`,`message_recipient_class`,`message_recipient`,`message_delivered`,`message_id`),
+  KEY `recipient_time` (`gamespace_id`,`message_recipient_class`,`message_recipient`,`message_time`),
+  KEY `sender` (`gamespace_id`,`message_sender`,`message_id`),
+  KEY `time` (`gamespace_id`,`message_time`),
+  KEY `conversation` (`gamespace_id`,`message_conversation`,`message_id`),
+  KEY `expires` (`message_expires`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
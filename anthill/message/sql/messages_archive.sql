@@ -0,0 +1,23 @@
+CREATE TABLE `messages_archive` (
+  `message_id` int(11) unsigned NOT NULL,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `message_uuid` varchar(40) DEFAULT NULL,
+  `message_sender` int(11) NOT NULL,
+  `message_recipient_class` varchar(64) NOT NULL,
+  `message_recipient` varchar(255) NOT NULL DEFAULT '',
+  `message_time` datetime NOT NULL,
+  `message_type` varchar(64) NOT NULL,
+  `message_payload` json NOT NULL,
+  `message_payload_packed` mediumblob DEFAULT NULL,
+  `message_delivered` tinyint(1) NOT NULL DEFAULT '0',
+  `message_flags` set('REMOVE_DELIVERED','EDITABLE','DELETABLE','SERVER') DEFAULT NULL,
+  `message_conversation` varchar(24) DEFAULT NULL,
+  `message_expires` datetime DEFAULT NULL,
+  PRIMARY KEY (`message_id`),
+  UNIQUE KEY `message_uuid` (`message_uuid`),
+  KEY `recipient_time` (`gamespace_id`,`message_recipient_class`,`message_recipient`,`message_time`),
+  KEY `sender` (`gamespace_id`,`message_sender`,`message_id`),
+  KEY `time` (`gamespace_id`,`message_time`),
+  KEY `conversation` (`gamespace_id`,`message_conversation`,`message_id`),
+  KEY `expires` (`message_expires`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8;
\ No newline at end of file
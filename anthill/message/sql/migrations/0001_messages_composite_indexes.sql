@@ -0,0 +1,11 @@
+ALTER TABLE `messages`
+  ADD KEY `recipient_delivered` (`gamespace_id`,`message_recipient_class`,`message_recipient`,`message_delivered`,`message_id`),
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages`
+  ADD KEY `recipient_time` (`gamespace_id`,`message_recipient_class`,`message_recipient`,`message_time`),
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages`
+  ADD KEY `sender` (`gamespace_id`,`message_sender`,`message_id`),
+  ALGORITHM=INPLACE, LOCK=NONE;
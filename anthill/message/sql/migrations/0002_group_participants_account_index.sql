@@ -0,0 +1,3 @@
+ALTER TABLE `group_participants`
+  ADD KEY `account` (`gamespace_id`,`participation_account`),
+  ALGORITHM=INPLACE, LOCK=NONE;
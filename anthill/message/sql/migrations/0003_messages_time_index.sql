@@ -0,0 +1,3 @@
+ALTER TABLE `messages`
+  ADD KEY `time` (`gamespace_id`,`message_time`),
+  ALGORITHM=INPLACE, LOCK=NONE;
\ No newline at end of file
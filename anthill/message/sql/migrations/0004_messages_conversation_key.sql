@@ -0,0 +1,15 @@
+ALTER TABLE `messages`
+  ADD COLUMN `message_conversation` varchar(24) DEFAULT NULL,
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages`
+  ADD KEY `conversation` (`gamespace_id`,`message_conversation`,`message_id`),
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages_archive`
+  ADD COLUMN `message_conversation` varchar(24) DEFAULT NULL,
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages_archive`
+  ADD KEY `conversation` (`gamespace_id`,`message_conversation`,`message_id`),
+  ALGORITHM=INPLACE, LOCK=NONE;
\ No newline at end of file
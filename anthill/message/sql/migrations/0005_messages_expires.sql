@@ -0,0 +1,15 @@
+ALTER TABLE `messages`
+  ADD COLUMN `message_expires` datetime DEFAULT NULL,
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages`
+  ADD KEY `expires` (`message_expires`),
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages_archive`
+  ADD COLUMN `message_expires` datetime DEFAULT NULL,
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages_archive`
+  ADD KEY `expires` (`message_expires`),
+  ALGORITHM=INPLACE, LOCK=NONE;
\ No newline at end of file
@@ -0,0 +1,7 @@
+ALTER TABLE `messages`
+  ADD COLUMN `message_payload_packed` mediumblob DEFAULT NULL,
+  ALGORITHM=INPLACE, LOCK=NONE;
+
+ALTER TABLE `messages_archive`
+  ADD COLUMN `message_payload_packed` mediumblob DEFAULT NULL,
+  ALGORITHM=INPLACE, LOCK=NONE;
\ No newline at end of file
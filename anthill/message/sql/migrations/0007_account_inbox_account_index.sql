@@ -0,0 +1,3 @@
+ALTER TABLE `account_inbox`
+  ADD KEY `account_id` (`account_id`),
+  ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from anthill.message.model.membership import GroupMembershipCache
+
+
+class FakeApplication(object):
+    monitoring = None
+
+
+class GroupMembershipCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = GroupMembershipCache(FakeApplication(), max_size=10, ttl=60)
+
+    def test_participations_per_gamespace(self):
+        self.cache.put_participations(1, 100, [{"group_id": 1}])
+        self.cache.put_participations(2, 100, [{"group_id": 2}])
+
+        self.assertEqual(self.cache.get_participations(1, 100), [{"group_id": 1}])
+        self.assertEqual(self.cache.get_participations(2, 100), [{"group_id": 2}])
+        self.assertIsNone(self.cache.get_participations(3, 100))
+        self.assertIsNone(self.cache.get_participations(1, 200))
+
+    def test_forget_in_gamespace(self):
+        self.cache.put_participations(1, 100, [])
+        self.cache.put_participations(2, 100, [])
+
+        self.cache.forget(1, accounts=[100])
+
+        self.assertIsNone(self.cache.get_participations(1, 100))
+        self.assertEqual(self.cache.get_participations(2, 100), [])
+
+    def test_forget_in_every_gamespace(self):
+        self.cache.put_participations(1, 100, [])
+        self.cache.put_participations(2, 100, [])
+        self.cache.put_participations(1, 200, [])
+
+        self.cache.event_received(self.cache.event(None, accounts=["100"]))
+
+        self.assertIsNone(self.cache.get_participations(1, 100))
+        self.assertIsNone(self.cache.get_participations(2, 100))
+        self.assertEqual(self.cache.get_participations(1, 200), [])
@@ -0,0 +1,189 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.common.database import Database
+
+from anthill.message import options as _opts
+from anthill.message.model import CLASS_USER
+from anthill.message.model.counters import KIND_RECIPIENT, conversation_key
+from anthill.message.model.history import MessagesHistoryModel
+from anthill.message.model.group import GroupsModel
+from anthill.message.model.migration import MigrationsModel
+from anthill.message.model.replica import ReplicaRouter
+from anthill.message.model.shards import ShardRouter
+
+import datetime
+import unittest
+import os
+
+
+SQL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql")
+
+# a scratch database every table of which is dropped and created again
+DB_HOST = os.environ.get("MESSAGE_TEST_DB_HOST")
+DB_NAME = os.environ.get("MESSAGE_TEST_DB_NAME", "test_message")
+DB_USERNAME = os.environ.get("MESSAGE_TEST_DB_USERNAME", "root")
+DB_PASSWORD = os.environ.get("MESSAGE_TEST_DB_PASSWORD", "")
+
+GAMESPACES = 3
+ACCOUNTS = 100
+GROUPS = 10
+MESSAGES = 2000
+
+
+class Application(object):
+    def module_path(self, path):
+        return os.path.join(os.path.dirname(SQL_PATH), path)
+
+
+@unittest.skipUnless(DB_HOST, "MESSAGE_TEST_DB_HOST is not set")
+class TestQueryPlans(AsyncTestCase):
+    """
+    Runs EXPLAIN on every query of MigrationsModel.list_query_plans over a populated scratch database,
+        and checks each one reads its tables with the indexes it's expected to
+    """
+
+    def setUp(self):
+        super(TestQueryPlans, self).setUp()
+
+        self.db = Database(host=DB_HOST, database=DB_NAME, user=DB_USERNAME, password=DB_PASSWORD)
+
+        app = Application()
+        app.shards = ShardRouter(self.db, app)
+        app.replica = ReplicaRouter(self.db)
+        app.history = MessagesHistoryModel(self.db, app)
+        app.groups = GroupsModel(self.db, app)
+
+        self.models = [app.groups, app.history]
+        self.migrations = MigrationsModel(self.db, self.models)
+
+    async def __create_tables__(self):
+        tables = []
+        for model in self.models:
+            tables.extend(model.get_setup_tables())
+
+        await self.db.execute("SET FOREIGN_KEY_CHECKS=0;")
+
+        for table in tables:
+            await self.db.execute("DROP TABLE IF EXISTS `{0}`;".format(table))
+
+        await self.db.execute("SET FOREIGN_KEY_CHECKS=1;")
+
+        for table in tables:
+            with open(os.path.join(SQL_PATH, table + ".sql")) as f:
+                await self.db.execute(f.read())
+
+    async def __insert__(self, table, rows):
+        columns = list(rows[0].keys())
+
+        for start in range(0, len(rows), 500):
+            chunk = rows[start:start + 500]
+            await self.db.execute(
+                """
+                    INSERT INTO `{0}`
+                    ({1})
+                    VALUES {2};
+                """.format(
+                    table, ", ".join("`{0}`".format(column) for column in columns),
+                    ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(chunk))),
+                *[row[column] for row in chunk for column in columns])
+
+    async def __populate__(self):
+        """
+        Fills the tables up with a history spread across gamespaces, groups and accounts, so the optimizer
+            has statistics to choose indexes with
+        """
+        now = datetime.datetime(2018, 1, 1)
+
+        groups = []
+        participants = []
+
+        for gamespace in range(1, GAMESPACES + 1):
+            for group in range(GROUPS):
+                group_id = len(groups) + 1
+                groups.append({
+                    "group_id": group_id, "gamespace_id": gamespace, "group_class": "group",
+                    "group_key": str(group)
+                })
+                participants.extend({
+                    "group_id": group_id, "group_class": "group", "group_key": str(group),
+                    "gamespace_id": gamespace, "cluster_id": 0, "participation_account": account
+                } for account in range(group, ACCOUNTS, GROUPS))
+
+        await self.__insert__("groups", groups)
+        await self.__insert__("group_participants", participants)
+
+        messages = []
+        inbox = []
+        counters = {}
+        summaries = {}
+        unread = {}
+
+        for message_id in range(1, MESSAGES + 1):
+            gamespace = message_id % GAMESPACES + 1
+            sender = message_id % ACCOUNTS
+            time = now + datetime.timedelta(minutes=message_id)
+
+            if message_id % 2:
+                recipient_class, recipient = CLASS_USER, str((sender + message_id) % ACCOUNTS)
+                accounts = {sender, int(recipient)}
+            else:
+                recipient_class, recipient = "group", str(message_id % GROUPS)
+                accounts = set(range(int(recipient), ACCOUNTS, GROUPS))
+
+            messages.append({
+                "message_id": message_id, "gamespace_id": gamespace, "message_uuid": "uuid-{0}".format(message_id),
+                "message_sender": sender, "message_recipient_class": recipient_class,
+                "message_recipient": recipient, "message_time": time, "message_type": "chat",
+                "message_payload": "{}", "message_delivered": message_id % 3 == 0,
+                "message_conversation": conversation_key(
+                    sender, recipient) if recipient_class == CLASS_USER else None,
+                "message_expires": time + datetime.timedelta(days=1) if message_id % 5 == 0 else None
+            })
+
+            key = (gamespace, KIND_RECIPIENT, recipient_class, recipient)
+            counters[key] = counters.get(key, 0) + 1
+
+            for account in accounts:
+                inbox.append({"gamespace_id": gamespace, "account_id": account, "message_id": message_id})
+                summaries[(gamespace, account, recipient_class, recipient)] = (message_id, sender, time)
+                if account != sender:
+                    key = (gamespace, account, recipient_class, recipient)
+                    unread[key] = unread.get(key, 0) + 1
+
+        await self.__insert__("messages", messages)
+        await self.__insert__("account_inbox", inbox)
+
+        await self.__insert__("message_counters", [{
+            "gamespace_id": gamespace, "counter_kind": kind, "counter_class": counter_class,
+            "counter_key": counter_key, "counter_value": value
+        } for (gamespace, kind, counter_class, counter_key), value in counters.items()])
+
+        await self.__insert__("conversation_summary", [{
+            "gamespace_id": gamespace, "account_id": account, "recipient_class": recipient_class,
+            "recipient": recipient, "last_message_id": message_id, "last_message_sender": sender,
+            "last_message_time": time, "last_message_type": "chat"
+        } for (gamespace, account, recipient_class, recipient), (message_id, sender, time) in summaries.items()])
+
+        await self.__insert__("message_unread", [{
+            "gamespace_id": gamespace, "account_id": account, "recipient_class": recipient_class,
+            "recipient": recipient, "unread_count": value
+        } for (gamespace, account, recipient_class, recipient), value in unread.items()])
+
+        await self.db.execute(
+            """
+                ANALYZE TABLE `messages`, `account_inbox`, `message_counters`, `conversation_summary`,
+                    `message_unread`, `groups`, `group_participants`;
+            """)
+
+    @gen_test(timeout=120)
+    async def test_query_plans(self):
+        await self.__create_tables__()
+        await self.__populate__()
+
+        plans = self.migrations.list_query_plans()
+        self.assertTrue(plans)
+
+        for name, (query, args, indexes) in sorted(plans.items()):
+            with self.subTest(query=name):
+                plan = await self.migrations.explain(query, *args)
+                self.assertEqual(MigrationsModel.check_plan(plan, indexes), [])
@@ -0,0 +1,129 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.message.model import MessageFlags
+from anthill.message.model.history import MessagesHistoryModel
+from anthill.message.model.lookup import MessageLookupCache
+from anthill.message.model.read import ReadPositions
+from anthill.message.model.compression import PayloadCompression
+
+import datetime
+import pytz
+
+
+class FakeDatabase(object):
+    """
+    Stands for a shard: stores nothing, and returns the same rows for any query
+    """
+
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.inserted = 0
+
+    def acquire(self, auto_commit=True):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return False
+
+    async def insert(self, query, *args):
+        self.inserted += 1
+        return self.inserted
+
+    async def query(self, query, *args):
+        return list(self.rows)
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+class FakeShards(object):
+    def __init__(self, db):
+        self.db = db
+
+    def gamespace_db(self, gamespace, write=False):
+        return self.db
+
+
+class FakeCounters(object):
+    async def message_added(self, db, gamespace, sender, recipient_class, recipient):
+        pass
+
+
+class FakeQuotas(object):
+    def check(self, gamespace, mailboxes):
+        pass
+
+
+class FakeApplication(object):
+    quotas = FakeQuotas()
+
+
+class TestMarkAsRead(AsyncTestCase):
+    def setUp(self):
+        super(TestMarkAsRead, self).setUp()
+
+        self.db = FakeDatabase()
+
+        history = MessagesHistoryModel.__new__(MessagesHistoryModel)
+        history.app = FakeApplication()
+        history.shards = FakeShards(self.db)
+        history.counters = FakeCounters()
+        history.compression = PayloadCompression()
+        history.lookup = MessageLookupCache()
+        history.read_positions = ReadPositions(history.shards)
+        history.uuids_partitioned = False
+        history.archive_days = 0
+
+        async def inbox_fan_out(*args):
+            pass
+
+        history.__inbox_fan_out__ = inbox_fan_out
+        history.__history_event__ = lambda *args, **kwargs: None
+
+        self.history = history
+
+    @gen_test
+    async def test_fresh_and_older_messages(self):
+        # an older message is read from the database, with a naive time
+        self.db.rows = [{
+            "message_id": 100,
+            "message_uuid": "older",
+            "message_sender": 2,
+            "message_recipient_class": "group",
+            "message_recipient": "chat",
+            "message_time": datetime.datetime(2018, 1, 1, 10, 0, 0),
+            "message_type": "chat",
+            "message_payload": "{}",
+            "message_delivered": 1,
+            "message_flags": "",
+            "message_expires": None
+        }]
+
+        # a fresh one is cached as it's stored, with a time that comes from the queue as an aware one
+        await self.history.add_message(
+            1, 3, "fresh", "group", "chat",
+            datetime.datetime(2018, 1, 1, 11, 0, 0, tzinfo=pytz.utc),
+            "chat", {"text": "hi"}, MessageFlags([]), delivered=True)
+
+        not_found = await self.history.mark_messages_as_read(1, 2, ["fresh", "older"])
+        self.assertEqual(not_found, [])
+
+        pending = self.history.read_positions.get_pending(1, 2)
+        self.assertEqual(pending[("group", "chat")], (datetime.datetime(2018, 1, 1, 11, 0, 0), "fresh"))
+
+        # the position flushed before is older than the pending one
+        self.db.rows = [{
+            "message_recipient_class": "group",
+            "message_recipient": "chat",
+            "last_message_time": datetime.datetime(2018, 1, 1, 10, 0, 0),
+            "last_message_uuid": "older"
+        }]
+
+        positions = await self.history.list_read_messages(1, 2)
+        self.assertEqual([position.uuid for position in positions], ["fresh"])
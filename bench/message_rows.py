@@ -0,0 +1,139 @@
+"""
+Renders a page of messages the way list endpoints do, with the eager message rows they used to have,
+    then with MessageAdapter and dumps_messages, and reports the time per page.
+
+    python bench/message_rows.py [--messages 100] [--payload 300] [--number 2000] [--repeat 5]
+"""
+
+from anthill.message.handler import dumps_messages
+from anthill.message.model import MessageFlags
+from anthill.message.model.history import MessageAdapter
+
+import argparse
+import datetime
+import timeit
+import ujson
+
+
+class EagerMessageAdapter(object):
+    """
+    A message row as it used to be: the payload decoded and the flags parsed as soon as it's read
+    """
+
+    def __init__(self, data):
+        self.message_id = data.get("message_id")
+        self.message_uuid = data.get("message_uuid")
+        self.recipient_class = str(data.get("message_recipient_class"))
+        self.sender = str(data.get("message_sender"))
+        self.recipient = str(data.get("message_recipient"))
+        self.time = data.get("message_time")
+        self.message_type = data.get("message_type")
+        self.payload = data.get("message_payload")
+        if isinstance(self.payload, str):
+            self.payload = ujson.loads(self.payload)
+        self.delivered = data.get("message_delivered")
+
+        flags = data.get("message_flags", "").lower().split(",")
+
+        self.flags = MessageFlags(flags)
+
+
+class Response(object):
+    """
+    Collects what a handler writes
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def set_header(self, name, value):
+        pass
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def body(self):
+        return "".join(self.chunks)
+
+
+def rows(count, payload_size):
+    time = datetime.datetime(2018, 1, 1)
+
+    return [{
+        "message_id": message_id,
+        "message_uuid": "00000000-0000-0000-0000-{0:012d}".format(message_id),
+        "message_sender": 1000 + message_id % 10,
+        "message_recipient_class": "group",
+        "message_recipient": "chat",
+        "message_time": time + datetime.timedelta(seconds=message_id),
+        "message_type": "chat",
+        "message_payload": ujson.dumps({
+            "text": "x" * payload_size,
+            "sent": message_id,
+            "attachments": [{"kind": "sticker", "id": message_id}]
+        }),
+        "message_delivered": 1,
+        "message_flags": "remove_delivered,editable"
+    } for message_id in range(count, 0, -1)]
+
+
+def eager_page(page, gamespace_id):
+    messages = list(map(EagerMessageAdapter, page))
+
+    response = Response()
+    response.write(ujson.dumps({
+        "recipient": {"class": "group", "key": "chat"},
+        "total_count": len(messages),
+        "messages": [
+            {
+                "uuid": message.message_uuid,
+                "recipient_class": message.recipient_class,
+                "sender": message.sender,
+                "recipient": message.recipient,
+                "gamespace": int(gamespace_id),
+                "time": str(message.time),
+                "type": message.message_type,
+                "payload": message.payload
+            }
+            for message in reversed(messages)
+        ]
+    }, escape_forward_slashes=False))
+    return response.body()
+
+
+def lazy_page(page, gamespace_id):
+    messages = list(map(MessageAdapter, page))
+
+    response = Response()
+    dumps_messages(response, {
+        "recipient": {"class": "group", "key": "chat"},
+        "total_count": len(messages)
+    }, messages, gamespace_id)
+    return response.body()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks rendering of message pages")
+    parser.add_argument("--messages", type=int, default=100, help="messages per page")
+    parser.add_argument("--payload", type=int, default=300, help="bytes of text in a payload")
+    parser.add_argument("--number", type=int, default=2000, help="pages rendered per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements, the best one is reported")
+    args = parser.parse_args()
+
+    page = rows(args.messages, args.payload)
+
+    if ujson.loads(eager_page(page, 1)) != ujson.loads(lazy_page(page, 1)):
+        raise SystemExit("Pages differ")
+
+    results = {}
+
+    for name, render in [("eager", eager_page), ("lazy", lazy_page)]:
+        best = min(timeit.repeat(lambda: render(page, 1), number=args.number, repeat=args.repeat))
+        results[name] = best / args.number * 1000000
+        print("{0:>6}: {1:.1f} us per {2}-message page".format(name, results[name], args.messages))
+
+    print("{0:>6}: {1:.2f}x".format("gain", results["eager"] / results["lazy"]))
+
+
+if __name__ == "__main__":
+    main()